@@ -0,0 +1,56 @@
+import argparse
+from data_formatting import build_chaco_store, watch_chaco_stores
+
+# One-time ingest of NeMo outputs into memory-mapped feature stores (one per atlas/chaco_type/nemo_settings combination).
+# Afterwards, pass the same --store_path to parse_args.py so that create_data_set reads the store instead of the pickles.
+# With --watch true, the script keeps running and appends newly arriving NeMo outputs to the stores.
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Ingest NeMo outputs (subjectID_*_mean.pkl files) into memory-mapped ChaCo feature stores.")
+
+  parser.add_argument("--nemo_path", default='/home/ubuntu/enigma/lesionmasks/',
+    help="Absolute path where NeMo outputs (subjectID_*_mean.pkl files) are located, or .zip archive(s) of NeMo outputs (comma-separated), default='/home/ubuntu/enigma/lesionmasks/'")
+
+  parser.add_argument("--store_path", default='/home/ubuntu/enigma/chaco_store',
+    help="Directory to write the feature stores to, default='/home/ubuntu/enigma/chaco_store'")
+
+  parser.add_argument("--nemo_settings", default=['1mm','sdstream'],type=lambda s: [item.replace(" ", "") for item in s.split(',')],
+    help="Settings used in Network Modification Tool. Default=['1mm','sdstream'], Options: '1mm', '2mm', 'sdstream', 'ifod2act'. Must have resolution 1st and then deterministic/probabilistic choice second.")
+
+  parser.add_argument("--atlases", default=['fs86subj'], type=lambda s: [item.replace(" ", "") for item in s.split(',')],
+    help="Which atlases to ingest, 'fs86subj', 'shen268', default=['fs86subj']")
+
+  parser.add_argument("--chaco_types", default=['chacovol'], type=lambda s: [item.replace(" ", "") for item in s.split(',')],
+    help="Which chaco types to ingest, Options: 'chacovol', 'chacoconn', default=['chacovol']")
+
+  parser.add_argument("--dtype", default='float64',
+    help="Data type of the stored feature matrix, Options: 'float64', 'float32', default='float64'")
+
+  parser.add_argument("--n_workers", type=int, default=8,
+    help="Number of threads used to read NeMo outputs, default=8")
+
+  parser.add_argument("--watch", default='false',
+    help="Keep running and append new NeMo outputs in nemo_path to the existing stores (new subjects only) every --interval seconds, default='false'")
+
+  parser.add_argument("--interval", type=float, default=60,
+    help="Seconds between checks for new NeMo outputs in watch mode, default=60")
+
+  args = parser.parse_args()
+
+  atlas_options = ['fs86subj', 'shen268']
+  if not set(args.atlases).issubset(set(atlas_options)):
+      raise RuntimeError('Warning! Unknown atlas type specified: {}\n Only the following options are allowed: {} \n'.format(args.atlases, atlas_options))
+
+  chaco_options = ['chacovol', 'chacoconn']
+  if not set(args.chaco_types).issubset(set(chaco_options)):
+      raise RuntimeError('Warning! Unknown chaco type specified: {}\n Only the following options are allowed: {} \n'.format(args.chaco_types, chaco_options))
+
+  # anything else I'm assuming you meant false.
+  args.watch = (args.watch =='True') or (args.watch == 'true') or (args.watch == 'T') or (args.watch == '1')
+
+  if args.watch:
+    watch_chaco_stores(args.nemo_path, args.store_path, args.atlases, args.chaco_types, args.nemo_settings, args.interval, args.n_workers, dtype=args.dtype)
+  else:
+    for atlas in args.atlases:
+      for chaco_type in args.chaco_types:
+        build_chaco_store(args.nemo_path, args.store_path, atlas, chaco_type, args.nemo_settings, args.dtype, args.n_workers)
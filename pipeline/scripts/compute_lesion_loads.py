@@ -0,0 +1,62 @@
+import argparse
+import pandas as pd
+from data_formatting import load_csv
+from lesion_load import get_template_files, find_lesion_masks, compute_lesion_loads_batch, EXTRAS_DIR
+
+# Batch computation of lesion loads for every subject of the .csv file that has a lesion mask in lesionmask_path.
+# Results are appended to the output table subject by subject; re-running the same command (after an interruption, or
+# after new masks were added) only computes the subjects whose mask or templates are new or changed.
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Compute S-MATT, LBM and sLNM lesion loads for a directory of lesion masks ({subject ID}.nii.gz).")
+
+  parser.add_argument("--lesionmask_path", default='/home/ubuntu/enigma/lesionmasks/',
+    help="Directory of binary lesion masks in MNI space ({subject ID}.nii.gz), default='/home/ubuntu/enigma/lesionmasks/'")
+
+  parser.add_argument("--csv_path", default='/home/ubuntu/enigma/motor_predictions/Behaviour_Information_ALL_April7_2022_sorted.csv',
+    help="Path to .csv file containing the subject IDs and lesioned hemispheres, default='/home/ubuntu/enigma/motor_predictions/Behaviour_Information_ALL_April7_2022_sorted.csv'")
+
+  parser.add_argument("--subid_colname", default='BIDS_ID',
+    help="Name of column in .csv file containing the subject identifiers, default='BIDS_ID'")
+
+  parser.add_argument("--hemisphere_colname", default='LESIONED_HEMISPHERE',
+    help="Name of column in .csv file containing the lesioned hemisphere (1 = left, 2 = right, 3-6 = bilateral/brainstem/cerebellum/combination), used for the ipsilesional S-MATT loads. Subjects without a code use the hemisphere inferred from their lesion mask, default='LESIONED_HEMISPHERE'")
+
+  parser.add_argument("--smatt_dir", default='none',
+    help="Directory of the S-MATT templates (Left-M1-S-MATT.nii ...). If 'none', S-MATT lesion loads are not computed, default='none'")
+
+  parser.add_argument("--slnm_dir", default=EXTRAS_DIR,
+    help="Directory of the LBM and sLNM templates (LBM_map_Bowren.nii.gz, fm_slnm_pc*.nii.gz), default=pipeline/extras")
+
+  parser.add_argument("--output", default='/home/ubuntu/enigma/lesion_loads.csv',
+    help="Output .csv file (one row per subject). Subjects already in this file are only recomputed if their lesion mask or the templates changed, default='/home/ubuntu/enigma/lesion_loads.csv'")
+
+  parser.add_argument("--lesion_cache_path", default='none',
+    help="Directory of the compressed lesion mask cache (one {subject ID}.npz file of voxel indices per mask). Masks are read from the cache if possible and added to it otherwise, default='none'")
+
+  parser.add_argument("--n_workers", type=int, default=8,
+    help="Number of processes used to compute lesion loads, default=8")
+
+  args = parser.parse_args()
+
+  df = load_csv(args.csv_path, [args.subid_colname, args.hemisphere_colname])
+  mask_files, missing = find_lesion_masks(args.lesionmask_path, df[args.subid_colname].astype(str))
+  print('\nThe following subjects are in the .csv file but do not have a lesion mask: {}\n'.format(missing))
+
+  hemispheres = {}
+  if args.hemisphere_colname in df.columns:
+    # codes that are not 1-6 (e.g. 'L', 'left') are reported, those subjects use the hemisphere inferred from their mask
+    codes = pd.to_numeric(df[args.hemisphere_colname], errors='coerce')
+    invalid = []
+    for subject, value, hemisphere in zip(df[args.subid_colname].astype(str), df[args.hemisphere_colname], codes):
+      if pd.notna(hemisphere) and hemisphere in (1, 2, 3, 4, 5, 6):
+        hemispheres[subject] = int(hemisphere)
+      elif pd.notna(value) and not str(value).strip() == '':
+        invalid.append((subject, value))
+    if invalid:
+      print('\nThe following subjects have a lesioned hemisphere that is not 1-6, the hemisphere inferred from their lesion mask is used: {}\n'.format(invalid))
+
+  template_files = get_template_files(args.smatt_dir, args.slnm_dir)
+  failed = compute_lesion_loads_batch(mask_files, template_files, args.output, hemispheres, args.n_workers, args.subid_colname, args.lesion_cache_path)
+  if failed:
+    print('\nLesion loads could not be computed for: {}\n'.format(failed))
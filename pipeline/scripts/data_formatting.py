@@ -3,7 +3,18 @@ import sys; sys.path
 import pandas as pd
 import numpy as np 
 import pickle
+import scipy.sparse as sp
+import json
+import inspect
+from collections import OrderedDict
+import re
+import hashlib
+import shutil
+import zipfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from helper_functions import *
+from lesion_load import find_lesion_masks, compute_parcel_overlap_matrix
 import glob
 from sklearn import preprocessing 
 
@@ -11,9 +22,7 @@ def prepare_data(X):
     '''Clean X-data (remove zero-value input variables)'''
 
     # remove inputs that are 0 for all subjects
-    zeros=X==0
-    zeros=np.sum(zeros,0)
-    zeros=zeros==X.shape[0]
+    zeros=find_zero_columns(X)
     X=X[:,~zeros]    
     return X
 
@@ -22,183 +31,584 @@ def access_elements(nums, list_index):
     result = [nums[i] for i in list_index]
     return result
 
-def find_missing_scans(ids, atlas, chaco_type,nemo_path, nemo_settings):
-    # Get full filenames for NeMo outputs:
-    # NeMo suffix:
-
+# NeMo output file names: {lesion mask name}_{resolution}_nemo_output_{tractography}_{chaco_type}_{atlas}_mean.pkl
+NEMO_OUTPUT_PATTERN = re.compile(r'^(?P<stem>.+)_(?P<resolution>[^_]+)_nemo_output_(?P<tractography>[^_]+)_(?P<chaco_type>chacovol|chacoconn)_(?P<atlas>[^_]+)_mean\.pkl$')
+
+# directory or zip archive -> (mtime, index), see index_nemo_outputs
+_nemo_index_cache = {}
+
+# zip archive -> (mtime, open zipfile.ZipFile), see get_nemo_archive
+_nemo_archive_cache = {}
+
+def get_nemo_archive(archive):
+    # Open (read-only) handle of a zip archive of NeMo outputs, kept open and shared by every read from that archive.
+    # ZipFile reads of different members can run in parallel threads; the archive is reopened if it changes.
+    mtime = os.stat(archive).st_mtime_ns
+    if archive in _nemo_archive_cache and _nemo_archive_cache[archive][0] == mtime:
+        return _nemo_archive_cache[archive][1]
+    _nemo_archive_cache[archive] = (mtime, zipfile.ZipFile(archive, 'r'))
+    return _nemo_archive_cache[archive][1]
+
+def index_nemo_outputs(nemo_path):
+    # Indexes every NeMo output in nemo_path in a single directory scan. Returns a dict keyed by
+    # (resolution, tractography, chaco_type, atlas), each holding a dict of lesion mask name -> full path.
+    # nemo_path can also be a zip archive of NeMo outputs, or several directories/archives separated by commas. Archives are
+    # indexed from their central directory only (nothing is extracted), and their outputs are referenced as
+    # (archive, member name) tuples that read_nemo_output reads straight from the archive.
+    # The index is cached and only rebuilt when the directory's (or archive's) modification time changes (i.e. files were added/removed).
+    if ',' in nemo_path:
+        index = {}
+        for path in nemo_path.split(','):
+            for key, outputs in index_nemo_outputs(path.strip()).items():
+                index.setdefault(key, {}).update(outputs)
+        return index
+
+    mtime = os.stat(nemo_path).st_mtime_ns
+    if nemo_path in _nemo_index_cache and _nemo_index_cache[nemo_path][0] == mtime:
+        return _nemo_index_cache[nemo_path][1]
+
+    if os.path.isfile(nemo_path) and zipfile.is_zipfile(nemo_path):
+        entries = [(os.path.basename(name), (nemo_path, name)) for name in get_nemo_archive(nemo_path).namelist()]
+    else:
+        with os.scandir(nemo_path) as scan:
+            entries = [(entry.name, entry.path) for entry in scan]
+    index = {}
+    for name, path in entries:
+        match = NEMO_OUTPUT_PATTERN.match(name)
+        if match:
+            key = (match.group('resolution'), match.group('tractography'), match.group('chaco_type'), match.group('atlas'))
+            index.setdefault(key, {})[match.group('stem')] = path
+    _nemo_index_cache[nemo_path] = (mtime, index)
+    return index
+
+def get_nemo_mtime(nemo_path):
+    # Modification times of the directories/archives in nemo_path (comma separated), the same times index_nemo_outputs uses
+    # to decide when to rebuild its index. Changes whenever NeMo outputs are added or removed.
+    return [os.stat(path.strip()).st_mtime_ns for path in nemo_path.split(',')]
+
+def read_nemo_output(path):
+    # Unpickles one NeMo output, either a file or an (archive, member name) tuple from index_nemo_outputs.
+    if isinstance(path, tuple):
+        archive, member = path
+        return pickle.loads(get_nemo_archive(archive).read(member))
+    with open(path, 'rb') as e:
+        return pickle.load(e)
+
+def normalize_nemo_target(atlas, chaco_type):
+    # The NeMo outputs an atlas/chaco_type combination reads: chaco_type 'NA' is read as 'chacovol', and lesion-load-only
+    # runs (atlas == 'none' or a lesionload_* atlas) fall back to the fs86subj outputs. Used by every function that names
+    # or looks up NeMo outputs, feature stores or cached data sets, so that they always agree.
     if chaco_type == 'NA':
         chaco_type = 'chacovol'
-    if not (atlas == 'fs86subj' or atlas == 'shen268'): # if atlas == none (this may occur when we're doing just LL, but we still want to load chaco data.)
+    if not (atlas == 'fs86subj' or atlas == 'shen268'):
         atlas = 'fs86subj'
-    print(atlas)
-    print(chaco_type)
-    nemo_suffix = '_{}_nemo_output_{}_{}_{}_mean.pkl'.format(nemo_settings[0], nemo_settings[1],chaco_type,atlas)
-    files = glob.glob(os.path.join(nemo_path, '*_{}_nemo_output_{}_{}_{}_mean.pkl'.format(nemo_settings[0], nemo_settings[1], chaco_type, atlas)))
-
-    # check if there is any content between the ID and the lesionmask filename after removing the NeMo bits.
-    files_stripped = [file.replace(nemo_path, '').replace(nemo_suffix, '') for file in files]
+    return atlas, chaco_type
 
-    i = 0
-    length = len(files_stripped)
-    
-    c=0
-    while i < length:
-        for id in ids:
-            if id in files_stripped[i]:
-                if not id == files_stripped[i]: # if there's not an exact character match
-                    if len(id)>len(files_stripped[i]):
-                        print('Subjects IDs may not be specific enough to find the corresponding NeMo output file. ')
-                    else:
-                        filebits = files_stripped[i].split(id)[1]
-                        if c == 0: # only run once
-                            current_diff = filebits
-                            c=c+1   
-                        else:
-                            if not filebits == current_diff:
-                                print(filebits)
-
-                                print('Multiple different image file names.')
-                                
-                else:
-                    filebits=[]
-                       
-        i += 1
+def get_nemo_outputs(nemo_path, atlas, chaco_type, nemo_settings):
+    # Returns the dict of lesion mask name -> NeMo output path for one atlas/chaco_type/nemo_settings combination.
+    atlas, chaco_type = normalize_nemo_target(atlas, chaco_type)
+    return index_nemo_outputs(nemo_path).get((nemo_settings[0], nemo_settings[1], chaco_type, atlas), {})
 
+def find_missing_scans(ids, atlas, chaco_type,nemo_path, nemo_settings):
+    # Get full filenames for NeMo outputs from the (cached) directory index, and look each subject up in it.
     # returns list of files without missing scans, as well as ids of missing subjects
-    files_in_dir = glob.glob(os.path.join(nemo_path,'*'+ filebits + nemo_suffix))
-    list_of_files_fromIDlist = nemo_path + ids + filebits + nemo_suffix 
-    missing_scans = [x for x in list_of_files_fromIDlist if x not in files_in_dir]
-    ids_fullpaths_nonemissing = [x for x in list_of_files_fromIDlist if x not in missing_scans]
-    endbits_toremove = filebits + nemo_suffix
+    print(atlas)
+    print(chaco_type)
+    outputs = get_nemo_outputs(nemo_path, atlas, chaco_type, nemo_settings)
+    matched, missing_scans = match_subject_ids(ids, list(outputs))
+    ids_fullpaths_nonemissing = [outputs[matched[id]] for id in ids if id in matched]
 
-    missing_scans = [scan.split(endbits_toremove)[0].split(nemo_path)[1] for scan in missing_scans] # get sub ID in table form.
     print('\nThe following subjects are in the .csv file but do not have corresponding ChaCo data: {}\n'.format(missing_scans))
     return ids_fullpaths_nonemissing, missing_scans
 
-def load_chaco_data(ids,chaco_type):
-    # This function takes in a list of IDs and a string containing the type of chaco data (either 'chacovol' or 'chacoconn')
+def load_chaco_data(ids,chaco_type, n_workers=1):
+    # This function takes in a list of NeMo output files and a string containing the type of chaco data (either 'chacovol' or 'chacoconn')
     # and returns a matrix of the chaco data. For 'chacoconn' data, the matrix is the upper triangular portion of the adjacency
     # matrix with the diagonal set to 0. For 'chacovol' data, the matrix is the volume data for each subject.
-    if chaco_type == 'NA':
-        chaco_type = 'chacovol'
-        
-    for i in range(0,len(ids)):
-        
-        with open(ids[i], 'r+b') as e:
-            
-            if chaco_type == 'chacoconn':
-                data = pickle.load(e)
-                data= data.todense()
-                np.fill_diagonal(data, 0)
-                nROIs = data.shape[0]
-                if i==0:
-                    X = data[np.triu_indices(nROIs,k=1)] # take upper triangular
-                    continue
-                X = np.concatenate((X, data[np.triu_indices(nROIs,k=1)]), axis=0)
-                
-            elif chaco_type=='chacovol':
-                data = pickle.load(e)    
-                if i==0:
-                    X = data
-                    continue
-                X = np.concatenate((X, data), axis=0)   
+    # The number of features is taken from the first file so that the (n_subjects, n_features) matrix can be allocated once,
+    # and the remaining files are read by n_workers threads (per-file latency dominates on network filesystems).
+    ids = list(ids)
+    first = read_chaco_file(ids[0], chaco_type)
+    X = np.empty(shape=(len(ids), first.shape[0]), dtype=first.dtype)
+    X[0] = first
+    fill_chaco_rows(X, ids, chaco_type, n_workers, start=1)
     return X
-            
-def remove_missing_yvar(df, yvar_colname):
-
-    idx=np.isnan(df[yvar_colname])
-    df=df[~idx]
-
-    return df 
-
-def remove_missing_scans(df, missinglist,subid_colname):
 
-    for missingscan in missinglist:
-        df = df[df[subid_colname] != missingscan] 
-
-    return df
-
-def remove_missing_demographics(df,covariates):
-    
-    missing_ids = np.zeros(df.shape[0])
+def fill_chaco_rows(X, files, chaco_type, n_workers=1, start=0):
+    # Reads files[start:] into the matching rows of the preallocated matrix X (an array or a memory map).
+    # Each worker writes to its own row, so no locking is needed.
+    def fill_row(i):
+        X[i] = read_chaco_file(files[i], chaco_type)
 
-    for cov in covariates:
-        
-        missing_ids = np.isnan(df[cov]) + missing_ids
-        
-    missing_ids = missing_ids>0
-    df=df[~missing_ids]
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(fill_row, range(start, len(files))))
+    else:
+        for i in range(start, len(files)):
+            fill_row(i)
+    return X
+            
+def read_chaco_file_sparse(path):
+    # Sparse equivalent of read_chaco_file for 'chacoconn' outputs: returns the positions (in np.triu_indices(nROIs, k=1) order)
+    # and values of the nonzero upper-triangular entries, read straight from the scipy sparse matrix without densifying it.
+    data = read_nemo_output(path)
+    nROIs = data.shape[0]
+    upper = sp.triu(data, k=1, format='coo')
+    rows = upper.row.astype(np.int64)
+    cols = upper.col.astype(np.int64)
+    # position of (row, col) in the row-major upper triangle, excluding the diagonal
+    idx = rows*nROIs - rows*(rows+1)//2 + (cols - rows - 1)
+    keep = upper.data != 0
+    order = np.argsort(idx[keep])
+    return idx[keep][order], upper.data[keep][order], nROIs*(nROIs-1)//2
+
+def load_chaco_data_sparse(ids, n_workers=1):
+    # Loads 'chacoconn' NeMo outputs into one cohort-wide CSR matrix (subjects x upper-triangular edges).
+    # Most edges are untouched by a focal lesion, so this needs a fraction of the memory of load_chaco_data.
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            rows = list(executor.map(read_chaco_file_sparse, ids))
+    else:
+        rows = [read_chaco_file_sparse(path) for path in ids]
+
+    n_features = rows[0][2]
+    indptr = np.zeros(len(rows)+1, dtype=np.int64)
+    indptr[1:] = np.cumsum([row[0].shape[0] for row in rows])
+    indices = np.concatenate([row[0] for row in rows])
+    data = np.concatenate([row[1] for row in rows])
+    return sp.csr_matrix((data, indices, indptr), shape=(len(rows), n_features))
+
+def get_nemo_suffix(atlas, chaco_type, nemo_settings):
+    # Returns the suffix that NeMo appends to each lesion mask name, e.g. '_1mm_nemo_output_sdstream_chacovol_fs86subj_mean.pkl'.
+    # atlas and chaco_type are normalized with normalize_nemo_target.
+    atlas, chaco_type = normalize_nemo_target(atlas, chaco_type)
+    return '_{}_nemo_output_{}_{}_{}_mean.pkl'.format(nemo_settings[0], nemo_settings[1], chaco_type, atlas)
+
+def match_subject_ids(ids, stems):
+    # NeMo outputs are named after the lesion mask, which may have extra characters between the subject ID and the NeMo
+    # suffix (e.g. 'sub-01_lesionmask'). This works out those extra characters once from the first output file that starts
+    # with a subject ID, then looks every subject up in a dict instead of comparing every ID against every file.
+    # Returns a dict of subject ID -> stem for subjects that have an output, and the list of subjects that do not.
+    ids = list(ids)
+    stem_set = set(stems)
+    filebits = ''
+    if not stem_set.intersection(ids):
+        for stem in stems:
+            prefixes = [id for id in ids if stem.startswith(id)]
+            if prefixes:
+                filebits = stem[len(max(prefixes, key=len)):]
+                break
+
+    matched = {}
+    missing = []
+    for id in ids:
+        if id + filebits in stem_set:
+            matched[id] = id + filebits
+        else:
+            missing.append(id)
+    return matched, missing
+
+def read_chaco_file(path, chaco_type):
+    # Reads a single NeMo output and returns it as a 1-D feature vector, in the same layout as load_chaco_data
+    # (upper triangle with the diagonal set to 0 for 'chacoconn', regional values for 'chacovol').
+    if chaco_type == 'NA':
+        chaco_type = 'chacovol'
+    data = read_nemo_output(path)
+    if chaco_type == 'chacoconn':
+        data = data.todense()
+        np.fill_diagonal(data, 0)
+        nROIs = data.shape[0]
+        data = data[np.triu_indices(nROIs, k=1)]
+    return np.asarray(data).ravel()
+
+def get_chaco_store_prefix(store_path, atlas, chaco_type, nemo_settings):
+    # One feature store per atlas/chaco_type/nemo_settings combination, e.g. store_path/shen268_chacoconn_1mm_sdstream
+    atlas, chaco_type = normalize_nemo_target(atlas, chaco_type)
+    return os.path.join(store_path, '{}_{}_{}_{}'.format(atlas, chaco_type, nemo_settings[0], nemo_settings[1]))
+
+def build_chaco_store(nemo_path, store_path, atlas, chaco_type, nemo_settings, dtype='float64', n_workers=1):
+    # One-time ingest of all NeMo outputs for one atlas/chaco_type/nemo_settings combination into a single
+    # memory-mapped feature matrix. Three files are written next to each other:
+    #   {prefix}_X.dat     - raw (n_subjects, n_features) matrix, one row per NeMo output
+    #   {prefix}_ids.txt   - subject index: the lesion mask name (NeMo output name without the suffix) of each row
+    #   {prefix}_meta.json - matrix shape and dtype, needed to open the .dat file
+    # create_data_set(store_path=...) then opens the matrix with open_chaco_store instead of reading every pickle.
+    nemo_suffix = get_nemo_suffix(atlas, chaco_type, nemo_settings)
+    outputs = get_nemo_outputs(nemo_path, atlas, chaco_type, nemo_settings)
+    if not outputs:
+        raise RuntimeError('Warning! No NeMo outputs matching *{} found in {}'.format(nemo_suffix, nemo_path))
+    # rows in file name order
+    stems = sorted(outputs, key=lambda stem: stem + nemo_suffix)
+    files = [outputs[stem] for stem in stems]
+
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    prefix = get_chaco_store_prefix(store_path, atlas, chaco_type, nemo_settings)
+
+    # a rebuild never writes over the files of the existing store: its meta is removed first, so it is not opened while it
+    # is replaced, and the new files are written under .tmp names and moved into place once complete, meta last
+    if os.path.exists(prefix + '_meta.json'):
+        os.remove(prefix + '_meta.json')
+    first = read_chaco_file(files[0], chaco_type)
+    X = np.memmap(prefix + '_X.dat.tmp', dtype=dtype, mode='w+', shape=(len(files), first.shape[0]))
+    X[0] = first
+    fill_chaco_rows(X, files, chaco_type, n_workers, start=1)
+    X.flush()
+    del X
+
+    with open(prefix + '_ids.txt.tmp', 'w') as f:
+        f.write('\n'.join(stems) + '\n')
+    with open(prefix + '_meta.json.tmp', 'w') as f:
+        json.dump({'n_subjects': len(files), 'n_features': int(first.shape[0]), 'dtype': dtype}, f)
+    os.replace(prefix + '_X.dat.tmp', prefix + '_X.dat')
+    os.replace(prefix + '_ids.txt.tmp', prefix + '_ids.txt')
+    os.replace(prefix + '_meta.json.tmp', prefix + '_meta.json')
+
+    print('Wrote {} subjects x {} features to {}_X.dat'.format(len(files), first.shape[0], prefix))
+    return prefix
+
+def update_chaco_store(nemo_path, store_path, atlas, chaco_type, nemo_settings, n_workers=1, dtype='float64'):
+    # Appends the NeMo outputs in nemo_path that are not in the feature store yet (new subjects) to the store: their rows are
+    # added to the end of {prefix}_X.dat and their names to {prefix}_ids.txt, and the meta file is replaced last, so readers
+    # (open_chaco_store) only ever see complete rows. Rows left behind by an interrupted update are dropped first.
+    # Outputs that cannot be read yet (e.g. still being copied) are skipped and picked up by the next update.
+    # Builds the store (with the given dtype) if it does not exist. Returns the number of subjects added.
+    prefix = get_chaco_store_prefix(store_path, atlas, chaco_type, nemo_settings)
+    outputs = get_nemo_outputs(nemo_path, atlas, chaco_type, nemo_settings)
+    if not os.path.exists(prefix + '_meta.json'):
+        if not outputs:
+            return 0
+        build_chaco_store(nemo_path, store_path, atlas, chaco_type, nemo_settings, dtype, n_workers)
+        return len(outputs)
+
+    with open(prefix + '_meta.json', 'r') as f:
+        meta = json.load(f)
+    with open(prefix + '_ids.txt', 'r') as f:
+        stems = f.read().split()[:meta['n_subjects']]
+    known = set(stems)
+    nemo_suffix = get_nemo_suffix(atlas, chaco_type, nemo_settings)
+    new = sorted([stem for stem in outputs if stem not in known], key=lambda stem: stem + nemo_suffix)
+    if not new:
+        return 0
+
+    def read_row(stem):
+        try:
+            return read_chaco_file(outputs[stem], chaco_type)
+        except Exception as e:
+            print('Skipping {} for now, could not read it: {}'.format(stem, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        rows = list(executor.map(read_row, new))
+    added = [stem for stem, row in zip(new, rows) if row is not None]
+    if not added:
+        return 0
+    X_new = np.empty((len(added), meta['n_features']), dtype=meta['dtype'])
+    for i, row in enumerate([row for row in rows if row is not None]):
+        X_new[i] = row
+
+    row_bytes = meta['n_features']*np.dtype(meta['dtype']).itemsize
+    with open(prefix + '_X.dat', 'r+b') as f:
+        f.truncate(meta['n_subjects']*row_bytes)
+        f.seek(0, os.SEEK_END)
+        f.write(X_new.tobytes())
+    # ids are replaced atomically too: readers keep the first n_subjects names of whichever version they open
+    with open(prefix + '_ids.txt.tmp', 'w') as f:
+        f.write('\n'.join(stems + added) + '\n')
+    os.replace(prefix + '_ids.txt.tmp', prefix + '_ids.txt')
+    meta['n_subjects'] += len(added)
+    with open(prefix + '_meta.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(prefix + '_meta.json.tmp', prefix + '_meta.json')
+
+    print('Added {} subjects to {}_X.dat ({} subjects)'.format(len(added), prefix, meta['n_subjects']))
+    return len(added)
+
+def watch_chaco_stores(nemo_path, store_path, atlases, chaco_types, nemo_settings, interval=60, n_workers=1, max_polls=None, dtype='float64'):
+    # Watch mode for continuously arriving NeMo outputs: every interval seconds, appends the new outputs in nemo_path to the
+    # feature store of every atlas/chaco_type combination (see update_chaco_store). The stores are only updated when the
+    # modification time of nemo_path changed since the last update (or outputs could not be read yet), so between arrivals
+    # a poll only costs one stat of nemo_path. Runs until interrupted, or for max_polls polls.
+    polls = 0
+    last_mtime = None
+    while max_polls is None or polls < max_polls:
+        mtime = get_nemo_mtime(nemo_path)
+        if not mtime == last_mtime:
+            complete = True
+            for atlas in atlases:
+                for chaco_type in chaco_types:
+                    update_chaco_store(nemo_path, store_path, atlas, chaco_type, nemo_settings, n_workers, dtype)
+                    complete = is_chaco_store_complete(nemo_path, store_path, atlas, chaco_type, nemo_settings) and complete
+            # outputs skipped by update_chaco_store (e.g. still being copied) are retried at the next poll, even if the
+            # directory did not change since
+            last_mtime = mtime if complete else None
+        polls += 1
+        if max_polls is None or polls < max_polls:
+            time.sleep(interval)
+
+def is_chaco_store_complete(nemo_path, store_path, atlas, chaco_type, nemo_settings):
+    # True if every NeMo output in nemo_path for this combination is in the feature store.
+    outputs = get_nemo_outputs(nemo_path, atlas, chaco_type, nemo_settings)
+    if not outputs:
+        return True
+    prefix = get_chaco_store_prefix(store_path, atlas, chaco_type, nemo_settings)
+    if not os.path.exists(prefix + '_meta.json'):
+        return False
+    with open(prefix + '_meta.json', 'r') as f:
+        meta = json.load(f)
+    with open(prefix + '_ids.txt', 'r') as f:
+        stems = set(f.read().split()[:meta['n_subjects']])
+    return all(stem in stems for stem in outputs)
+
+def get_chaco_store_mtime(store_path, atlas, chaco_type, nemo_settings):
+    # Modification time of a feature store's meta file (changes whenever subjects are added), None if there is no store.
+    if not store_path or store_path == 'none':
+        return None
+    prefix = get_chaco_store_prefix(store_path, atlas, chaco_type, nemo_settings)
+    if not os.path.exists(prefix + '_meta.json'):
+        return None
+    return os.stat(prefix + '_meta.json').st_mtime_ns
+
+def open_chaco_store(store_path, atlas, chaco_type, nemo_settings):
+    # Opens a feature store written by build_chaco_store read-only (nothing is read from disk until rows are accessed).
+    # Returns the memory-mapped matrix and the list of lesion mask names, one per row.
+    prefix = get_chaco_store_prefix(store_path, atlas, chaco_type, nemo_settings)
+    if not os.path.exists(prefix + '_meta.json'):
+        raise RuntimeError('Warning! No ChaCo feature store found at {}. Run build_chaco_store.py first.'.format(prefix))
+    with open(prefix + '_meta.json', 'r') as f:
+        meta = json.load(f)
+    with open(prefix + '_ids.txt', 'r') as f:
+        stems = f.read().split()[:meta['n_subjects']]
+    X = np.memmap(prefix + '_X.dat', dtype=meta['dtype'], mode='r', shape=(meta['n_subjects'], meta['n_features']))
+    return X, stems
+
+def load_chaco_store(ids, store_path, atlas, chaco_type, nemo_settings):
+    # Store equivalent of find_missing_scans + load_chaco_data: returns the rows of the feature store for the subjects in ids
+    # (in the order of ids), and the list of subjects without ChaCo data. If the subjects are a contiguous block of the store,
+    # the returned matrix is a view of the memory map and no data is copied.
+    X_store, stems = open_chaco_store(store_path, atlas, chaco_type, nemo_settings)
+    matched, missing_scans = match_subject_ids(ids, stems)
+    print('\nThe following subjects are in the .csv file but do not have corresponding ChaCo data: {}\n'.format(missing_scans))
 
+    row_lookup = {stem: i for i, stem in enumerate(stems)}
+    rows = np.array([row_lookup[matched[id]] for id in ids if id in matched], dtype=int)
+    if rows.size > 0 and np.all(np.diff(rows) == 1):
+        X = X_store[rows[0]:rows[-1] + 1]
+    else:
+        X = X_store[rows]
+    return X, missing_scans
+
+def build_chaco_memmap(ids, atlas, chaco_type, nemo_path, nemo_settings, out_of_core_path, store_path=None, chunk_size=256, n_workers=1):
+    # Out-of-core equivalent of load_chaco_features for cohorts whose feature matrix does not fit in memory: the ChaCo scores
+    # of the subjects in ids (in the order of ids) are streamed chunk_size subjects at a time into an on-disk float32 matrix,
+    # so only one chunk is ever held in memory. The files use the feature store layout (see build_chaco_store) with a
+    # cohort-specific prefix, {out_of_core_path}/{atlas}_{chaco_type}_{settings}_{hash of ids}, and an existing matrix for
+    # the same subjects is reused as long as its source has not changed since it was written (the modification time of the
+    # feature store, or of nemo_path, is kept in the meta file). Rows are read from the feature store in store_path if given,
+    # otherwise from nemo_path.
+    # Returns the read-only memory-mapped matrix and the list of subjects without ChaCo data.
+    ids = [str(id) for id in ids]
+    if store_path and not store_path == 'none':
+        X_store, stems = open_chaco_store(store_path, atlas, chaco_type, nemo_settings)
+        matched, missing_scans = match_subject_ids(ids, stems)
+        row_lookup = {stem: i for i, stem in enumerate(stems)}
+        sources = [row_lookup[matched[id]] for id in ids if id in matched]
+        print('\nThe following subjects are in the .csv file but do not have corresponding ChaCo data: {}\n'.format(missing_scans))
+    else:
+        sources, missing_scans = find_missing_scans(ids, atlas, chaco_type, nemo_path, nemo_settings)
+    if store_path and not store_path == 'none':
+        source_mtime = get_chaco_store_mtime(store_path, atlas, chaco_type, nemo_settings)
+    else:
+        source_mtime = get_nemo_mtime(nemo_path)
+    missing_set = set(missing_scans)
+    ids = [id for id in ids if id not in missing_set]
+
+    cohort_hash = hashlib.sha1('\n'.join(ids).encode()).hexdigest()[:12]
+    prefix = get_chaco_store_prefix(out_of_core_path, atlas, chaco_type, nemo_settings) + '_' + cohort_hash
+    if os.path.exists(prefix + '_meta.json'):
+        with open(prefix + '_meta.json', 'r') as f:
+            meta = json.load(f)
+        if meta.get('source_mtime') == source_mtime:
+            return np.memmap(prefix + '_X.dat', dtype=meta['dtype'], mode='r', shape=(meta['n_subjects'], meta['n_features'])), missing_scans
+        # the source changed (e.g. NeMo outputs were rerun): the matrix is rewritten
+        os.remove(prefix + '_meta.json')
+
+    if not os.path.exists(out_of_core_path):
+        os.makedirs(out_of_core_path)
+    n_subjects = len(sources)
+    if store_path and not store_path == 'none':
+        n_features = X_store.shape[1]
+    else:
+        n_features = read_chaco_file(sources[0], chaco_type).shape[0]
+
+    X = np.memmap(prefix + '_X.dat', dtype='float32', mode='w+', shape=(n_subjects, n_features))
+    for start in range(0, n_subjects, chunk_size):
+        chunk = sources[start:start + chunk_size]
+        if store_path and not store_path == 'none':
+            X[start:start + len(chunk)] = X_store[chunk]
+        else:
+            X_chunk = np.empty((len(chunk), n_features))
+            fill_chaco_rows(X_chunk, chunk, chaco_type, n_workers)
+            X[start:start + len(chunk)] = X_chunk
+        X.flush()
+        print('Wrote subjects {}-{}/{} to {}_X.dat'.format(start + 1, start + len(chunk), n_subjects, prefix))
+    del X
+
+    with open(prefix + '_ids.txt', 'w') as f:
+        f.write('\n'.join(ids) + '\n')
+    # meta is written last so that a half-written matrix is never opened
+    with open(prefix + '_meta.json', 'w') as f:
+        json.dump({'n_subjects': n_subjects, 'n_features': int(n_features), 'dtype': 'float32', 'source_mtime': source_mtime}, f)
+    return np.memmap(prefix + '_X.dat', dtype='float32', mode='r', shape=(n_subjects, n_features)), missing_scans
+
+def load_csv(csv_path, columns=None, cache_dir=None):
+    # Loads the .csv file. If columns is given, only those columns are loaded (columns not in the .csv are skipped).
+    # If cache_dir is given, the table is read from a binary per-column cache (see build_csv_cache) instead of being parsed.
+    if cache_dir and not cache_dir == 'none':
+        return load_csv_cache(csv_path, columns, cache_dir)
+    if columns is None:
+        df = pd.read_csv(csv_path, header =0)
+    else:
+        columns = set(columns)
+        df = pd.read_csv(csv_path, header =0, usecols=lambda c: c in columns)
     return df
 
-def load_csv(csv_path):
+def get_csv_columns(csv_path, cache_dir=None):
+    # Column names of the .csv file (the header only, no data is parsed).
+    if cache_dir and not cache_dir == 'none':
+        return [c['name'] for c in build_csv_cache(csv_path, cache_dir)['columns']]
+    return list(pd.read_csv(csv_path, header =0, nrows=0).columns)
+
+
+# In-process cache of .csv file hashes, keyed by path and invalidated by modification time and size
+_csv_hash_cache = {}
+
+def hash_csv_file(csv_path):
+    # sha1 of the file contents. Only recomputed when the file's modification time or size changes.
+    st = os.stat(csv_path)
+    key = os.path.abspath(csv_path)
+    cached = _csv_hash_cache.get(key)
+    if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    h = hashlib.sha1()
+    with open(csv_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    _csv_hash_cache[key] = ((st.st_mtime_ns, st.st_size), h.hexdigest())
+    return h.hexdigest()
+
+def get_csv_cache_dir(csv_path, cache_dir):
+    # Cache directory of one version of the .csv file: {cache_dir}/{csv name}_{content hash}
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, '{}_{}'.format(name, hash_csv_file(csv_path)[:16]))
+
+def build_csv_cache(csv_path, cache_dir):
+    # Parses the .csv file once and writes every column to its own .npy file, with the column names and dtypes in meta.json.
+    # Numeric columns keep the dtype pandas infers (int64, float64, bool), everything else is stored as str (object).
+    # The cache is keyed by the file contents, so an edited .csv gets a new cache. Returns the meta data.
+    path = get_csv_cache_dir(csv_path, cache_dir)
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            return json.load(f)
+
+    print('Building .csv cache ' + path)
     df = pd.read_csv(csv_path, header =0)
-    return df
-
-def get_chronicity_subset(df, subset, subid_colname, chronicity_colname):
-    # The get_chronicity_subset function filters a DataFrame df to only include data for a certain subset of stroke subjects, 
-    # as specified by the subset parameter. The subset parameter can be either 'chronic' or 'acute', 
-    # to indicate whether to include only chronic or acute stroke subjects, respectively. If the subset
-    # parameter is set to any other value, the function will return the original DataFrame without filtering.
-
-    # It then uses an if statement to check the value of subset and filter the DataFrame accordingly. 
-    # If subset is 'chronic', the function filters the DataFrame to only include rows where the 'CHRONICITY'
-    # column has a value of 180. If subset is 'acute', the function filters the DataFrame to only include rows
-    # where the 'CHRONICITY' column has a value of 90. In either case, the function then resets the DataFrame's
-    # index and saves the filtered DataFrame to the df_final variable.
-
-    # Finally, the function returns the list of subject IDs in the filtered DataFrame, which are stored in the 'BIDS_ID' column.
-
-    if subset == 'chronic':
-        print('\nSelecting chronic subjects only.\n')
-
-        df_chronic = df[df[chronicity_colname]==180]
-        df_chronic = df_chronic.reset_index(drop=True)
-        df_final = df_chronic
-        ids = df_chronic[subid_colname]  
-    elif subset == 'acute':
-        print('\nSelecting acute subjects only. \n')
-        df_acute = df[df[chronicity_colname]==90]
-        df_acute = df_acute.reset_index(drop=True)
-        df_final = df_acute
-        ids = df_acute[subid_colname]
-        
-    elif subset == 'acutechronic': # if acute+chronic, load chronic data here. 
-        print('\nSelecting chronic subjects only.\n')
-
-        df_chronic = df[df[chronicity_colname]==180]
-        df_chronic = df_chronic.reset_index(drop=True)
-        df_final = df_chronic
-        ids = df_chronic[subid_colname] 
-    else:
-        print('\nSelecting all subjects\n')
-        ids = df[subid_colname]
-        df_final = df
-
-    return df_final, ids
-
-def load_lesion_vol(df_final):
-    lesionvolpath = '/home/ubuntu/enigma/lesionvol'
-    lesionvol=np.zeros(shape=(df_final.shape[0],1))
-    i=0
-    for subject in df_final['BIDS_ID']:
-        lesionvol[i]=(np.loadtxt(os.path.join(lesionvolpath, subject + '.txt'))[0])
-        i=i+1
-    df_final['lesionvol']=lesionvol
-    
+    tmp_path = path + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    columns = []
+    for i, name in enumerate(df.columns):
+        col = df[name]
+        if pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype):
+            values = col.to_numpy()
+        else:
+            values = col.to_numpy(dtype=object)
+        np.save(os.path.join(tmp_path, '{}.npy'.format(i)), values, allow_pickle=values.dtype == object)
+        columns.append({'name': str(name), 'file': '{}.npy'.format(i), 'dtype': str(values.dtype)})
+    meta = {'csv_path': os.path.abspath(csv_path), 'sha1': hash_csv_file(csv_path), 'n_rows': int(df.shape[0]), 'columns': columns}
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process wrote the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return meta
+
+def load_csv_cache(csv_path, columns, cache_dir):
+    # Loads the requested columns (all columns if columns is None) of the .csv file from its binary cache, building it if needed.
+    meta = build_csv_cache(csv_path, cache_dir)
+    path = get_csv_cache_dir(csv_path, cache_dir)
+    if columns is not None:
+        columns = set(columns)
+    data = OrderedDict()
+    for c in meta['columns']:
+        if columns is None or c['name'] in columns:
+            values = np.load(os.path.join(path, c['file']), allow_pickle=c['dtype'] == 'object')
+            data[c['name']] = values.astype(c['dtype'], copy=False)
+    return pd.DataFrame(data, index=pd.RangeIndex(meta['n_rows']))
+
+# lesionvol_path -> (directory mtime, lesion volumes), see load_lesion_volumes
+_lesion_vol_cache = {}
+
+def read_lesion_vol_file(path):
+    # first value of the lesion volume text file (same as np.loadtxt(path)[0]), or, for a lesion cache entry
+    # ({subject ID}.npz, see lesion_load.load_lesion_voxels), the number of lesioned voxels times the voxel volume
+    if path.endswith('.npz'):
+        with np.load(path) as cache:
+            return float(cache['n_voxels']*cache['voxel_volume'])
+    with open(path, 'r') as f:
+        return float(f.read().split()[0])
+
+def load_lesion_volumes(lesionvol_path, n_workers=8):
+    # Reads every {subject ID}.txt lesion volume file (or {subject ID}.npz lesion cache entry) in lesionvol_path once,
+    # using n_workers threads, and returns the volumes as a pandas Series indexed by subject ID.
+    # lesionvol_path can also be a lesion-load table written by compute_lesion_loads.py (.csv, subject IDs in the first
+    # column), whose 'lesionvol' column is used. If a subject has both a .txt file and a .npz cache entry, the .txt file
+    # (the measured lesion volume) is used.
+    # The result is cached until the directory's (or table's) modification time changes.
+    mtime = os.stat(lesionvol_path).st_mtime_ns
+    if lesionvol_path in _lesion_vol_cache and _lesion_vol_cache[lesionvol_path][0] == mtime:
+        return _lesion_vol_cache[lesionvol_path][1]
+
+    if os.path.isfile(lesionvol_path):
+        table = pd.read_csv(lesionvol_path, dtype=str)
+        lesionvol = pd.Series(table['lesionvol'].astype('float64').values, index=table.iloc[:, 0].values, name='lesionvol')
+        _lesion_vol_cache[lesionvol_path] = (mtime, lesionvol)
+        return lesionvol
+
+    with os.scandir(lesionvol_path) as entries:
+        files = [entry.path for entry in entries if entry.name.endswith('.txt') or entry.name.endswith('.npz')]
+    # one file per subject, .txt before .npz
+    subject_files = {}
+    for file in sorted(files, key=lambda file: file.endswith('.txt')):
+        subject_files[os.path.splitext(os.path.basename(file))[0]] = file
+    subjects = sorted(subject_files)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        volumes = list(executor.map(read_lesion_vol_file, [subject_files[subject] for subject in subjects]))
+    lesionvol = pd.Series(volumes, index=subjects, name='lesionvol', dtype='float64')
+
+    _lesion_vol_cache[lesionvol_path] = (mtime, lesionvol)
     return lesionvol
-        
 
-def create_data_set(csv_path=None, site_colname = None, nemo_path=None,yvar_colname = None, subid_colname=None,chronicity_colname=None,atlas=None, covariates=None, verbose=False, y_var=None,chaco_type=None, subset=None, remove_demog =None, nemo_settings=None, ll=None,return_motor=False):
+def load_cohort(csv_path, covariates, ll, subid_colname=None, lesionvol_path=None, yvar_colname=None, chronicity_colname=None, site_colname=None, csv_cache_dir=None):
+    # Loads the .csv file and checks the requested covariates and lesion load type.
+    # Only the columns a run needs are loaded (subject ID, outcome, chronicity, site, covariates and lesion loads), from the
+    # binary .csv cache if csv_cache_dir is given (see load_csv).
+    # If lesionvol_path is given, lesion volumes (see load_lesion_volumes) are added as a 'lesionvol' column that can be used as a covariate.
+    # Returns all subjects in the .csv file and the list of covariate column names. Subjects are excluded later by filter_cohort.
     print('\n\nLoading .csv...')
     print(csv_path)
-    df = load_csv(csv_path)
-    print('\nSize of dataset before removing subjects without outcome scores: {} subjects'.format(df.shape[0]))
-
-    df = remove_missing_yvar(df, yvar_colname)
-    print('Size of dataset after removing subjects without outcome scores: {} subjects\n'.format(df.shape[0]))
-
-    all_cov_labels = df.columns.values # Age, sex, days post stroke, chronicity, lesioned hem 
+    if isinstance(covariates, str):
+        covariates = [covariates]
+    columns = [subid_colname, yvar_colname, chronicity_colname, site_colname] + LESION_LOAD_COLUMNS.get(ll, [])
+    if isinstance(covariates, list):
+        columns = columns + covariates
+    df = load_csv(csv_path, columns, csv_cache_dir)
+    all_cov_labels = get_csv_columns(csv_path, csv_cache_dir) # Age, sex, days post stroke, chronicity, lesioned hem 
+    if lesionvol_path and not lesionvol_path == 'none':
+        df['lesionvol'] = df[subid_colname].map(load_lesion_volumes(lesionvol_path)).values
+        all_cov_labels = all_cov_labels + ['lesionvol']
     
     if covariates:
         if isinstance(covariates, str):
@@ -220,30 +630,99 @@ def create_data_set(csv_path=None, site_colname = None, nemo_path=None,yvar_coln
         if not set([ll]).issubset(set(all_ll_options)):
             raise RuntimeError('Warning! Unknown lesion load option specified: {} \n'
                                'Only the following options are allowed: {} \n'.format(ll, all_ll_options))
-    
-    print('\nSize of dataset before removing subjects without non-lesion covariates {}: {} subjects'.format(covariates_list,df.shape[0]))
-    df = remove_missing_demographics(df,covariates_list)   
-    print('Size of dataset after removing subjects without non-lesion covariates: {} subjects'.format(df.shape[0]))
 
-    # this was for me specifically, just make sure your sex variable is a logical.
+    return df, covariates_list
+
+def find_available_scans(ids, atlas, chaco_type, nemo_path, nemo_settings, store_path=None, lesionmask_path=None):
+    # Boolean mask of the subjects in ids that have ChaCo data (in the feature store if store_path is given, otherwise in nemo_path).
+    # Only looks the subjects up in the (cached) index, nothing is loaded.
+    # For chaco_type 'lesionoverlap', the subjects that have a lesion mask in lesionmask_path.
+    if chaco_type == 'lesionoverlap':
+        mask_files, missing = find_lesion_masks(lesionmask_path, ids)
+        return np.array([id in mask_files for id in ids], dtype=bool)
+    if store_path and not store_path == 'none':
+        X_store, stems = open_chaco_store(store_path, atlas, chaco_type, nemo_settings)
+    else:
+        stems = list(get_nemo_outputs(nemo_path, atlas, chaco_type, nemo_settings))
+    matched, missing = match_subject_ids(ids, stems)
+    return np.array([id in matched for id in ids], dtype=bool)
+
+def filter_cohort(df, yvar_colname, covariates_list, chronicity_colname, subset, has_scan=None):
+    # Applies all exclusion rules at once: every rule is evaluated on the whole table, the rules are combined into one
+    # boolean mask and the table is filtered a single time. Rules, in the order subjects are attributed to them:
+    #   missing outcome    - no outcome score (yvar_colname)
+    #   missing covariates - any of the covariates missing
+    #   SEX > 2            - only if SEX is a covariate (SEX is then recoded to 0/1, just make sure your sex variable is a logical)
+    #   chronicity         - not in the chronic (180) / acute (90) subset, if a subset is requested
+    #   missing scans      - no ChaCo data (has_scan, see find_available_scans)
+    # Returns the remaining subjects and a report of how many subjects each rule excluded.
+    # Row labels are reset after chronicity subsetting, before removing missing scans.
+    rules = OrderedDict()
+    rules['missing outcome'] = df[yvar_colname].isna().values
+    rules['missing covariates'] = df[covariates_list].isna().any(axis=1).values
     if 'SEX' in covariates_list:
-        sex = df['SEX']
-        df['SEX'] = sex -1
-        df = df[df['SEX'] <= 1]
-        
-
-    ids=df[subid_colname]
-    print('\nSize of dataset before subsetting for chronic/acute: {} subjects'.format(df.shape[0]))
-    df_final, ids = get_chronicity_subset(df, subset, subid_colname, chronicity_colname)
-    print('Size of dataset after subsetting for chronic/acute: {} subjects'.format(df_final.shape[0]))
-
-    # find subjects who have motor scores but are missing scans.
-    ids_fullpaths_nonemissing, missinglist = find_missing_scans(ids, atlas, chaco_type,nemo_path, nemo_settings)
-    df_final = remove_missing_scans(df_final,missinglist,subid_colname)  
+        rules['SEX > 2'] = (df['SEX'].values - 1) > 1
+    chronicity_values = {'chronic': 180, 'acute': 90, 'acutechronic': 180}
+    if subset in chronicity_values:
+        rules['chronicity'] = df[chronicity_colname].values != chronicity_values[subset]
+
+    report = OrderedDict()
+    report['subjects in .csv'] = df.shape[0]
+    excluded = np.zeros(df.shape[0], dtype=bool)
+    for rule, mask in rules.items():
+        report[rule] = int(np.sum(mask & ~excluded))
+        excluded = excluded | mask
+    before_scans = ~excluded
+    if has_scan is not None:
+        report['missing scans'] = int(np.sum(~has_scan & ~excluded))
+        excluded = excluded | ~has_scan
+    report['included'] = int(np.sum(~excluded))
+
+    df_final = df[~excluded].copy()
+    if 'SEX' in covariates_list:
+        df_final['SEX'] = df_final['SEX'] - 1
+    if subset in chronicity_values:
+        df_final.index = (np.cumsum(before_scans) - 1)[~excluded]
+    return df_final, report
+
+def print_exclusion_report(report, subset):
+    print('\nSubjects excluded ({} subset):'.format(subset))
+    for rule, count in report.items():
+        print('  {}: {}'.format(rule, count))
+
+def load_chaco_features(ids, atlas, chaco_type, nemo_path, nemo_settings, store_path=None, n_workers=1, sparse=False, out_of_core_path=None, lesionmask_path=None, atlas_dir=None, lesion_cache_path=None):
+    # Loads the ChaCo scores of the subjects in ids (one row per subject that has NeMo outputs, in the order of ids).
+    # Returns the feature matrix and the list of subjects without ChaCo data.
+    if chaco_type == 'lesionoverlap':
+        # fraction of each atlas parcel covered by the lesion, computed from the lesion masks instead of NeMo outputs
+        mask_files, missinglist = find_lesion_masks(lesionmask_path, ids)
+        X = compute_parcel_overlap_matrix(list(mask_files.values()), atlas, atlas_dir, lesion_cache_path, n_workers)
+    elif out_of_core_path and not out_of_core_path == 'none':
+        # stream the scores into an on-disk float32 matrix instead of loading them into memory (see build_chaco_memmap)
+        X, missinglist = build_chaco_memmap(ids, atlas, chaco_type, nemo_path, nemo_settings, out_of_core_path, store_path, n_workers=n_workers)
+    elif store_path and not store_path == 'none':
+        # read from the memory-mapped feature store (see build_chaco_store.py) instead of the individual NeMo pickles
+        X, missinglist = load_chaco_store(ids, store_path, atlas, chaco_type, nemo_settings)
+    else:
+        ids_fullpaths_nonemissing, missinglist = find_missing_scans(ids, atlas, chaco_type,nemo_path, nemo_settings)
     
-    X = load_chaco_data(ids_fullpaths_nonemissing, chaco_type)
-    X = np.array(X)
-
+        if sparse and chaco_type == 'chacoconn':
+            # keep pairwise scores as a scipy CSR matrix through prepare_data, SelectKBest and the linear models
+            X = load_chaco_data_sparse(ids_fullpaths_nonemissing, n_workers)
+        else:
+            X = load_chaco_data(ids_fullpaths_nonemissing, chaco_type, n_workers)
+            X = np.asarray(X)
+    return X, missinglist
+
+# .csv columns holding the lesion loads of each ll option
+LESION_LOAD_COLUMNS = {'M1': ['M1_CST'],
+                       'all': ['M1_CST', 'PMd_CST', 'PMv_CST','S1_CST','SMA_CST','preSMA_CST'],
+                       'all_2h': ['L_M1_CST', 'L_PMd_CST', 'L_PMv_CST','L_S1_CST','L_SMA_CST','L_preSMA_CST','R_M1_CST', 'R_PMd_CST', 'R_PMv_CST','R_S1_CST','R_SMA_CST','R_preSMA_CST'],
+                       'slnm': ['PC1', 'PC2_1', 'PC2_2','PC3_1','PC3_2'],
+                       'none': []}
+
+def get_data_set_outputs(df_final, yvar_colname, subid_colname, covariates_list, ll):
+    # Pulls the covariates, outcome scores, lesion loads and subject IDs out of the final table of subjects.
     C = df_final.loc[:,covariates_list].values
     
         
@@ -252,22 +731,162 @@ def create_data_set(csv_path=None, site_colname = None, nemo_path=None,yvar_coln
        # y = np.reshape(y, (len(y),1))
     
     
-    llvars = ['M1_CST', 'PMd_CST', 'PMv_CST','S1_CST','SMA_CST','preSMA_CST']
-    ll_2h_vars =['L_M1_CST', 'L_PMd_CST', 'L_PMv_CST','L_S1_CST','L_SMA_CST','L_preSMA_CST','R_M1_CST', 'R_PMd_CST', 'R_PMv_CST','R_S1_CST','R_SMA_CST','R_preSMA_CST']
-    slnm_vars = ['PC1', 'PC2_1', 'PC2_2','PC3_1','PC3_2']
     if ll=='all':
-        lesion_load = df_final.loc[:,llvars]
+        lesion_load = df_final.loc[:,LESION_LOAD_COLUMNS['all']]
     elif ll=='M1':
         lesion_load=df_final.loc[:,'M1_CST']
     elif ll=='all_2h':
-        lesion_load=df_final.loc[:,ll_2h_vars]
+        lesion_load=df_final.loc[:,LESION_LOAD_COLUMNS['all_2h']]
     elif ll=='slnm':
-        lesion_load = df_final.loc[:,slnm_vars]
+        lesion_load = df_final.loc[:,LESION_LOAD_COLUMNS['slnm']]
     elif ll=='none':
         lesion_load=[]
         
     subIDs = df_final[subid_colname]
-    
+    return y, C, lesion_load, subIDs
+
+def create_data_set(csv_path=None, site_colname = None, nemo_path=None,yvar_colname = None, subid_colname=None,chronicity_colname=None,atlas=None, covariates=None, verbose=False, y_var=None,chaco_type=None, subset=None, remove_demog =None, nemo_settings=None, ll=None,return_motor=False, store_path=None, n_workers=1, sparse=False, lesionvol_path=None, csv_cache_dir=None, out_of_core_path=None, lesionmask_path=None, atlas_dir=None, lesion_cache_path=None):
+    df, covariates_list = load_cohort(csv_path, covariates, ll, subid_colname, lesionvol_path, yvar_colname, chronicity_colname, site_colname, csv_cache_dir)
+
+    # find subjects who have motor scores but are missing scans, and remove every excluded subject in one step.
+    has_scan = find_available_scans(df[subid_colname], atlas, chaco_type, nemo_path, nemo_settings, store_path, lesionmask_path)
+    df_final, report = filter_cohort(df, yvar_colname, covariates_list, chronicity_colname, subset, has_scan)
+    print_exclusion_report(report, subset)
+
+    X, missinglist = load_chaco_features(df_final[subid_colname], atlas, chaco_type, nemo_path, nemo_settings, store_path, n_workers, sparse, out_of_core_path, lesionmask_path, atlas_dir, lesion_cache_path)
+
+    y, C, lesion_load, subIDs = get_data_set_outputs(df_final, yvar_colname, subid_colname, covariates_list, ll)
 
     return X, y, C, lesion_load, subIDs
 
+def create_acutechronic_data_set(csv_path=None, site_colname = None, nemo_path=None,yvar_colname = None, subid_colname=None,chronicity_colname=None,atlas=None, covariates=None, verbose=False, y_var=None,chaco_type=None, subset='acutechronic', remove_demog =None, nemo_settings=None, ll=None,return_motor=False, store_path=None, n_workers=1, sparse=False, lesionvol_path=None, csv_cache_dir=None, out_of_core_path=None, lesionmask_path=None, atlas_dir=None, lesion_cache_path=None):
+    # Loader for subset == 'acutechronic'. Equivalent to calling create_data_set once with 'acutechronic' (chronic subjects,
+    # used for training and testing) and once with 'acute' (acute subjects, only added to the training data), but the .csv
+    # is parsed and the NeMo outputs are looked up and read only once. The chronic subjects are loaded first, so both
+    # feature matrices are slices (views, for dense data) of one shared matrix.
+    # Returns the chronic (X, y, C, lesion_load, subIDs) and the acute (X, y, C, lesion_load, subIDs).
+    df, covariates_list = load_cohort(csv_path, covariates, ll, subid_colname, lesionvol_path, yvar_colname, chronicity_colname, site_colname, csv_cache_dir)
+
+    has_scan = find_available_scans(df[subid_colname], atlas, chaco_type, nemo_path, nemo_settings, store_path, lesionmask_path)
+    df_chronic, report = filter_cohort(df, yvar_colname, covariates_list, chronicity_colname, 'chronic', has_scan)
+    print_exclusion_report(report, 'chronic')
+    df_acute, report = filter_cohort(df, yvar_colname, covariates_list, chronicity_colname, 'acute', has_scan)
+    print_exclusion_report(report, 'acute')
+
+    ids = pd.concat((df_chronic[subid_colname], df_acute[subid_colname]), ignore_index=True)
+    X_all, missinglist = load_chaco_features(ids, atlas, chaco_type, nemo_path, nemo_settings, store_path, n_workers, sparse, out_of_core_path, lesionmask_path, atlas_dir, lesion_cache_path)
+
+    n_chronic = df_chronic.shape[0]
+    y, C, lesion_load, subIDs = get_data_set_outputs(df_chronic, yvar_colname, subid_colname, covariates_list, ll)
+    acute_y, acute_C, acute_lesion_load, acute_subIDs = get_data_set_outputs(df_acute, yvar_colname, subid_colname, covariates_list, ll)
+
+    return (X_all[:n_chronic], y, C, lesion_load, subIDs), (X_all[n_chronic:], acute_y, acute_C, acute_lesion_load, acute_subIDs)
+
+def create_data_set_bundle(csv_path=None, site_colname = None, nemo_path=None,yvar_colname = None, subid_colname=None,chronicity_colname=None,atlases=None, covariates=None, chaco_types=None, subset=None, nemo_settings_list=None, ll='none', store_path=None, n_workers=1, sparse=False, lesionvol_path=None, csv_cache_dir=None, lesionmask_path=None, atlas_dir=None, lesion_cache_path=None):
+    # Loads the ChaCo scores of several atlases, chaco types and NeMo settings (e.g. nemo_settings_list=[['1mm','sdstream'],
+    # ['2mm','ifod2act']]) for one common set of subjects, so that they can be compared on the same cohort, splits and
+    # covariates. The .csv is loaded and filtered once, all settings are looked up in the same (cached) scan of nemo_path,
+    # and only subjects that have NeMo outputs for every combination are kept.
+    # Returns a dict of (atlas, chaco_type, resolution, tractography) -> feature matrix, with rows in the same subject
+    # order, and the shared y, C, lesion_load and subIDs (as in create_data_set).
+    # chaco_type 'lesionoverlap' needs lesionmask_path (and atlas_dir, lesion_cache_path as in create_data_set).
+    if 'lesionoverlap' in chaco_types and (not lesionmask_path or lesionmask_path == 'none'):
+        raise RuntimeError("Warning! chaco_type 'lesionoverlap' requires lesionmask_path.")
+    df, covariates_list = load_cohort(csv_path, covariates, ll, subid_colname, lesionvol_path, yvar_colname, chronicity_colname, site_colname, csv_cache_dir)
+
+    combinations = [(atlas, chaco_type) + tuple(nemo_settings) for nemo_settings in nemo_settings_list for atlas in atlases for chaco_type in chaco_types]
+    has_scan = np.ones(df.shape[0], dtype=bool)
+    for atlas, chaco_type, resolution, tractography in combinations:
+        has_scan &= find_available_scans(df[subid_colname], atlas, chaco_type, nemo_path, [resolution, tractography], store_path, lesionmask_path)
+    df_final, report = filter_cohort(df, yvar_colname, covariates_list, chronicity_colname, subset, has_scan)
+    print_exclusion_report(report, subset)
+
+    X_bundle = OrderedDict()
+    for atlas, chaco_type, resolution, tractography in combinations:
+        X_bundle[(atlas, chaco_type, resolution, tractography)], missinglist = load_chaco_features(df_final[subid_colname], atlas, chaco_type, nemo_path, [resolution, tractography], store_path, n_workers, sparse, None, lesionmask_path, atlas_dir, lesion_cache_path)
+
+    y, C, lesion_load, subIDs = get_data_set_outputs(df_final, yvar_colname, subid_colname, covariates_list, ll)
+
+    return X_bundle, y, C, lesion_load, subIDs
+
+
+# In-process cache of create_data_set outputs (least recently used first), see create_data_set_cached
+_data_set_cache = OrderedDict()
+
+def get_data_set_key(arguments):
+    # Only the parameters that change the loaded data go into the cache key (not y_var, verbose, site_colname, n_workers...).
+    # The modification times of the data sources are part of the key, so changed inputs are picked up: the feature store's
+    # (subjects added by update_chaco_store) or, without a store, the NeMo directories', and those of the lesion volume,
+    # lesion mask and lesion cache directories.
+    # atlas and chaco_type are normalized with normalize_nemo_target, so e.g. lesion-load runs with atlas 'none' and
+    # chaco_type 'NA' share the fs86subj chacovol data.
+    atlas, chaco_type = normalize_nemo_target(arguments['atlas'], arguments['chaco_type'])
+    covariates = arguments['covariates']
+    if isinstance(covariates, str):
+        covariates = [covariates]
+    nemo_mtime = None
+    if (not arguments['store_path'] or arguments['store_path'] == 'none') and arguments['nemo_path'] and not arguments['nemo_path'] == 'none':
+        nemo_mtime = tuple(get_nemo_mtime(arguments['nemo_path']))
+    return (arguments['csv_path'], os.path.getmtime(arguments['csv_path']), arguments['nemo_path'], arguments['store_path'],
+            arguments['yvar_colname'], arguments['subid_colname'], arguments['chronicity_colname'], atlas, chaco_type,
+            tuple(covariates or []), arguments['subset'], arguments['ll'], tuple(arguments['nemo_settings'] or []), arguments['sparse'],
+            arguments['lesionvol_path'], arguments['out_of_core_path'], arguments['lesionmask_path'], arguments['atlas_dir'],
+            arguments['lesion_cache_path'], get_chaco_store_mtime(arguments['store_path'], atlas, chaco_type, arguments['nemo_settings']),
+            nemo_mtime, get_path_mtime(arguments['lesionvol_path']), get_path_mtime(arguments['lesionmask_path']),
+            get_path_mtime(arguments['lesion_cache_path']))
+
+def get_path_mtime(path):
+    # Modification time of a file or directory argument, None if it is not set ('none') or does not exist.
+    if not path or path == 'none' or not os.path.exists(path):
+        return None
+    return os.stat(path).st_mtime_ns
+
+def get_data_set_nbytes(data_set, seen=None):
+    # Approximate memory held by a create_data_set output. Memory-mapped feature stores live on disk and are not counted.
+    # Arrays that are views of one matrix (e.g. the chronic and acute slices of create_acutechronic_data_set) are counted
+    # once, with the size of the matrix they share.
+    if seen is None:
+        seen = set()
+    nbytes = 0
+    for item in data_set:
+        if isinstance(item, tuple):
+            nbytes += get_data_set_nbytes(item, seen)
+            continue
+        if sp.issparse(item):
+            nbytes += item.data.nbytes + item.indices.nbytes + item.indptr.nbytes
+        elif isinstance(item, np.ndarray):
+            base = item
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            if isinstance(base, np.memmap) or id(base) in seen:
+                continue
+            seen.add(id(base))
+            nbytes += base.nbytes
+        elif isinstance(item, pd.DataFrame):
+            nbytes += int(item.memory_usage(deep=True).sum())
+        elif isinstance(item, pd.Series):
+            nbytes += int(item.memory_usage(deep=True))
+    return nbytes
+
+def create_data_set_cached(*args, cache_mb=2000, loader=create_data_set, **kwargs):
+    # Same arguments and outputs as create_data_set (or loader, e.g. create_acutechronic_data_set), but outputs are kept in
+    # memory and reused by later calls that need the same data (e.g. when run_models sweeps several models or cross-validation
+    # types over one atlas). Least recently used data sets are evicted once the cache holds more than cache_mb megabytes.
+    # The returned arrays are shared between calls, so they must not be modified in place.
+    arguments = inspect.signature(loader).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    key = get_data_set_key(arguments.arguments) + (loader.__name__,)
+
+    if key in _data_set_cache:
+        print('\nUsing cached data set for atlas: {}, chaco_type: {}, subset: {}'.format(key[7], key[8], key[10]))
+        _data_set_cache.move_to_end(key)
+        return _data_set_cache[key][0]
+
+    data_set = loader(*args, **kwargs)
+    nbytes = get_data_set_nbytes(data_set)
+    budget = cache_mb*1024*1024
+    if nbytes <= budget:
+        while _data_set_cache and sum(item[1] for item in _data_set_cache.values()) + nbytes > budget:
+            _data_set_cache.popitem(last=False)
+        _data_set_cache[key] = (data_set, nbytes)
+    return data_set
@@ -1,9 +1,13 @@
 import numpy as np 
+import scipy.sparse as sp
 from scipy.stats import pearsonr
 import os
-from sklearn.model_selection import GridSearchCV, KFold
+from sklearn.model_selection import GridSearchCV, KFold, ParameterGrid
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV
 from sklearn.metrics import explained_variance_score
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
 from sklearn.linear_model import Lasso, Ridge, ElasticNet,LinearRegression,LogisticRegression
 from sklearn.svm import SVC,SVR
 from sklearn.feature_selection import SelectKBest, f_regression
@@ -11,7 +15,10 @@ import matplotlib.pyplot as plt
 from sklearn.model_selection import GroupShuffleSplit, GroupKFold, LeaveOneGroupOut
 import glob
 import math
+import itertools
 from sklearn.ensemble import RandomForestClassifier
+from joblib import Parallel, delayed, parallel_backend, cpu_count
+from threadpoolctl import threadpool_limits
 
 import warnings
 warnings.filterwarnings('ignore') 
@@ -22,14 +29,27 @@ def prepare_data(X):
     '''Clean X-data (remove zero-value input variables)'''
 
     # remove inputs that are 0 for all subjects
-    zeros=X==0
-    zeros=np.sum(zeros,0)
-    zeros=zeros==X.shape[0]
+    zeros=find_zero_columns(X)
     X=X[:,~zeros]
     print("Final size of X: " + str(X.shape))
     
     return X
 
+def find_zero_columns(X):
+    '''Boolean mask of input variables that are 0 for all subjects (works for dense and scipy sparse X)'''
+    if sp.issparse(X):
+        # count the nonzero entries per column without densifying
+        return np.asarray((abs(X) > 0).sum(axis=0)).ravel() == 0
+    zeros=X==0
+    zeros=np.sum(zeros,0)
+    return np.asarray(zeros==X.shape[0]).ravel()
+
+def stack_rows(X1, X2):
+    '''Append the rows of X2 to X1, keeping scipy sparse inputs sparse (used to add acute subjects to the training set)'''
+    if sp.issparse(X1) or sp.issparse(X2):
+        return sp.vstack((X1, X2), format='csr')
+    return np.concatenate((X1, X2),axis=0)
+
 def prepare_image_data(X):
     '''Clean X-data (remove zero-value input variables)'''
 
@@ -169,7 +189,12 @@ def get_models(model_type='regression', model_list=None):
         mdls_labels = model_list 
     return mdls, mdls_labels
 
-def inner_loop(mdl, mdl_label, X, Y, group, inner_cv, n_jobs):
+def inner_loop(mdl, mdl_label, X, Y, group, inner_cv, n_jobs, blas_threads=None, search_mode='grid'):
+    # n_jobs: number of grid search worker processes; blas_threads: BLAS/OpenMP threads per grid search worker (None: joblib default)
+    # search_mode: 'grid' (every point of the grid), 'halving' (successive halving over subjects, see halving_search) or
+    # 'coarse_to_fine' (see coarse_to_fine_search). The ridge models are always searched with the path searches, which score
+    # the alpha grid from decompositions instead of fits ('coarse_to_fine' refines k only, see coarse_to_fine_path_search).
+    # Returns the refit best model and the search counts (see get_search_counts), None for models without a search.
     
     if mdl_label =='ensemble_reg':
         print('No feature selection')
@@ -229,22 +254,149 @@ def inner_loop(mdl, mdl_label, X, Y, group, inner_cv, n_jobs):
         score = 'roc_auc'
     else:
         print('Model not found..')
-        return mdl
+        return mdl, None
     
     if mdl_label == 'ensemble_reg':
-        return mdl
+        return mdl, None
     elif mdl_label=='linear_regression':
-        return mdl
+        return mdl, None
+
+    n_splits = inner_cv.get_n_splits(X, Y, group)
+    n_full = len(ParameterGrid(grid_params))*n_splits
+    n_decompositions = 0
+    if mdl_label=='ridge':
+        # same selection as the grid search, with features ranked once per inner fold and the alpha grid scored from one
+        # decomposition per k (halving over subjects would not save any of these decompositions)
+        ks = np.unique(grid_params['featselect__k'])
+        with threadpool_limits(limits=get_path_search_threads(n_jobs, blas_threads)):
+            if search_mode == 'coarse_to_fine':
+                print('Performing coarse-to-fine feature selection x ridge path search for: {} \n'.format(mdl_label))
+                best_k, best_alpha, n_ks = coarse_to_fine_path_search(X, Y, group, inner_cv, grid_params['featselect__k'], grid_params['ridge__alpha'])
+            else:
+                print('Performing feature selection x ridge path search for: {} \n'.format(mdl_label))
+                best_k, best_alpha = ridge_featselect_path_search(X, Y, group, inner_cv, grid_params['featselect__k'], grid_params['ridge__alpha'])
+                n_ks = len(ks)
+            best_mdl = clone(mdl).set_params(featselect__k=best_k, ridge__alpha=best_alpha)
+            best_mdl.fit(X, Y)
+        n_fits = n_fits_equiv = 0
+        n_decompositions = n_ks*n_splits
+    elif mdl_label=='ridge_nofeatselect':
+        # same selection as the grid search, with the whole alpha grid scored from one decomposition per inner fold, which no
+        # other search mode can improve on
+        print('Performing ridge path search for: {} \n'.format(mdl_label))
+        with threadpool_limits(limits=get_path_search_threads(n_jobs, blas_threads)):
+            best_alpha = ridge_path_search(X, Y, group, inner_cv, grid_params['ridge_nofeatselect__alpha'])
+            best_mdl = clone(mdl).set_params(ridge_nofeatselect__alpha=best_alpha)
+            best_mdl.fit(X, Y)
+        n_fits = n_fits_equiv = 0
+        n_decompositions = n_splits
+    elif search_mode == 'halving':
+        print('Performing successive halving search for: {} \n'.format(mdl_label))
+        best_mdl, n_fits, n_fits_equiv = halving_search(mdl, grid_params, score, X, Y, group, inner_cv, n_jobs, blas_threads)
+    elif search_mode == 'coarse_to_fine':
+        print('Performing coarse-to-fine search for: {} \n'.format(mdl_label))
+        best_mdl, n_fits = coarse_to_fine_search(mdl, grid_params, score, X, Y, group, inner_cv, n_jobs, blas_threads)
+        n_fits_equiv = n_fits
     else:
         print('Performing grid search for: {} \n'.format(mdl_label))
 
         grid_search = GridSearchCV(estimator=mdl, param_grid=grid_params, scoring=score, cv=inner_cv, refit=True, verbose=1,
                                 n_jobs=n_jobs, return_train_score=False, pre_dispatch='2*n_jobs')
-
-    grid_search.fit(X, Y, group)
-    best_mdl = grid_search.best_estimator_
-
-    return best_mdl
+        fit_search(grid_search, X, Y, group, n_jobs, blas_threads)
+        best_mdl = grid_search.best_estimator_
+        n_fits = n_fits_equiv = n_full
+
+    # every search ends with one refit of the best parameters on the whole training set
+    search_counts = get_search_counts(n_fits, n_fits_equiv, n_decompositions, 1, n_full)
+    print_search_counts(search_counts, '{}, {}'.format(mdl_label, search_mode))
+    return best_mdl, search_counts
+
+def get_search_counts(n_fits, n_fits_equiv, n_decompositions, n_refits, n_full):
+    # Work done by one inner loop search: number of estimator fits used to score the grid, the same weighted by the fraction
+    # of subjects each fit used (halving_search), number of matrix decompositions the path searches use instead of fits,
+    # number of refits of the best parameters, and number of fits the full grid search needs to score the grid (n_full).
+    return {'fits': n_fits, 'fits_equiv': n_fits_equiv, 'decompositions': n_decompositions, 'refits': n_refits, 'full_grid_fits': n_full}
+
+def print_search_counts(search_counts, label):
+    print('Search ({}): {} fits ({} full-data equivalents) and {} decompositions + {} refit(s), full grid search: {} fits + {} refit(s)'.format(label,
+          int(search_counts['fits']), np.round(search_counts['fits_equiv'], 1), int(search_counts['decompositions']),
+          int(search_counts['refits']), int(search_counts['full_grid_fits']), int(search_counts['refits'])))
+
+def get_path_search_threads(n_jobs, blas_threads=None):
+    # Path searches (ridge_path_search, ridge_featselect_path_search, fit_out_of_core_fold) replace a grid search over n_jobs
+    # worker processes by one process, which gets the BLAS/OpenMP threads of all those workers (None: left as is).
+    if blas_threads is None:
+        return None
+    return n_jobs*blas_threads
+
+def fit_search(search, X, Y, group, n_jobs, blas_threads=None):
+    # Fits a GridSearchCV-like object, with blas_threads BLAS/OpenMP threads per worker (see inner_loop).
+    if blas_threads is not None and n_jobs != 1:
+        with parallel_backend('loky', inner_max_num_threads=blas_threads):
+            search.fit(X, Y, groups=group)
+    else:
+        search.fit(X, Y, groups=group)
+    return search
+
+def halving_search(mdl, grid_params, score, X, Y, group, inner_cv, n_jobs, blas_threads=None, factor=3, n_rounds=3):
+    # Successive halving over the subject budget: every grid point is scored on a random 1/factor**(n_rounds-1) of the
+    # subjects, and only the best 1/factor of the points go on to the next round, which uses factor times as many subjects,
+    # until the last few points are scored on all subjects (large grids get extra rounds on the smallest subset first).
+    # Very small subsets favour strong regularization, hence the floor on the subset size. The optimum can differ slightly
+    # from the full grid search.
+    # Returns the refit best model, the number of fits and the number of full-data fit equivalents (fits weighted by the
+    # fraction of subjects they used), not counting the refit.
+    n_splits = inner_cv.get_n_splits(X, Y, group)
+    min_resources = max(X.shape[0]//factor**(n_rounds - 1), 2*n_splits)
+    # with aggressive elimination, small grids are scored several times on the smallest subset, so the number of fits can be
+    # larger than the full grid search's, only their cost (n_fits_equiv) is smaller
+    search = HalvingGridSearchCV(estimator=mdl, param_grid=grid_params, scoring=score, cv=inner_cv, factor=factor, resource='n_samples',
+                                 min_resources=min_resources, aggressive_elimination=True, refit=True, verbose=1, n_jobs=n_jobs,
+                                 return_train_score=False, random_state=0)
+    fit_search(search, X, Y, group, n_jobs, blas_threads)
+    n_fits = len(search.cv_results_['params'])*n_splits
+    n_fits_equiv = np.sum(np.array(search.cv_results_['n_resources']))*n_splits/X.shape[0]
+    return search.best_estimator_, n_fits, n_fits_equiv
+
+def coarse_to_fine_search(mdl, grid_params, score, X, Y, group, inner_cv, n_jobs, blas_threads=None, stride=5):
+    # Coarse-to-fine refinement on the grid: every stride-th value of each parameter (the grids are log-spaced for alpha, k,
+    # C and gamma) is scored first, then the neighbourhood of the best point is scored with half the stride, and so on
+    # until neighbouring grid values are scored. Only points of the original grid are scored, each at most once. The
+    # optimum can differ from the full grid search if the score has several local maxima.
+    # Returns the refit best model and the number of fits, not counting the refit.
+    keys = sorted(grid_params)
+    values = [list(grid_params[key]) for key in keys]
+    lo = [0 for v in values]
+    hi = [len(v) - 1 for v in values]
+    step = stride
+    mean_scores = {}
+    n_splits = inner_cv.get_n_splits(X, Y, group)
+    while True:
+        axes = [sorted(set(range(lo[i], hi[i] + 1, step)) | {hi[i]}) for i in range(len(keys))]
+        points = [point for point in itertools.product(*axes) if point not in mean_scores]
+        if points:
+            search = GridSearchCV(estimator=mdl, param_grid=[{key: [values[i][p]] for i, (key, p) in enumerate(zip(keys, point))} for point in points],
+                                  scoring=score, cv=inner_cv, refit=False, verbose=1, n_jobs=n_jobs, return_train_score=False, pre_dispatch='2*n_jobs')
+            fit_search(search, X, Y, group, n_jobs, blas_threads)
+            mean_scores.update(zip(points, search.cv_results_['mean_test_score']))
+        # first best point in the order of the full grid, as in GridSearchCV
+        best = max(sorted(mean_scores), key=lambda point: np.nan_to_num(mean_scores[point], nan=-np.inf))
+        if step == 1:
+            break
+        lo = [max(0, b - step) for b in best]
+        hi = [min(len(v) - 1, b + step) for b, v in zip(best, values)]
+        step = max(1, step//2)
+    best_params = {key: values[i][best[i]] for i, key in enumerate(keys)}
+    print('Best parameters: {}'.format(best_params))
+    best_mdl = clone(mdl).set_params(**best_params)
+    best_mdl.fit(X, Y)
+    return best_mdl, len(mean_scores)*n_splits
+
+def get_search_mode(search_modes, mdl_label):
+    # Search mode of inner_loop for a model: search_modes maps model names (or 'all') to 'grid', 'halving' or 'coarse_to_fine'.
+    if not search_modes:
+        return 'grid'
+    return search_modes.get(mdl_label, search_modes.get('all', 'grid'))
 
 def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
     # In case there was feature selection, return full size feature set with 0s for features not selected
@@ -253,7 +405,7 @@ def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
     
     # first transform (ie rearrange) the beta coefficients
 
-    if chaco_type =='chacovol':
+    if chaco_type =='chacovol' or chaco_type == 'lesionoverlap':
         if atlas == 'fs86subj':
             
             idx=np.ones(shape=(86,1), dtype='bool')
@@ -271,9 +423,7 @@ def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
             
             #print("Full 3192: " + str(np.sum(activation_full>0)))
             # fill spots with 0's (up to 3655)
-            zeros=X==0
-            zeros=np.sum(zeros,0) # number of zeros across subjects
-            zeros=zeros==X.shape[0] # find columns with zeros for all 101 subjects
+            zeros=find_zero_columns(X) # find columns with zeros for all subjects
             X=X[:,~zeros]
             
             zeroidx=np.arange(0, 86)
@@ -304,9 +454,7 @@ def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
             
             #print("Full 3192: " + str(np.sum(activation_full>0)))
             # fill spots with 0's (up to 3655)
-            zeros=X==0
-            zeros=np.sum(zeros,0) # number of zeros across subjects
-            zeros=zeros==X.shape[0] # find columns with zeros for all 101 subjects
+            zeros=find_zero_columns(X) # find columns with zeros for all subjects
             X=X[:,~zeros]
             
             zeroidx=np.arange(0, 268)
@@ -339,9 +487,7 @@ def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
             
             #print("Full 3192: " + str(np.sum(activation_full>0)))
             # fill spots with 0's (up to 3655)
-            zeros=X==0
-            zeros=np.sum(zeros,0) # number of zeros across subjects
-            zeros=zeros==X.shape[0] # find columns with zeros for all 101 subjects
+            zeros=find_zero_columns(X) # find columns with zeros for all subjects
             X=X[:,~zeros]
             
             zeroidx=np.arange(0, 3655)
@@ -377,9 +523,7 @@ def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
             
             #print("Full 3192: " + str(np.sum(activation_full>0)))
             # fill spots with 0's (up to 3655)
-            zeros=X==0
-            zeros=np.sum(zeros,0) # number of zeros across subjects
-            zeros=zeros==X.shape[0] # find columns with zeros for all 101 subjects
+            zeros=find_zero_columns(X) # find columns with zeros for all subjects
             X=X[:,~zeros]
             
             zeroidx=np.arange(0, 35778)
@@ -401,18 +545,19 @@ def get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, X):
 
     return beta_coeffs
 
-def create_outer_cv(outer_cv_id):
+def create_outer_cv(outer_cv_id, perm=None):
     #This code defines a function that creates a cross-validation object for use in training and evaluating machine learning models.
-    # The function takes as input an identifier for the type of cross-validation to use (outer_cv_id).
+    # The function takes as input an identifier for the type of cross-validation to use (outer_cv_id) and a random seed (perm),
+    # so that the outer split of each permutation is reproducible.
     
     if outer_cv_id=="1": # random
-        outer_cv = KFold(n_splits=5, shuffle=True)
+        outer_cv = KFold(n_splits=5, shuffle=True, random_state=perm)
     elif outer_cv_id =="2": # leave one group out
         outer_cv = LeaveOneGroupOut()
     elif outer_cv_id =='3':
         outer_cv = GroupKFold(n_splits=5)
     elif outer_cv_id == "4" or outer_cv_id =="5":
-        outer_cv = GroupShuffleSplit(train_size=.8)
+        outer_cv = GroupShuffleSplit(train_size=.8, random_state=perm)
     return outer_cv
         
 def create_inner_cv(inner_cv_id, perm):
@@ -433,10 +578,53 @@ def create_inner_cv(inner_cv_id, perm):
     elif inner_cv_id == "4":
         inner_cv = KFold(n_splits=5, shuffle=True,random_state=perm)
     elif inner_cv_id == "5":
-        inner_cv = GroupShuffleSplit(train_size = 0.8)
+        inner_cv = GroupShuffleSplit(train_size = 0.8, random_state=perm)
     return inner_cv
+
+def get_core_budget(n_cores, n_outer_jobs=1, blas_threads=1):
+    # Splits a budget of n_cores (0 or None: all cores available to this process) between the processes running
+    # (permutation, outer fold) units, the grid search workers of each unit and the BLAS/OpenMP threads of each of those,
+    # so that n_outer_jobs * n_grid_jobs * blas_threads <= n_cores. Units whose search runs in one process (the ridge path
+    # searches and the out-of-core model) use n_grid_jobs * blas_threads BLAS threads instead (see get_path_search_threads).
+    # Returns a dict with the keyword arguments of the run_regression* functions.
+    if not n_cores or n_cores < 1:
+        n_cores = cpu_count()
+    n_outer_jobs = max(1, min(n_outer_jobs, n_cores))
+    blas_threads = max(1, min(blas_threads, n_cores // n_outer_jobs))
+    n_grid_jobs = max(1, n_cores // (n_outer_jobs * blas_threads))
+    print('Core budget: {} cores = {} outer job(s) x {} grid search job(s) x {} BLAS thread(s)'.format(n_cores, n_outer_jobs, n_grid_jobs, blas_threads))
+    return {'n_outer_jobs': n_outer_jobs, 'n_grid_jobs': n_grid_jobs, 'blas_threads': blas_threads}
+
+def get_outer_units(X, Y, subIDs, outer_cv_id, nperms):
+    # The (permutation, outer fold) units of a run. The outer split of permutation n is drawn with random_state=n (and its
+    # inner splits with create_inner_cv(inner_cv_id, n)), so every unit can run independently, in any order and on any
+    # worker, and a run is reproducible.
+    # Returns a list of (n, cv_fold, train_id, test_id), ordered by permutation and fold.
+    units = []
+    for n in range(0, nperms):
+        outer_cv = create_outer_cv(outer_cv_id, n)
+        for cv_fold, (train_id, test_id) in enumerate(outer_cv.split(X, Y, subIDs)):
+            units.append((n, cv_fold, train_id, test_id))
+    return units
+
+def run_outer_units(fit_unit, units, n_outer_jobs=1, blas_threads=None, **kwargs):
+    # Runs fit_unit(unit, blas_threads=blas_threads, **kwargs) for every unit of get_outer_units, on n_outer_jobs worker
+    # processes. Large arrays in kwargs are memory-mapped by joblib instead of being copied to every worker. Results are
+    # returned in the order of units.
+    if n_outer_jobs > 1:
+        return Parallel(n_jobs=n_outer_jobs)(delayed(run_unit)(fit_unit, unit, blas_threads, kwargs) for unit in units)
+    return [run_unit(fit_unit, unit, blas_threads, kwargs) for unit in units]
+
+def run_unit(fit_unit, unit, blas_threads, kwargs):
+    # Pins the BLAS/OpenMP thread pools of the worker to blas_threads (None: left as is) while the unit runs.
+    with threadpool_limits(limits=blas_threads):
+        return fit_unit(unit, blas_threads=blas_threads, **kwargs)
+
+def get_perm_results(results, n):
+    # Results of permutation n's outer folds, in fold order.
+    return [result for result in results if result['perm'] == n]
     
-def run_regression(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null, output_folder, acute_data):
+def run_regression(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null, output_folder, acute_data, n_outer_jobs=1, n_grid_jobs=10, blas_threads=None, search_modes=None):
     # This code implements a cross-validation procedure for training and evaluating machine learning models on brain imaging data. 
     # The function takes as input the features (x), labels (Y), grouping information (group), inner and outer cross-validation schemes 
     # (inner_cv_id, outer_cv_id), a list of models to test (model_tested), an atlas of the brain (atlas), the name of the dependent variable 
@@ -449,6 +637,9 @@ def run_regression(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas,
     # model_tested and trains and evaluates each model using the training and testing sets. The function returns the trained models, 
     # explained variance, variable importance, correlations, and size of the test group for each model.
     # - ChatGPT
+    #
+    # The (permutation, outer fold) units are independent (see get_outer_units) and run on n_outer_jobs processes
+    # (fit_regression_fold); their results are gathered in order and saved per permutation.
 
         
     if atlas =='lesionload_m1' :
@@ -460,6 +651,7 @@ def run_regression(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas,
     else:
         X = x
         
+    acute = None
     if acute_data:
         acute_Y = acute_data['acute_Y']
         acute_subIDs = acute_data['acute_subIDs']
@@ -475,115 +667,43 @@ def run_regression(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas,
         else:
             acute_X =acute_data['acute_X']
             acute_X = acute_X
+        acute = (acute_X, acute_Y, acute_subIDs)
 
     # grab CV object for outer CV
     outer_cv = create_outer_cv(outer_cv_id)
     
     outer_cv_splits = outer_cv.get_n_splits(X, Y, subIDs)
+    mdl, mdl_label = get_models('regression', model_tested) 
     
     models = np.zeros((outer_cv_splits), dtype=object)
     explained_var  = np.zeros((outer_cv_splits), dtype=object)
     correlations  = np.zeros((outer_cv_splits), dtype=object)
     size_testgroup =[]
 
-    for n in range(0,nperms):
-        
-        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
-        
-        beta_coeffs_weights=[]
-        for cv_fold, (train_id, test_id) in enumerate(outer_cv.split(X, Y, subIDs)): 
-                        
-            print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
-            
-            X_train, X_test = X[train_id], X[test_id]  # for acutechronic, this is only chronic data.
-            y_train, y_test = Y[train_id], Y[test_id]
-
-            group_train, group_test = subIDs[train_id], subIDs[test_id]
-            
-            if acute_data:
-                print('Acute data incorporated into training set.')
-                X_train = np.concatenate((X_train, acute_X),axis=0)
-                y_train = np.concatenate((y_train, acute_Y),axis=0)
-                group_train = np.concatenate((group_train, acute_subIDs), axis=0)
-    
-            
-            print('Size of test: {}'.format(y_test.shape[0]))
-            print('Size of train: {}'.format(X_train.shape[0]))
-            
-            # grab the model specified/create Pipeline if necessary
-            mdl, mdl_label = get_models('regression', model_tested) 
-
-            # save size of test group
-            size_testgroup.append(group_test.shape[0])
-            
-            # grab CV object 
-            inner_cv = create_inner_cv(inner_cv_id,n)
-
-            # do cross-validation to find an optimal model 
-            mdl = inner_loop(mdl, mdl_label, X_train, y_train, group_train, inner_cv, 10)  
+    units = get_outer_units(X, Y, subIDs, outer_cv_id, nperms)
+    results = run_outer_units(fit_regression_fold, units, n_outer_jobs, blas_threads, n_grid_jobs=n_grid_jobs, search_modes=search_modes, X=X, Y=Y, subIDs=subIDs, x=x, acute=acute, inner_cv_id=inner_cv_id,
+                              model_tested=model_tested, atlas=atlas, chaco_type=chaco_type, save_models=save_models, outer_cv_splits=outer_cv_splits, nperms=nperms)
 
-            # fit best model to full training set
-            mdl.fit(X_train, y_train)
-            
-            # extract features from the fit model
-            if model_tested == 'ridge':
-                cols = mdl['featselect'].get_support(indices=True)
-                beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
-                beta_coeffs_weights.append(beta_coeffs)
-
-            elif model_tested== 'ridge_nofeatselect':
-                mdl_label=mdl_label
-                if atlas =='lesionload_all':
-                    cols = [0, 1, 2, 3, 4, 5]
-                    beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
-                    beta_coeffs_weights.append(beta_coeffs)
-                    
-                elif atlas == 'lesionload_all_2h':
-                    cols = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
-                    beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
-                    beta_coeffs_weights.append(beta_coeffs)
-                    
-                elif atlas == 'lesionload_slnm':
-                    cols = [0, 1, 2, 3, 4]
-                    beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
-                    beta_coeffs_weights.append(beta_coeffs)
-                elif atlas == 'shen268':
-                    cols = range(268)
-                    beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
-                    beta_coeffs_weights.append(beta_coeffs)
-                elif atlas == 'fs86subj':
-                    cols = range(86)
-                    beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
-                    beta_coeffs_weights.append(beta_coeffs)
-            else:
-                mdl_label=mdl_label
-
-                beta_coeffs_weights=[]
-
-            # predict scores in the test set
-            y_pred= mdl.predict(X_test)
-            
-            # create filename suffix for saving outputs
-            filename =  '{}_{}_{}_{}_{}_crossval{}_perm{}'.format(atlas, y_var, chaco_type, subset, mdl_label,crossval_type,n)
-
-            # sanity check to make sure test subjects != any training subjects
-            #np.save(os.path.join(results_path,output_folder, filename + "_train_IDs"), group_train)
-            #np.save(os.path.join(results_path,output_folder, filename + "_test_IDs"), group_test)
-            
-            expl=explained_variance_score(y_test, y_pred)
-            correlations[cv_fold] = np_pearson_cor(y_test,y_pred)[0]
-            
-            print('R^2 score: {} '.format(np.round(explained_variance_score(y_test, y_pred), 3)))
-            print('Correlation: {} '.format(np.round(np_pearson_cor(y_test,y_pred)[0][0], 3)))
-            explained_var[cv_fold]=expl
-            
+    for n in range(0,nperms):
+        perm_results = get_perm_results(results, n)
+        beta_coeffs_weights = [result['beta_coeffs'] for result in perm_results if result['beta_coeffs'] is not None]
+        for result in perm_results:
+            explained_var[result['fold']] = result['explained_var']
+            correlations[result['fold']] = result['correlation']
+            size_testgroup.append(result['size_testgroup'])
             if save_models:
-                models[cv_fold] = mdl
-                
-            print('\n')
+                models[result['fold']] = result['model']
+            
+        # create filename suffix for saving outputs
+        filename =  '{}_{}_{}_{}_{}_crossval{}_perm{}'.format(atlas, y_var, chaco_type, subset, mdl_label,crossval_type,n)
 
+        print('Permutation {}/{}'.format(n, nperms))
         print('Mean correlation over all outer folds: {}'.format(np.mean(correlations)[0]))
         print('Mean R^2 over all outer folds: {}'.format(np.mean(explained_var)))
+        search_counts = [result['search_counts'] for result in perm_results if result['search_counts'] is not None]
+        if search_counts:
+            print_search_counts({key: np.sum([counts[key] for counts in search_counts]) for key in search_counts[0]},
+                                'all outer folds, {}'.format(get_search_mode(search_modes, mdl_label)))
 
         print('\n\n')
         np.save(os.path.join(results_path, output_folder,filename+ "_scores.npy"), explained_var)
@@ -592,9 +712,90 @@ def run_regression(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas,
         np.save(os.path.join(results_path,output_folder, filename + "_beta_coeffs.npy"), beta_coeffs_weights)
         np.save(os.path.join(results_path, output_folder,filename+ "_test_group_sizes.npy"), size_testgroup)
 
+def fit_regression_fold(unit, X, Y, subIDs, x, acute, inner_cv_id, model_tested, atlas, chaco_type, save_models, outer_cv_splits, nperms, n_grid_jobs=10, blas_threads=None, search_modes=None):
+    # One (permutation, outer fold) unit of run_regression: inner-loop model selection on the outer training set (plus the
+    # acute subjects, if any), refit, and evaluation on the outer test set.
+    # Returns a dict with the fold's explained variance, correlation, beta coefficients (None if not extracted), test set size
+    # and model (None unless save_models).
+    n, cv_fold, train_id, test_id = unit
+    if cv_fold == 0:
+        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
+    print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
+    
+    X_train, X_test = X[train_id], X[test_id]  # for acutechronic, this is only chronic data.
+    y_train, y_test = Y[train_id], Y[test_id]
+
+    group_train, group_test = subIDs[train_id], subIDs[test_id]
+    
+    if acute is not None:
+        acute_X, acute_Y, acute_subIDs = acute
+        print('Acute data incorporated into training set.')
+        X_train = stack_rows(X_train, acute_X)
+        y_train = np.concatenate((y_train, acute_Y),axis=0)
+        group_train = np.concatenate((group_train, acute_subIDs), axis=0)
+
+    
+    print('Size of test: {}'.format(y_test.shape[0]))
+    print('Size of train: {}'.format(X_train.shape[0]))
+    
+    # grab the model specified/create Pipeline if necessary
+    mdl, mdl_label = get_models('regression', model_tested) 
+    
+    # grab CV object 
+    inner_cv = create_inner_cv(inner_cv_id,n)
+
+    # do cross-validation to find an optimal model 
+    mdl, search_counts = inner_loop(mdl, mdl_label, X_train, y_train, group_train, inner_cv, n_grid_jobs, blas_threads, get_search_mode(search_modes, mdl_label))  
+
+    # fit best model to full training set
+    mdl.fit(X_train, y_train)
+    
+    # extract features from the fit model
+    beta_coeffs = None
+    if model_tested == 'ridge':
+        cols = mdl['featselect'].get_support(indices=True)
+        beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
+
+    elif model_tested== 'ridge_nofeatselect':
+        if atlas =='lesionload_all':
+            cols = [0, 1, 2, 3, 4, 5]
+            beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
+            
+        elif atlas == 'lesionload_all_2h':
+            cols = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+            beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
+            
+        elif atlas == 'lesionload_slnm':
+            cols = [0, 1, 2, 3, 4]
+            beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
+        elif atlas == 'shen268':
+            cols = range(268)
+            beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
+        elif atlas == 'fs86subj':
+            cols = range(86)
+            beta_coeffs = get_beta_coefficients(cols, mdl, mdl_label, chaco_type, atlas, x)
+
+    # predict scores in the test set
+    y_pred= mdl.predict(X_test)
+
+    # sanity check to make sure test subjects != any training subjects
+    #np.save(os.path.join(results_path,output_folder, filename + "_train_IDs"), group_train)
+    #np.save(os.path.join(results_path,output_folder, filename + "_test_IDs"), group_test)
+    
+    expl=explained_variance_score(y_test, y_pred)
+    correlation = np_pearson_cor(y_test,y_pred)[0]
+    
+    print('R^2 score: {} '.format(np.round(expl, 3)))
+    print('Correlation: {} '.format(np.round(correlation[0], 3)))
+    print('\n')
+
+    return {'perm': n, 'fold': cv_fold, 'explained_var': expl, 'correlation': correlation, 'beta_coeffs': beta_coeffs,
+            'size_testgroup': group_test.shape[0], 'model': mdl if save_models else None, 'search_counts': search_counts}
+
 
 def run_regression_final(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null, output_folder, acute_data):
-    # Runs only 1 split of 5-fold cross validation, does not estimate performance, returns model with highest out-of-sample accuracy
+    # Runs the outer folds of the first permutation only (the same splits as run_regression's, see get_outer_units), does not
+    # estimate performance, returns model with highest out-of-sample accuracy
 
     X = prepare_data(x) 
     
@@ -614,16 +815,16 @@ def run_regression_final(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, a
                     'featselect__k':k_range}
     score = 'explained_variance'
     
-    inner_cv = create_inner_cv(inner_cv_id,1)
     current_best=0
-    for cv_fold, (train_id, test_id) in enumerate(inner_cv.split(X, Y, group)):
+    for n, cv_fold, train_id, test_id in get_outer_units(X, Y, subIDs, outer_cv_id, 1):
         X_train, X_test = X[train_id], X[test_id]
         y_train, y_test = Y[train_id], Y[test_id]
 
-        group_train, group_test = group[train_id], group[test_id]
-        X_train = np.concatenate((X_train, acute_X),axis=0)
-        y_train = np.concatenate((y_train, acute_Y),axis=0)
-        group_train = np.concatenate((group_train, acute_subIDs), axis=0)
+        group_train, group_test = subIDs[train_id], subIDs[test_id]
+        if acute_data:
+            X_train = np.concatenate((X_train, acute_X),axis=0)
+            y_train = np.concatenate((y_train, acute_Y),axis=0)
+            group_train = np.concatenate((group_train, acute_subIDs), axis=0)
         
         best_alpha,best_k, maxexpl= do_grid_search(X_train, X_test, y_train, y_test, mdl, grid_params, score)
         if maxexpl >= current_best:
@@ -679,7 +880,382 @@ def do_grid_search(X_train, X_test, y_train, y_test, mdl, grid_params, score):
 
 
 
-def run_regression_ensemble(X1, C, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null,output_folder, acute_data):
+def read_row_chunk(segments, seg_id, seg_row, cols=slice(None)):
+    # Reads the rows (seg_id[i], seg_row[i]) of a training set that is split over several matrices (e.g. the chronic rows of
+    # X and all rows of acute_X) into one in-memory float64 array. Each matrix may be a memory map, only these rows (and
+    # columns cols) are read.
+    X_chunk = np.empty((len(seg_id), len(range(segments[0][0].shape[1])[cols])))
+    for s, (X, _) in enumerate(segments):
+        sel = seg_id == s
+        if np.any(sel):
+            X_chunk[sel] = X[seg_row[sel], cols]
+    return X_chunk
+
+def accumulate_ridge_stats(segments, seg_id, seg_row, y, positions, chunk_size=1024):
+    # Sufficient statistics for (normalized) ridge regression over the training rows at positions, read chunk_size rows at a
+    # time: number of rows, column sums, sum of y, X'X and X'y. Memory depends on the number of features, not subjects.
+    n_features = segments[0][0].shape[1]
+    stats = {'n': 0, 'sum_x': np.zeros(n_features), 'sum_y': 0.0, 'xtx': np.zeros((n_features, n_features)), 'xty': np.zeros(n_features)}
+    positions = np.sort(positions)
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        X_chunk = read_row_chunk(segments, seg_id[chunk], seg_row[chunk])
+        y_chunk = y[chunk]
+        stats['n'] += len(chunk)
+        stats['sum_x'] += X_chunk.sum(axis=0)
+        stats['sum_y'] += y_chunk.sum()
+        stats['xtx'] += X_chunk.T @ X_chunk
+        stats['xty'] += X_chunk.T @ y_chunk
+    return stats
+
+def accumulate_fold_kernels(segments, seg_id, seg_row, positions, folds, chunk_size=1024):
+    # Dual form of ridge regression (used instead of accumulate_ridge_stats when there are more features than subjects):
+    # one kernel (len(positions), len(positions)) per entry of folds, with the columns centered and scaled (see
+    # get_centered_kernels) by the means and norms of that fold's rows (indices into positions). Column statistics only
+    # depend on the column, so all kernels are built in a single pass over the data, chunk_size columns at a time.
+    # Memory: len(folds) kernels of len(positions)**2 float64 (e.g. 6 x 0.8 GB for 10000 training subjects).
+    # Returns the kernels and each fold's column means and norms.
+    n_features = segments[0][0].shape[1]
+    kernels = [np.zeros((len(positions), len(positions))) for rows in folds]
+    x_means = [np.zeros(n_features) for rows in folds]
+    x_scales = [np.ones(n_features) for rows in folds]
+    for start in range(0, n_features, chunk_size):
+        cols = slice(start, start + chunk_size)
+        X_chunk = read_row_chunk(segments, seg_id[positions], seg_row[positions], cols)
+        for K, x_mean, x_scale, rows in zip(kernels, x_means, x_scales, folds):
+            x_mean[cols] = X_chunk[rows].mean(axis=0)
+            scale = np.linalg.norm(X_chunk[rows] - x_mean[cols], axis=0)
+            scale[scale == 0] = 1
+            x_scale[cols] = scale
+            Z = (X_chunk - x_mean[cols])/x_scale[cols]
+            K += Z @ Z.T
+    return kernels, x_means, x_scales
+
+def solve_ridge_dual(segments, seg_id, seg_row, y, positions, K, x_mean, x_scale, alpha, chunk_size=1024):
+    # Ridge(normalize=True) coefficients for one alpha in the dual form, from the kernel of the training rows at positions
+    # and its column means/norms (accumulate_fold_kernels): the kernel is decomposed, and the dual coefficients are mapped
+    # back to the features in one more pass over the rows.
+    # Returns the coefficients (n_features, 1) and intercepts (1,) on the original scale, as solve_ridge_path.
+    y_mean = np.mean(y[positions])
+    evals, evecs = np.linalg.eigh(K)
+    evals = np.clip(evals, 0, None)
+    dual_coef = evecs @ ((evecs.T @ (y[positions] - y_mean))/(evals + alpha))
+    xt_dual = np.zeros(segments[0][0].shape[1])
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        xt_dual += read_row_chunk(segments, seg_id[chunk], seg_row[chunk]).T @ dual_coef[start:start + chunk_size]
+    coefs = ((xt_dual - x_mean*np.sum(dual_coef))/x_scale**2)[:, None]
+    intercepts = y_mean - x_mean @ coefs
+    return coefs, intercepts
+
+def subtract_ridge_stats(stats, other):
+    # Statistics of the rows in stats but not in other (e.g. inner training folds = outer training set - inner test fold).
+    return {key: stats[key] - other[key] for key in stats}
+
+def solve_ridge_path(stats, alphas):
+    # Ridge(normalize=True) coefficients for every alpha from the sufficient statistics: columns are centered and scaled
+    # to unit norm, and the scaled X'X is decomposed once so that each alpha only costs a matrix-vector product.
+    # Returns the coefficients (n_features, n_alphas) and intercepts (n_alphas,) on the original scale.
+    n = stats['n']
+    x_mean = stats['sum_x']/n
+    y_mean = stats['sum_y']/n
+    xtx = stats['xtx'] - n*np.outer(x_mean, x_mean)
+    xty = stats['xty'] - n*x_mean*y_mean
+    x_scale = np.sqrt(np.clip(np.diag(xtx), 0, None))
+    x_scale[x_scale == 0] = 1
+    evals, evecs = np.linalg.eigh(xtx/np.outer(x_scale, x_scale))
+    proj = evecs.T @ (xty/x_scale)
+    coefs = (evecs @ (proj[:, None]/(evals[:, None] + np.asarray(alphas)[None, :])))/x_scale[:, None]
+    intercepts = y_mean - x_mean @ coefs
+    return coefs, intercepts
+
+def get_ridge_stats(X, y):
+    # accumulate_ridge_stats for an in-memory training set.
+    return {'n': X.shape[0], 'sum_x': X.sum(axis=0), 'sum_y': y.sum(), 'xtx': X.T @ X, 'xty': X.T @ y}
+
+def get_centered_kernels(X_train, X_test):
+    # Linear kernels of the normalized training set (columns centered and scaled to unit norm, as in Ridge(normalize=True))
+    # with itself (n_train, n_train) and with the test rows (n_test, n_train), scaled with the training set's means and norms.
+    # For sparse X, centering is applied to the kernels so that X is never densified.
+    n = X_train.shape[0]
+    x_mean = np.asarray(X_train.mean(axis=0)).ravel()
+    if sp.issparse(X_train):
+        x_scale = np.sqrt(np.clip(np.asarray(X_train.multiply(X_train).sum(axis=0)).ravel() - n*x_mean**2, 0, None))
+        x_scale[x_scale == 0] = 1
+        d = sp.diags(1/x_scale**2)
+        XD_train, XD_test = X_train @ d, sp.csr_matrix(X_test) @ d
+        u_train, u_test = XD_train @ x_mean, XD_test @ x_mean
+        c = x_mean @ (x_mean/x_scale**2)
+        K = (XD_train @ X_train.T).toarray() - u_train[:, None] - u_train[None, :] + c
+        K_test = (XD_test @ X_train.T).toarray() - u_test[:, None] - u_train[None, :] + c
+    else:
+        Z_train = X_train - x_mean
+        x_scale = np.sqrt(np.sum(Z_train**2, axis=0))
+        x_scale[x_scale == 0] = 1
+        Z_train = Z_train/x_scale
+        K = Z_train @ Z_train.T
+        K_test = ((X_test - x_mean)/x_scale) @ Z_train.T
+    return K, K_test
+
+def predict_ridge_path(X_train, y_train, X_test, alphas):
+    # Ridge(normalize=True) predictions (n_test, n_alphas) for every alpha from one decomposition of the training set. With
+    # fewer features than subjects, the scaled X'X is decomposed (solve_ridge_path); otherwise (ChaCo features, n << p) the
+    # dual form is used: the n x n kernel of the normalized training set is decomposed, and the predictions for each alpha
+    # only cost a matrix-vector product.
+    alphas = np.asarray(alphas)
+    if X_train.shape[1] < X_train.shape[0] and not sp.issparse(X_train):
+        coefs, intercepts = solve_ridge_path(get_ridge_stats(X_train, y_train), alphas)
+        return X_test @ coefs + intercepts
+    K, K_test = get_centered_kernels(X_train, X_test)
+    return predict_kernel_ridge_path(K, K_test, y_train, alphas)
+
+def predict_kernel_ridge_path(K, K_test, y_train, alphas):
+    # Dual form of predict_ridge_path from the kernels of get_centered_kernels: K is decomposed once for all alphas.
+    alphas = np.asarray(alphas)
+    y_mean = np.mean(y_train)
+    evals, evecs = np.linalg.eigh(K)
+    evals = np.clip(evals, 0, None)
+    proj = evecs.T @ (y_train - y_mean)
+    return (K_test @ evecs) @ (proj[:, None]/(evals[:, None] + alphas[None, :])) + y_mean
+
+def ridge_path_search(X, Y, group, inner_cv, alphas):
+    # Scores every alpha on every inner fold with predict_ridge_path and returns the alpha with the best mean explained
+    # variance (first one if tied, as in GridSearchCV).
+    Y = np.asarray(Y, dtype=float)
+    inner_scores = []
+    for inner_train, inner_test in inner_cv.split(X, Y, group):
+        y_pred = predict_ridge_path(X[inner_train], Y[inner_train], X[inner_test], alphas)
+        residuals = Y[inner_test][:, None] - y_pred
+        inner_scores.append(1 - np.var(residuals, axis=0)/np.var(Y[inner_test]))
+    best = np.argmax(np.mean(inner_scores, axis=0))
+    print('Best alpha: {}'.format(alphas[best]))
+    return alphas[best]
+
+def rank_features(X, y):
+    # Feature indices from best to worst f_regression score, so that the first k are the features SelectKBest(f_regression, k)
+    # selects (NaN scores rank last and ties are broken the same way).
+    scores, _ = f_regression(X, y)
+    scores = np.where(np.isnan(scores), np.finfo(float).min, scores)
+    return np.argsort(scores, kind='mergesort')[::-1]
+
+def ridge_featselect_path_scores(X, Y, group, inner_cv, ks, alphas):
+    # Mean explained variance (len(ks), len(alphas)) over the inner folds of the 'ridge' pipeline for every (k, alpha), ks
+    # increasing. Features are ranked once per inner fold (rank_features), and the nested top-k feature sets are walked in
+    # increasing k. For each k, the whole alpha path is scored from one decomposition (predict_ridge_path while k < n,
+    # otherwise the kernel is extended with the newly added features only and decomposed).
+    Y = np.asarray(Y, dtype=float)
+    inner_scores = []
+    for inner_train, inner_test in inner_cv.split(X, Y, group):
+        X_train, X_test = X[inner_train], X[inner_test]
+        y_train, y_test = Y[inner_train], Y[inner_test]
+        ranking = rank_features(X_train, y_train)
+        fold_scores = np.empty((len(ks), len(alphas)))
+        K, K_test, n_cols = 0, 0, 0
+        for i, k in enumerate(ks):
+            if k < X_train.shape[0] and not sp.issparse(X_train):
+                y_pred = predict_ridge_path(X_train[:, ranking[:k]], y_train, X_test[:, ranking[:k]], alphas)
+            else:
+                # kernels are sums over (normalized) features, so only the features added since the last k are computed
+                K_add, K_test_add = get_centered_kernels(X_train[:, ranking[n_cols:k]], X_test[:, ranking[n_cols:k]])
+                K, K_test, n_cols = K + K_add, K_test + K_test_add, k
+                y_pred = predict_kernel_ridge_path(K, K_test, y_train, alphas)
+            residuals = y_test[:, None] - y_pred
+            fold_scores[i] = 1 - np.var(residuals, axis=0)/np.var(y_test)
+        inner_scores.append(fold_scores)
+    return np.mean(inner_scores, axis=0)
+
+def ridge_featselect_path_search(X, Y, group, inner_cv, k_range, alphas):
+    # Joint search over SelectKBest k and ridge alpha for the 'ridge' pipeline (see ridge_featselect_path_scores). Returns
+    # the (k, alpha) with the best mean explained variance, taking the first one in GridSearchCV's candidate order (k
+    # slowest, then alpha) if tied.
+    k_range = np.asarray(k_range)
+    ks = np.unique(k_range)
+    mean_scores = ridge_featselect_path_scores(X, Y, group, inner_cv, ks, alphas)[np.searchsorted(ks, k_range)]
+    best_k, best_alpha = np.unravel_index(np.argmax(mean_scores), (len(k_range), len(alphas)))
+    print('Best k: {}, best alpha: {}'.format(k_range[best_k], alphas[best_alpha]))
+    return k_range[best_k], alphas[best_alpha]
+
+def coarse_to_fine_path_search(X, Y, group, inner_cv, k_range, alphas, stride=5):
+    # Coarse-to-fine version of ridge_featselect_path_search: the whole alpha path is scored for every stride-th k first,
+    # then the neighbourhood of the best k is scored with half the stride, and so on until neighbouring k are scored (see
+    # coarse_to_fine_search). Returns the best (k, alpha) and the number of k scored.
+    ks = np.unique(k_range)
+    lo, hi = 0, len(ks) - 1
+    step = stride
+    mean_scores = {}
+    while True:
+        points = [i for i in sorted(set(range(lo, hi + 1, step)) | {hi}) if i not in mean_scores]
+        if points:
+            mean_scores.update(zip(points, ridge_featselect_path_scores(X, Y, group, inner_cv, ks[points], alphas)))
+        # first best k in increasing order, as in GridSearchCV
+        best = max(sorted(mean_scores), key=lambda i: np.max(np.nan_to_num(mean_scores[i], nan=-np.inf)))
+        if step == 1:
+            break
+        lo, hi = max(0, best - step), min(len(ks) - 1, best + step)
+        step = max(1, step//2)
+    best_alpha = np.argmax(mean_scores[best])
+    print('Best k: {}, best alpha: {}'.format(ks[best], alphas[best_alpha]))
+    return ks[best], alphas[best_alpha], len(mean_scores)
+
+def predict_row_chunks(segments, seg_id, seg_row, positions, coefs, intercepts, chunk_size=1024):
+    # Predictions (len(positions), n_alphas) for the rows at positions, read chunk_size rows at a time.
+    y_pred = np.empty((len(positions), coefs.shape[1]))
+    for start in range(0, len(positions), chunk_size):
+        chunk = positions[start:start + chunk_size]
+        y_pred[start:start + len(chunk)] = read_row_chunk(segments, seg_id[chunk], seg_row[chunk]) @ coefs + intercepts
+    return y_pred
+
+class OutOfCoreRidge:
+    # Fitted out-of-core ridge model (see run_regression_out_of_core), predicts chunk_size rows at a time.
+    def __init__(self, coef, intercept, alpha, chunk_size=1024):
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.alpha = alpha
+        self.chunk_size = chunk_size
+
+    def predict(self, X):
+        y_pred = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], self.chunk_size):
+            y_pred[start:start + self.chunk_size] = np.asarray(X[start:start + self.chunk_size], dtype=np.float64) @ self.coef_ + self.intercept_
+        return y_pred
+
+def run_regression_out_of_core(x, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null, output_folder, acute_data, chunk_size=1024, n_outer_jobs=1, n_grid_jobs=10, blas_threads=None, search_modes=None):
+    # Out-of-core version of run_regression for model_tested == 'ridge_outofcore' (ridge regression without feature selection,
+    # same alpha grid and outputs as 'ridge_nofeatselect'). x is typically the on-disk float32 matrix written by
+    # data_formatting.build_chaco_memmap: training and test rows are never copied out of it (see fit_out_of_core_fold).
+    # The (permutation, outer fold) units are the same as run_regression's (get_outer_units) and run on n_outer_jobs
+    # processes; the memory map is passed to the workers by file name.
+    X = x
+    mdl_label = model_tested
+
+    outer_cv = create_outer_cv(outer_cv_id)
+    outer_cv_splits = outer_cv.get_n_splits(X, Y, subIDs)
+
+    models = np.zeros((outer_cv_splits), dtype=object)
+    explained_var  = np.zeros((outer_cv_splits), dtype=object)
+    correlations  = np.zeros((outer_cv_splits), dtype=object)
+    size_testgroup =[]
+
+    acute = None
+    if acute_data:
+        acute = (acute_data['acute_X'], acute_data['acute_Y'], acute_data['acute_subIDs'])
+
+    units = get_outer_units(np.zeros((X.shape[0], 1)), Y, subIDs, outer_cv_id, nperms)
+    results = run_outer_units(fit_out_of_core_fold, units, n_outer_jobs, blas_threads, n_grid_jobs=n_grid_jobs, X=X, Y=Y, subIDs=subIDs, acute=acute,
+                              inner_cv_id=inner_cv_id, chaco_type=chaco_type, save_models=save_models, outer_cv_splits=outer_cv_splits, nperms=nperms, chunk_size=chunk_size)
+
+    for n in range(0,nperms):
+        perm_results = get_perm_results(results, n)
+        beta_coeffs_weights = [result['beta_coeffs'] for result in perm_results]
+        for result in perm_results:
+            explained_var[result['fold']] = result['explained_var']
+            correlations[result['fold']] = result['correlation']
+            size_testgroup.append(result['size_testgroup'])
+            if save_models:
+                models[result['fold']] = result['model']
+
+        # create filename suffix for saving outputs
+        filename =  '{}_{}_{}_{}_{}_crossval{}_perm{}'.format(atlas, y_var, chaco_type, subset, mdl_label,crossval_type,n)
+
+        print('Mean correlation over all outer folds: {}'.format(np.mean(correlations)[0]))
+        print('Mean R^2 over all outer folds: {}'.format(np.mean(explained_var)))
+
+        print('\n\n')
+        np.save(os.path.join(results_path, output_folder,filename+ "_scores.npy"), explained_var)
+        np.save(os.path.join(results_path,output_folder, filename + "_model.npy"), models)
+        np.save(os.path.join(results_path,output_folder, filename+ "_correlations.npy"), correlations)
+        np.save(os.path.join(results_path,output_folder, filename + "_beta_coeffs.npy"), beta_coeffs_weights)
+        np.save(os.path.join(results_path, output_folder,filename+ "_test_group_sizes.npy"), size_testgroup)
+
+def fit_out_of_core_fold(unit, X, Y, subIDs, acute, inner_cv_id, chaco_type, save_models, outer_cv_splits, nperms, chunk_size=1024, n_grid_jobs=10, blas_threads=None):
+    # One (permutation, outer fold) unit of run_regression_out_of_core. The outer training set is read chunk_size rows at a
+    # time to accumulate ridge sufficient statistics (accumulate_ridge_stats), the inner folds' statistics are derived by
+    # subtracting each held-out fold, and the whole alpha grid is solved per fold from one decomposition (solve_ridge_path).
+    # When there are more features than training subjects (ChaCo features), the p x p statistics would be larger than the
+    # data, so the dual form is used instead: the n x n kernels of the normalized training rows of every inner fold and of
+    # the whole training set are built in one pass over the data (accumulate_fold_kernels), and each is decomposed once for
+    # the whole alpha grid. The data is then read twice per outer fold (kernels, refit) whatever the number of inner folds,
+    # and peak memory is (inner folds + 1) n x n kernels, e.g. 6 x 0.8 GB for 10000 training subjects with 5 inner folds.
+    # Returns the same dict as fit_regression_fold.
+    n, cv_fold, train_id, test_id = unit
+    alphas = np.logspace(-2, 2, 30, base=10,dtype=None)
+    if cv_fold == 0:
+        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
+    print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
+
+    # the training set as row indices into X (and acute_X), in the same order as run_regression's X_train
+    segments = [(X, train_id)]
+    y_train = Y[train_id]
+    group_train, group_test = subIDs[train_id], subIDs[test_id]
+    if acute is not None:
+        acute_X, acute_Y, acute_subIDs = acute
+        print('Acute data incorporated into training set.')
+        segments.append((acute_X, np.arange(acute_X.shape[0])))
+        y_train = np.concatenate((y_train, acute_Y),axis=0)
+        group_train = np.concatenate((group_train, acute_subIDs), axis=0)
+    seg_id = np.concatenate([np.full(len(rows), s) for s, (_, rows) in enumerate(segments)])
+    seg_row = np.concatenate([rows for _, rows in segments])
+    positions = np.arange(len(seg_id))
+
+    print('Size of test: {}'.format(test_id.shape[0]))
+    print('Size of train: {}'.format(len(positions)))
+
+    # inner loop: score every alpha on every inner fold. With more features than subjects, the dual form is used: only
+    # n x n kernels are kept, instead of the p x p X'X. The fold runs in one process, so it gets the
+    # BLAS threads of the grid search workers it replaces (see get_path_search_threads)
+    with threadpool_limits(limits=get_path_search_threads(n_grid_jobs, blas_threads)):
+        inner_cv = create_inner_cv(inner_cv_id,n)
+        inner_splits = list(inner_cv.split(np.zeros((len(positions), 1)), y_train, group_train))
+        dual = X.shape[1] > len(positions)
+        if dual:
+            kernels, x_means, x_scales = accumulate_fold_kernels(segments, seg_id, seg_row, positions,
+                                                                 [inner_train for inner_train, _ in inner_splits] + [np.arange(len(positions))], chunk_size)
+        else:
+            train_stats = accumulate_ridge_stats(segments, seg_id, seg_row, y_train, positions, chunk_size)
+        inner_scores = []
+        for i, (inner_train, inner_test) in enumerate(inner_splits):
+            if dual:
+                K = kernels[i]
+                y_pred = predict_kernel_ridge_path(K[np.ix_(inner_train, inner_train)], K[np.ix_(inner_test, inner_train)], y_train[inner_train], alphas)
+            else:
+                fold_stats = accumulate_ridge_stats(segments, seg_id, seg_row, y_train, inner_test, chunk_size)
+                coefs, intercepts = solve_ridge_path(subtract_ridge_stats(train_stats, fold_stats), alphas)
+                y_pred = predict_row_chunks(segments, seg_id, seg_row, inner_test, coefs, intercepts, chunk_size)
+            residuals = y_train[inner_test][:, None] - y_pred
+            inner_scores.append(1 - np.var(residuals, axis=0)/np.var(y_train[inner_test]))
+        best = np.argmax(np.mean(inner_scores, axis=0))
+        print('Best alpha: {}'.format(alphas[best]))
+
+        # fit best model to full training set
+        if dual:
+            coefs, intercepts = solve_ridge_dual(segments, seg_id, seg_row, y_train, positions, kernels[-1], x_means[-1], x_scales[-1], alphas[best], chunk_size)
+        else:
+            coefs, intercepts = solve_ridge_path(train_stats, alphas[best:best + 1])
+    mdl = OutOfCoreRidge(coefs[:, 0], intercepts[0], alphas[best], chunk_size)
+
+    if chaco_type == 'chacoconn':
+        nROIs = int(round((1 + np.sqrt(1 + 8*X.shape[1]))/2))
+        beta_coeffs = np.zeros((nROIs, nROIs))
+        beta_coeffs[np.triu_indices(nROIs, k=1)] = mdl.coef_
+    else:
+        beta_coeffs = mdl.coef_
+
+    # predict scores in the test set
+    y_test = Y[test_id]
+    y_pred = predict_row_chunks([(X, test_id)], np.zeros(len(test_id), dtype=int), test_id, np.arange(len(test_id)), coefs, intercepts, chunk_size)[:, 0]
+
+    expl=explained_variance_score(y_test, y_pred)
+    correlation = np_pearson_cor(y_test,y_pred)[0]
+
+    print('R^2 score: {} '.format(np.round(expl, 3)))
+    print('Correlation: {} '.format(np.round(correlation[0], 3)))
+    print('\n')
+
+    return {'perm': n, 'fold': cv_fold, 'explained_var': expl, 'correlation': correlation, 'beta_coeffs': beta_coeffs,
+            'size_testgroup': group_test.shape[0], 'model': mdl if save_models else None}
+
+
+def run_regression_ensemble(X1, C, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null,output_folder, acute_data, n_outer_jobs=1, n_grid_jobs=10, blas_threads=None, search_modes=None):
     X2 = C
 
             
@@ -717,6 +1293,7 @@ def run_regression_ensemble(X1, C, Y, subIDs, inner_cv_id, outer_cv_id, model_te
     outer_cv = create_outer_cv(outer_cv_id)
 
     outer_cv_splits = outer_cv.get_n_splits(X1, Y, subIDs)
+    mdl, mdl_label1 = get_models('regression', model_tested) 
     
     models = np.zeros((1, outer_cv_splits), dtype=object)
     explained_var  = np.zeros((1,outer_cv_splits), dtype=object)
@@ -724,78 +1301,24 @@ def run_regression_ensemble(X1, C, Y, subIDs, inner_cv_id, outer_cv_id, model_te
     correlations_ensemble  = np.zeros((1,outer_cv_splits), dtype=object)
     mean_abs_error = np.zeros((1,outer_cv_splits), dtype=object)
 
-    size_testgroup =[]
-    for n in range(0,nperms):
-        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
-        
-        for cv_fold, (train_id, test_id) in enumerate(outer_cv.split(X1, Y, subIDs)):
-            inner_cv = create_inner_cv(inner_cv_id,n)
-
-            print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
-            
-            X1_train, X1_test = X1[train_id], X1[test_id]
-            X2_train, X2_test = X2[train_id], X2[test_id]
-
-            y_train, y_test = Y[train_id], Y[test_id]
-            group_train, group_test = subIDs[train_id], subIDs[test_id]
-
-            if acute_data:
-                print('Acute data incorporated into training set.')
-                X1_train = np.concatenate((X1_train, acute_X1),axis=0)
-                X2_train = np.concatenate((X2_train, acute_X2),axis=0)
+    acute = None
+    if acute_data:
+        acute = (acute_X1, acute_X2, acute_Y)
 
-                y_train = np.concatenate((y_train, acute_Y),axis=0)
-                group_train = np.concatenate((group_train,acute_Y))
-            
-            print('Size of test group: {}'.format(group_test.shape[0]))
-            print('Size of train group: {}'.format(group_train.shape[0]))
-            print('Number of sites in test set: {}\n'.format(np.unique(group_test).shape[0]))            
+    size_testgroup =[]
+    units = get_outer_units(X1, Y, subIDs, outer_cv_id, nperms)
+    results = run_outer_units(fit_ensemble_demog_fold, units, n_outer_jobs, blas_threads, n_grid_jobs=n_grid_jobs, search_modes=search_modes, X1=X1, X2=X2, Y=Y, subIDs=subIDs, acute=acute, inner_cv_id=inner_cv_id,
+                              model_tested=model_tested, save_models=save_models, outer_cv_splits=outer_cv_splits, nperms=nperms)
 
-            size_testgroup.append(group_test.shape[0])
-            
-            mdl_idx=0
-            print(model_tested)
-            mdl, mdl_label1 = get_models('regression', model_tested) 
-            
-            # first model: X1 (lesion data)
-            print('~~ Running model 1: lesion info ~~~')
-            mdl1 = inner_loop(mdl, mdl_label1, X1_train, y_train, group_train, inner_cv, 10)  
-            mdl1.fit(X1_train, y_train)
-            y1_pred= mdl1.predict(X1_test)
-                
-            print('~~ Running model 2: demographics ~~~')
-            # second model: demographic data
-            mdl, mdl_label = get_models('regression', 'linear_regression')
-            mdl = inner_loop(mdl, mdl_label, X2_train, y_train, group_train, inner_cv, 10)
-            mdl.fit(X2_train, y_train)
-            y2_pred= mdl.predict(X2_test)
-        
-            
-            avg_pred = np.mean([y1_pred, y2_pred], axis=0)
-            expl=explained_variance_score(y_test, avg_pred)
-            filename = '{}_{}_{}_{}_{}_crossval{}_perm{}_ensemble_demog'.format(atlas, y_var, chaco_type, subset, mdl_label1,crossval_type,n)
-            
-            correlations_ensemble[mdl_idx, cv_fold] = np_pearson_cor(y_test,avg_pred)[0]
- 
-            
-   
-            
-            explained_var[mdl_idx, cv_fold] =explained_variance_score(y_test, avg_pred)
-
-            print('\n')
-            print('R^2 score (ensemble): {} '.format(np.round(explained_variance_score(y_test, avg_pred), 3)))
-            print('Correlation (ensemble): {} '.format(np.round(np_pearson_cor(y_test,avg_pred)[0][0], 3)))
-            print('\n')
-            print('Corr chaco only: {} '.format(np.round(np_pearson_cor(y_test, y1_pred)[0][0], 3)))
-            print('Corr demog only: {} '.format(np.round(np_pearson_cor(y_test, y2_pred)[0][0], 3)))
-            print('\n')
-            explained_var[mdl_idx, cv_fold]=expl
+    for n in range(0,nperms):
+        for result in get_perm_results(results, n):
+            correlations_ensemble[0, result['fold']] = result['correlation']
+            explained_var[0, result['fold']] = result['explained_var']
+            size_testgroup.append(result['size_testgroup'])
             if save_models:
-                models[mdl_idx, cv_fold] = mdl1
-                
-            mdl_idx += 1
-
+                models[0, result['fold']] = result['model']
 
+        filename = '{}_{}_{}_{}_{}_crossval{}_perm{}_ensemble_demog'.format(atlas, y_var, chaco_type, subset, mdl_label1,crossval_type,n)
         if null>0:
             print('NULL!')
             filename = filename + '_null_' + str(null)
@@ -804,10 +1327,70 @@ def run_regression_ensemble(X1, C, Y, subIDs, inner_cv_id, outer_cv_id, model_te
         np.save(os.path.join(results_path, output_folder,filename + "_scores.npy"), explained_var)
         np.save(os.path.join(results_path,output_folder, filename + "_model.npy"), models)
         np.save(os.path.join(results_path,output_folder, filename +"_correlations_ensemble.npy"), correlations_ensemble)
-        np.save(os.path.join(results_path,output_folder, filename + "_model_labels.npy"), mdl_label)
+        np.save(os.path.join(results_path,output_folder, filename + "_model_labels.npy"), 'linear_regression')
         np.save(os.path.join(results_path, output_folder,filename + "_test_group_sizes.npy"), size_testgroup)
 
-def run_regression_chaco_ll(X1, X2, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null,output_folder,ensemble_atlas,chaco_model_tested,acute_data):
+def fit_ensemble_demog_fold(unit, X1, X2, Y, subIDs, acute, inner_cv_id, model_tested, save_models, outer_cv_splits, nperms, n_grid_jobs=10, blas_threads=None, search_modes=None):
+    # One (permutation, outer fold) unit of run_regression_ensemble: lesion model (X1) and demographics model (X2), whose
+    # test set predictions are averaged.
+    n, cv_fold, train_id, test_id = unit
+    if cv_fold == 0:
+        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
+    inner_cv = create_inner_cv(inner_cv_id,n)
+
+    print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
+    
+    X1_train, X1_test = X1[train_id], X1[test_id]
+    X2_train, X2_test = X2[train_id], X2[test_id]
+
+    y_train, y_test = Y[train_id], Y[test_id]
+    group_train, group_test = subIDs[train_id], subIDs[test_id]
+
+    if acute is not None:
+        acute_X1, acute_X2, acute_Y = acute
+        print('Acute data incorporated into training set.')
+        X1_train = stack_rows(X1_train, acute_X1)
+        X2_train = np.concatenate((X2_train, acute_X2),axis=0)
+
+        y_train = np.concatenate((y_train, acute_Y),axis=0)
+        group_train = np.concatenate((group_train,acute_Y))
+    
+    print('Size of test group: {}'.format(group_test.shape[0]))
+    print('Size of train group: {}'.format(group_train.shape[0]))
+    print('Number of sites in test set: {}\n'.format(np.unique(group_test).shape[0]))            
+
+    print(model_tested)
+    mdl, mdl_label1 = get_models('regression', model_tested) 
+    
+    # first model: X1 (lesion data)
+    print('~~ Running model 1: lesion info ~~~')
+    mdl1, _ = inner_loop(mdl, mdl_label1, X1_train, y_train, group_train, inner_cv, n_grid_jobs, blas_threads, get_search_mode(search_modes, mdl_label1))  
+    mdl1.fit(X1_train, y_train)
+    y1_pred= mdl1.predict(X1_test)
+        
+    print('~~ Running model 2: demographics ~~~')
+    # second model: demographic data
+    mdl, mdl_label = get_models('regression', 'linear_regression')
+    mdl, _ = inner_loop(mdl, mdl_label, X2_train, y_train, group_train, inner_cv, n_grid_jobs, blas_threads, get_search_mode(search_modes, mdl_label))
+    mdl.fit(X2_train, y_train)
+    y2_pred= mdl.predict(X2_test)
+
+    
+    avg_pred = np.mean([y1_pred, y2_pred], axis=0)
+    expl=explained_variance_score(y_test, avg_pred)
+
+    print('\n')
+    print('R^2 score (ensemble): {} '.format(np.round(expl, 3)))
+    print('Correlation (ensemble): {} '.format(np.round(np_pearson_cor(y_test,avg_pred)[0][0], 3)))
+    print('\n')
+    print('Corr chaco only: {} '.format(np.round(np_pearson_cor(y_test, y1_pred)[0][0], 3)))
+    print('Corr demog only: {} '.format(np.round(np_pearson_cor(y_test, y2_pred)[0][0], 3)))
+    print('\n')
+
+    return {'perm': n, 'fold': cv_fold, 'explained_var': expl, 'correlation': np_pearson_cor(y_test,avg_pred)[0],
+            'size_testgroup': group_test.shape[0], 'model': mdl1 if save_models else None}
+
+def run_regression_chaco_ll(X1, X2, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null,output_folder,ensemble_atlas,chaco_model_tested,acute_data, n_outer_jobs=1, n_grid_jobs=10, blas_threads=None, search_modes=None):
     print(acute_data)
     if atlas =='lesionload_m1':
         X1=np.array(X1).reshape(-1,1)
@@ -840,6 +1423,8 @@ def run_regression_chaco_ll(X1, X2, Y, subIDs, inner_cv_id, outer_cv_id, model_t
     outer_cv = create_outer_cv(outer_cv_id)
 
     outer_cv_splits = outer_cv.get_n_splits(X1, Y, subIDs)
+    mdl, mdl_label1 = get_models('regression', model_tested) 
+    mdl, mdl_label2 = get_models('regression', chaco_model_tested)
     
     models = np.zeros((1, outer_cv_splits), dtype=object)
     explained_var  = np.zeros((1,outer_cv_splits), dtype=object)
@@ -847,83 +1432,24 @@ def run_regression_chaco_ll(X1, X2, Y, subIDs, inner_cv_id, outer_cv_id, model_t
     correlations_ensemble  = np.zeros((1,outer_cv_splits), dtype=object)
     mean_abs_error = np.zeros((1,outer_cv_splits), dtype=object)
     size_testgroup =[]
-    
-    for n in range(0,nperms):
-        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
-        
-        for cv_fold, (train_id, test_id) in enumerate(outer_cv.split(X1, Y, subIDs)):
-            inner_cv = create_inner_cv(inner_cv_id,n)
-
-            print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
-            
-            X1_train, X1_test = X1[train_id], X1[test_id]
-            X2_train, X2_test = X2[train_id], X2[test_id]
-            group_train, group_test = subIDs[train_id], subIDs[test_id]
-
-            y_train, y_test = Y[train_id], Y[test_id]
-            if acute_data:
-                print('Acute data incorporated into training set.')
-                X1_train = np.concatenate((X1_train, acute_X1),axis=0)
-                X2_train = np.concatenate((X2_train, acute_X2),axis=0)
-                group_train = np.concatenate((group_train,acute_Y), axis=0)
-                y_train = np.concatenate((y_train, acute_Y),axis=0)
-                
-            print(X2_train.shape)
-
-            print('Size of test group: {}'.format(group_test.shape[0]))
-            print('Size of train group: {}'.format(group_train.shape[0]))
-            print('Number of sites in test set: {}\n'.format(np.unique(group_test).shape[0]))            
-
-            size_testgroup.append(group_test.shape[0])
-            
-            mdl_idx=0
-            mdl, mdl_label1 = get_models('regression', model_tested) 
-            
-            # first model: X1 (lesion data)
-            print('~~ Running model 1: lesion info ~~~')
-   
-            mdl1 = inner_loop(mdl, mdl_label1, X1_train, y_train, group_train, inner_cv, 10)  
-            mdl1.fit(X1_train, y_train)
-            y1_pred= mdl1.predict(X1_test)
-                
-            print('~~ Running model 2: chaco ~~~')
-            # second model: X2 (chaco data)
-            mdl, mdl_label2 = get_models('regression', chaco_model_tested)
-     
-            mdl = inner_loop(mdl, mdl_label2, X2_train, y_train, group_train, inner_cv, 10)
-            mdl.fit(X2_train, y_train)
-            y2_pred= mdl.predict(X2_test)
-            
-            print(X2.shape[1])
-            if X2.shape[1] == 86:
-                chacoatlas = 'fs86subj'
-            elif X2.shape[1] == 268:
-                chacoatlas= 'shen268'
-            
-            avg_pred = np.mean([y1_pred, y2_pred], axis=0)
-            expl=explained_variance_score(y_test, avg_pred)
-            filename = '{}_{}_{}_{}_{}_crossval{}_perm{}_ensemble_chacoLL_{}_{}'.format(atlas, y_var, chaco_type, subset, mdl_label1,crossval_type,n, ensemble_atlas,mdl_label2)
-            
-            #variable_importance.append(mdl.named_steps[mdl_label].coef_)
-            correlations_ensemble[mdl_idx, cv_fold] = np_pearson_cor(y_test,avg_pred)[0]
 
-            explained_var[mdl_idx, cv_fold] =explained_variance_score(y_test, avg_pred)
+    acute = None
+    if acute_data:
+        acute = (acute_X1, acute_X2, acute_Y)
 
-            print('\n')
-            print('R^2 score (ensemble): {} '.format(np.round(explained_variance_score(y_test, avg_pred), 3)))
-            print('Correlation (ensemble): {} '.format(np.round(np_pearson_cor(y_test,avg_pred)[0][0], 3)))
-            print('\n')
-            print('Corr lesion only: {} '.format(np.round(np_pearson_cor(y_test, y1_pred)[0][0], 3)))
-            print('Corr ChaCo only: {} '.format(np.round(np_pearson_cor(y_test, y2_pred)[0][0], 3)))
-            
-            print('\n')
-            explained_var[mdl_idx, cv_fold]=expl
+    units = get_outer_units(X1, Y, subIDs, outer_cv_id, nperms)
+    results = run_outer_units(fit_chaco_ll_fold, units, n_outer_jobs, blas_threads, n_grid_jobs=n_grid_jobs, search_modes=search_modes, X1=X1, X2=X2, X3=None, Y=Y, subIDs=subIDs, acute=acute, inner_cv_id=inner_cv_id,
+                              model_tested=model_tested, chaco_model_tested=chaco_model_tested, save_models=save_models, outer_cv_splits=outer_cv_splits, nperms=nperms)
+    
+    for n in range(0,nperms):
+        for result in get_perm_results(results, n):
+            correlations_ensemble[0, result['fold']] = result['correlation']
+            explained_var[0, result['fold']] = result['explained_var']
+            size_testgroup.append(result['size_testgroup'])
             if save_models:
-                models[mdl_idx, cv_fold] = mdl1
-                
-            mdl_idx += 1
-
+                models[0, result['fold']] = result['model']
 
+        filename = '{}_{}_{}_{}_{}_crossval{}_perm{}_ensemble_chacoLL_{}_{}'.format(atlas, y_var, chaco_type, subset, mdl_label1,crossval_type,n, ensemble_atlas,mdl_label2)
         if null>0:
             print('NULL!')
             filename = filename + '_null_' + str(null)
@@ -934,8 +1460,83 @@ def run_regression_chaco_ll(X1, X2, Y, subIDs, inner_cv_id, outer_cv_id, model_t
         np.save(os.path.join(results_path,output_folder, filename + "_model_labels.npy"), mdl_label1)
         np.save(os.path.join(results_path, output_folder,filename + "_test_group_sizes.npy"), size_testgroup)
 
+def fit_chaco_ll_fold(unit, X1, X2, X3, Y, subIDs, acute, inner_cv_id, model_tested, chaco_model_tested, save_models, outer_cv_splits, nperms, n_grid_jobs=10, blas_threads=None, search_modes=None):
+    # One (permutation, outer fold) unit of run_regression_chaco_ll (X3 None) and run_regression_chaco_ll_demog: lesion load
+    # model (X1), ChaCo model (X2) and, if X3 is given, demographics model (X3), whose test set predictions are averaged.
+    n, cv_fold, train_id, test_id = unit
+    if cv_fold == 0:
+        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
+    inner_cv = create_inner_cv(inner_cv_id,n)
+
+    print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
+    
+    X1_train, X1_test = X1[train_id], X1[test_id]
+    X2_train, X2_test = X2[train_id], X2[test_id]
+    if X3 is not None:
+        X3_train, X3_test = X3[train_id], X3[test_id]
+    group_train, group_test = subIDs[train_id], subIDs[test_id]
+
+    y_train, y_test = Y[train_id], Y[test_id]
+    if acute is not None:
+        print('Acute data incorporated into training set.')
+        X1_train = np.concatenate((X1_train, acute[0]),axis=0)
+        X2_train = stack_rows(X2_train, acute[1])
+        group_train = np.concatenate((group_train,acute[2]), axis=0)
+        y_train = np.concatenate((y_train, acute[2]),axis=0)
+        if X3 is not None:
+            X3_train = np.concatenate((X3_train, acute[3]))
+        
+    print(X2_train.shape)
+
+    print('Size of test group: {}'.format(group_test.shape[0]))
+    print('Size of train group: {}'.format(group_train.shape[0]))
+    print('Number of sites in test set: {}\n'.format(np.unique(group_test).shape[0]))            
+
+    mdl, mdl_label1 = get_models('regression', model_tested) 
+    
+    # first model: X1 (lesion data)
+    print('~~ Running model 1: lesion info ~~~')
+
+    mdl1, _ = inner_loop(mdl, mdl_label1, X1_train, y_train, group_train, inner_cv, n_grid_jobs, blas_threads, get_search_mode(search_modes, mdl_label1))  
+    mdl1.fit(X1_train, y_train)
+    y1_pred= mdl1.predict(X1_test)
+        
+    print('~~ Running model 2: chaco ~~~')
+    # second model: X2 (chaco data)
+    mdl, mdl_label2 = get_models('regression', chaco_model_tested)
+
+    mdl, _ = inner_loop(mdl, mdl_label2, X2_train, y_train, group_train, inner_cv, n_grid_jobs, blas_threads, get_search_mode(search_modes, mdl_label2))
+    mdl.fit(X2_train, y_train)
+    y2_pred= mdl.predict(X2_test)
+    preds = [y1_pred, y2_pred]
+
+    if X3 is not None:
+        print('~~ Running model 3: demographics ~~~')
+        # third model: demographic data
+        mdl, mdl_label3 = get_models('regression', 'linear_regression')
+        mdl, _ = inner_loop(mdl, mdl_label3, X3_train, y_train, group_train, inner_cv, n_grid_jobs, blas_threads, get_search_mode(search_modes, mdl_label3))
+        mdl.fit(X3_train, y_train)
+        y3_pred= mdl.predict(X3_test)
+        preds.append(y3_pred)
+    
+    avg_pred = np.mean(preds, axis=0)
+    expl=explained_variance_score(y_test, avg_pred)
+
+    print('\n')
+    print('R^2 score (ensemble): {} '.format(np.round(expl, 3)))
+    print('Correlation (ensemble): {} '.format(np.round(np_pearson_cor(y_test,avg_pred)[0][0], 3)))
+    print('\n')
+    print('Corr lesion only: {} '.format(np.round(np_pearson_cor(y_test, y1_pred)[0][0], 3)))
+    print('Corr ChaCo only: {} '.format(np.round(np_pearson_cor(y_test, y2_pred)[0][0], 3)))
+    if X3 is not None:
+        print('Corr demog only: {} '.format(np.round(np_pearson_cor(y_test, y3_pred)[0][0], 3)))
+    print('\n')
+
+    return {'perm': n, 'fold': cv_fold, 'explained_var': expl, 'correlation': np_pearson_cor(y_test,avg_pred)[0],
+            'size_testgroup': group_test.shape[0], 'model': mdl1 if save_models else None}
+
 
-def run_regression_chaco_ll_demog(X1, X2, C, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null,output_folder,ensemble_atlas,chaco_model_tested,acute_data):
+def run_regression_chaco_ll_demog(X1, X2, C, Y, subIDs, inner_cv_id, outer_cv_id, model_tested, atlas, y_var, chaco_type, subset, save_models,results_path,crossval_type,nperms,null,output_folder,ensemble_atlas,chaco_model_tested,acute_data, n_outer_jobs=1, n_grid_jobs=10, blas_threads=None, search_modes=None):
     
     # X1 = lesion load 
     # X2 = chaco scores
@@ -969,98 +1570,32 @@ def run_regression_chaco_ll_demog(X1, X2, C, Y, subIDs, inner_cv_id, outer_cv_id
     outer_cv = create_outer_cv(outer_cv_id)
 
     outer_cv_splits = outer_cv.get_n_splits(X1, Y, subIDs)
+    mdl, mdl_label = get_models('regression', model_tested) 
+    mdl, mdl_label2 = get_models('regression', chaco_model_tested)
     
     models = np.zeros((1, outer_cv_splits), dtype=object)
     explained_var  = np.zeros((1,outer_cv_splits), dtype=object)
     correlations_ensemble  = np.zeros((1,outer_cv_splits), dtype=object)
     mean_abs_error = np.zeros((1,outer_cv_splits), dtype=object)
     size_testgroup =[]
+
+    acute = None
+    if acute_data:
+        acute = (acute_X1, acute_X2, acute_Y, acute_C)
+
+    units = get_outer_units(X1, Y, subIDs, outer_cv_id, nperms)
+    results = run_outer_units(fit_chaco_ll_fold, units, n_outer_jobs, blas_threads, n_grid_jobs=n_grid_jobs, search_modes=search_modes, X1=X1, X2=X2, X3=X3, Y=Y, subIDs=subIDs, acute=acute, inner_cv_id=inner_cv_id,
+                              model_tested=model_tested, chaco_model_tested=chaco_model_tested, save_models=save_models, outer_cv_splits=outer_cv_splits, nperms=nperms)
     
     for n in range(0,nperms):
-        print('\n\n~ ~ ~ ~ ~ ~ ~ ~ ~ ~ PERMUTATION: {}/{} ~ ~ ~ ~ ~ ~ ~ ~ ~ \n\n'.format(n, nperms))
-        
-        for cv_fold, (train_id, test_id) in enumerate(outer_cv.split(X1, Y, subIDs)):
-            inner_cv = create_inner_cv(inner_cv_id,n)
-
-            print("------ Outer Fold: {}/{} ------".format(cv_fold + 1, outer_cv_splits))
-            
-            X1_train, X1_test = X1[train_id], X1[test_id]
-            X2_train, X2_test = X2[train_id], X2[test_id]
-            X3_train, X3_test = X3[train_id], X3[test_id]
-            y_train, y_test = Y[train_id], Y[test_id]
-            group_train, group_test = subIDs[train_id], subIDs[test_id]
-
-            if acute_data:
-                print('Acute data incorporated into training set.')
-                X1_train = np.concatenate((X1_train, acute_X1))
-                X2_train = np.concatenate((X2_train, acute_X2))
-                X3_train = np.concatenate((X3_train, acute_C))
-                group_train = np.concatenate((group_train, acute_Y))
-                y_train = np.concatenate((y_train, acute_Y))            
-                
-                
-            print(X1_train.shape[0])
-            print(X1_train.shape[1])
-            print(X2_train.shape[1])
-            print('Size of test group: {}'.format(group_test.shape[0]))
-            print('Size of train group: {}'.format(group_train.shape[0]))
-            print('Number of sites in test set: {}\n'.format(np.unique(group_test).shape[0]))            
-
-            size_testgroup.append(group_test.shape[0])
-            
-            mdl_idx=0
-            mdl, mdl_label = get_models('regression', model_tested) 
-                
-            # first model: X1 (lesion data)
-            print('~~ Running model 1: lesion info ~~~')
-            mdl1 = inner_loop(mdl, mdl_label, X1_train, y_train, group_train, inner_cv, 10)  
-            mdl1.fit(X1_train, y_train)
-            y1_pred= mdl1.predict(X1_test)
-                
-            print('~~ Running model 2: chaco ~~~')
-            # second model: X2 (chaco data)
-            mdl, mdl_label2 = get_models('regression', chaco_model_tested)
-            mdl = inner_loop(mdl, mdl_label2, X2_train, y_train, group_train, inner_cv, 10)
-            mdl.fit(X2_train, y_train)
-            y2_pred= mdl.predict(X2_test)
-                
-            print('~~ Running model 3: demographics ~~~')
-            # third model: demographic data
-            mdl, mdl_label3 = get_models('regression', 'linear_regression')
-            mdl = inner_loop(mdl, mdl_label3, X3_train, y_train, group_train, inner_cv, 10)
-            mdl.fit(X3_train, y_train)
-            y3_pred= mdl.predict(X3_test)
-                   
-            if X2.shape[1] == 86:
-                chacoatlas = 'fs86subj'
-            elif X2.shape[1] == 268:
-                chacoatlas= 'shen268'
-            
-            avg_pred = np.mean([y1_pred, y2_pred, y3_pred], axis=0)
-            expl=explained_variance_score(y_test, avg_pred)
-            filename = '{}_{}_{}_{}_{}_crossval{}_perm{}_ensemble_chacoLLdemog_{}_{}'.format(atlas, y_var, chaco_type, subset, mdl_label,crossval_type,n, ensemble_atlas,mdl_label2)
- 
-            #variable_importance.append(mdl.named_steps[mdl_label].coef_)
-            correlations_ensemble[mdl_idx, cv_fold] = np_pearson_cor(y_test,avg_pred)[0]
-
-            explained_var[mdl_idx, cv_fold] =explained_variance_score(y_test, avg_pred)
-
-            print('\n')
-            print('R^2 score (ensemble): {} '.format(np.round(explained_variance_score(y_test, avg_pred), 3)))
-            print('Correlation (ensemble): {} '.format(np.round(np_pearson_cor(y_test,avg_pred)[0][0], 3)))
-            print('\n')
-            print('Corr lesion only: {} '.format(np.round(np_pearson_cor(y_test, y1_pred)[0][0], 3)))
-            print('Corr ChaCo only: {} '.format(np.round(np_pearson_cor(y_test, y2_pred)[0][0], 3)))
-            print('Corr demog only: {} '.format(np.round(np_pearson_cor(y_test, y3_pred)[0][0], 3)))
-            print('\n')
-            
-            explained_var[mdl_idx, cv_fold]=expl
+        for result in get_perm_results(results, n):
+            correlations_ensemble[0, result['fold']] = result['correlation']
+            explained_var[0, result['fold']] = result['explained_var']
+            size_testgroup.append(result['size_testgroup'])
             if save_models:
-                models[mdl_idx, cv_fold] = mdl1
-                
-            mdl_idx += 1
-
+                models[0, result['fold']] = result['model']
 
+        filename = '{}_{}_{}_{}_{}_crossval{}_perm{}_ensemble_chacoLLdemog_{}_{}'.format(atlas, y_var, chaco_type, subset, mdl_label,crossval_type,n, ensemble_atlas,mdl_label2)
         if null>0:
             print('NULL!')
             filename = filename + '_null_' + str(null)
@@ -1093,10 +1628,16 @@ def set_vars_for_ll(lesionload_type):
     return atlas, model_tested, chaco_type
         
 
-def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null, ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model):
+def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null, ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model,core_budget=None,search_modes=None):
     # This function sets up the parameters for a machine learning model.
     # The function sets up the cross-validation method to be used based on the crossval input. 
     # Finally, it runs a machine learning regression using the specified parameters.
+    # core_budget: how the cores are split between (permutation, outer fold) units, grid search workers and BLAS threads
+    # (see get_core_budget). None keeps the defaults: units run one at a time, 10 grid search workers.
+    # search_modes: inner loop search mode per model (see get_search_mode). None: full grid search for every model.
+    if core_budget is None:
+        core_budget = {'n_outer_jobs': 1, 'n_grid_jobs': 10, 'blas_threads': None}
+    run_options = dict(core_budget, search_modes=search_modes)
     
     if crossval == '1':
         print('1. Outer CV: Random partition fixed fold sizes, Inner CV: Random partition fixed fold sizes')
@@ -1131,9 +1672,11 @@ def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y
             if final_model=='true':
                 print('afdkljasfd')
                 run_regression_final(**kwargs)
+            elif model_tested == 'ridge_outofcore':
+                run_regression_out_of_core(**kwargs, **run_options)
             else:
                
-                run_regression(**kwargs)
+                run_regression(**kwargs, **run_options)
             
         elif lesionload_type =='M1':
             atlas = 'lesionload_m1'
@@ -1141,28 +1684,28 @@ def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y
             chaco_type ='NA'
             kwargs = {'x':lesionload, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression(**kwargs)            
+            run_regression(**kwargs, **run_options)            
         elif lesionload_type =='all':
             atlas = 'lesionload_all'
             model_tested = 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'x':lesionload, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression(**kwargs) 
+            run_regression(**kwargs, **run_options) 
         elif lesionload_type =='all_2h':
             atlas = 'lesionload_all_2h'
             model_tested = 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'x':lesionload, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression(**kwargs) 
+            run_regression(**kwargs, **run_options) 
         elif lesionload_type =='slnm':
             atlas = 'lesionload_slnm'
             model_tested = 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'x':lesionload, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression(**kwargs) 
+            run_regression(**kwargs, **run_options) 
             
     elif ensemble == 'demog':
         print('\n Running ensemble model with demog. \n')
@@ -1171,35 +1714,35 @@ def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y
             print('running demog')
             kwargs = {'X1':X, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression_ensemble(**kwargs)            
+            run_regression_ensemble(**kwargs, **run_options)            
         elif lesionload_type =='M1':
             atlas = 'lesionload_m1'
             model_tested = 'linear_regression'
             chaco_type = 'NA'
             kwargs = {'X1':lesionload, 'C':C, 'Y':Y, 'subIDs':subIDs, 'model_tested':model_tested, 'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression_ensemble(**kwargs)
+            run_regression_ensemble(**kwargs, **run_options)
         elif lesionload_type =='all':
             atlas = 'lesionload_all'
             model_tested= 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression_ensemble(**kwargs)
+            run_regression_ensemble(**kwargs, **run_options)
         elif lesionload_type =='all_2h':
             atlas = 'lesionload_all_2h'
             model_tested= 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression_ensemble(**kwargs)
+            run_regression_ensemble(**kwargs, **run_options)
         elif lesionload_type =='slnm':
             atlas = 'lesionload_slnm'
             model_tested= 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'acute_data':acute_data}
-            run_regression_ensemble(**kwargs)
+            run_regression_ensemble(**kwargs, **run_options)
             
     elif ensemble == 'chaco_ll':
         print('\n Running ensemble model with ChaCo scores AND lesion loads.. \n')
@@ -1209,28 +1752,28 @@ def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y
             chaco_type = 'NA'
             kwargs = {'X1':lesionload, 'X2':X, 'Y':Y, 'subIDs':subIDs, 'model_tested':model_tested, 'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll(**kwargs)
+            run_regression_chaco_ll(**kwargs, **run_options)
         elif lesionload_type =='all':
             atlas = 'lesionload_all'
             model_tested= model_tested
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'X2':X, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll(**kwargs)
+            run_regression_chaco_ll(**kwargs, **run_options)
         elif lesionload_type =='all_2h':
             atlas = 'lesionload_all_2h'
             model_tested= model_tested
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'X2':X, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll(**kwargs)
+            run_regression_chaco_ll(**kwargs, **run_options)
         elif lesionload_type =='slnm':
             atlas = 'lesionload_slnm'
             model_tested= model_tested
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'X2':X, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll(**kwargs)
+            run_regression_chaco_ll(**kwargs, **run_options)
             
     elif ensemble == 'chaco_ll_demog':
         print('\n Running ensemble model with ChaCo scores AND lesion loads AND demographics.. \n')
@@ -1240,28 +1783,28 @@ def set_up_and_run_model(crossval, model_tested,lesionload,lesionload_type, X, Y
             chaco_type = 'NA'
             kwargs = {'X1':lesionload, 'X2':X, 'C':C, 'Y':Y, 'subIDs':subIDs, 'model_tested':model_tested, 'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll_demog(**kwargs)
+            run_regression_chaco_ll_demog(**kwargs, **run_options)
         elif lesionload_type =='all':
             atlas = 'lesionload_all'
             model_tested= 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'X2':X, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll_demog(**kwargs)
+            run_regression_chaco_ll_demog(**kwargs, **run_options)
         elif lesionload_type =='all_2h':
             atlas = 'lesionload_all_2h'
             model_tested= 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'X2':X, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll_demog(**kwargs)
+            run_regression_chaco_ll_demog(**kwargs, **run_options)
         elif lesionload_type =='slnm':
             atlas = 'lesionload_slnm'
             model_tested= 'ridge_nofeatselect'
             chaco_type ='NA'
             kwargs = {'X1':lesionload, 'X2':X, 'C':C, 'Y':Y, 'subIDs':subIDs,  'model_tested':model_tested,'inner_cv_id':inner_cv_id, 'outer_cv_id':outer_cv_id, 'atlas':atlas, 'y_var':y_var, 'chaco_type':chaco_type, 'subset':subset,\
                 'save_models':save_models, 'results_path':results_path, 'crossval_type':crossval, 'nperms':nperms, 'null':null, 'output_folder':output_folder, 'ensemble_atlas':ensemble_atlas, 'chaco_model_tested':chaco_model_tested,'acute_data':acute_data}
-            run_regression_chaco_ll_demog(**kwargs)
+            run_regression_chaco_ll_demog(**kwargs, **run_options)
           
 def save_model_outputs(results_path, output_folder, atlas, y_var, chaco_type, subset, model_tested, crossval, nperms, ensemble,n_outer_folds,ensemble_atlas,chaco_model_tested=None):
     # This function is a helper function for saving the outputs of a machine learning model. It takes a number of 
@@ -1297,7 +1840,7 @@ def save_model_outputs(results_path, output_folder, atlas, y_var, chaco_type, su
             betas_allperms = np.empty(shape=(0, 86, 86))
         if atlas == 'shen268':
             betas_allperms = np.empty(shape=(0, 268, 268))
-    elif chaco_type=='chacovol':
+    elif chaco_type=='chacovol' or chaco_type=='lesionoverlap':
         if atlas == 'fs86subj':
             betas_allperms =np.zeros(shape=(100,5,86))
 
@@ -0,0 +1,448 @@
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import scipy.sparse as sp
+
+# Lesion loads (overlap of a lesion mask with tract/network templates), as used by create_data_set(ll=...).
+# Replaces data_processing/SMATT_lesion_load.ipynb, LBM_lesionload.ipynb and sLNM_lesion_load.ipynb: all templates are
+# loaded once into one sparse (voxel x template) weight matrix, and every lesion load of a lesion is one sparse product
+# over the lesion's voxels instead of one full-volume multiplication per template.
+
+SMATT_TRACTS = ['M1', 'PMd', 'PMv', 'S1', 'SMA', 'preSMA']
+
+# template name: (file name, whether the lesion load is normalized by the sum of the template, values <= this are set to 0)
+# As in sLNM_lesion_load.ipynb, the background value of the PC1 map (non-WM voxels, <= -0.07635655) is zeroed out.
+SLNM_TEMPLATES = OrderedDict([('PC1', ('fm_slnm_pc1.nii.gz', True, -0.07635655)),
+                              ('PC2_1', ('fm_slnm_pc2_pos.nii.gz', True, None)),
+                              ('PC2_2', ('fm_slnm_pc2_neg_flipped.nii.gz', True, None)),
+                              ('PC3_1', ('fm_slnm_pc3_pos.nii.gz', True, None)),
+                              ('PC3_2', ('fm_slnm_pc3_neg_flipped.nii.gz', True, None))])
+LBM_TEMPLATE = ('LBM_map_Bowren.nii.gz', False, None)
+
+# templates shipped with the pipeline (LBM and sLNM maps)
+EXTRAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'extras')
+
+# lesion descriptors returned with the lesion loads: lesion volume (mm^3), number of lesioned voxels left/right of the
+# midline (x < 0 / x > 0 in world coordinates) and the lesioned hemisphere inferred from them (coded as LESIONED_HEMISPHERE)
+LESION_DESCRIPTORS = ['lesionvol', 'n_voxels_left', 'n_voxels_right', 'inferred_hemisphere']
+
+# a lesion is bilateral (3) if at least this fraction of its voxels lies in the smaller hemisphere
+BILATERAL_FRACTION = 0.1
+
+
+def get_template_files(smatt_dir=None, slnm_dir=EXTRAS_DIR):
+    # Template name -> (file, normalize, threshold) for every template that is available: the 12 S-MATT tracts
+    # ({smatt_dir}/Left-M1-S-MATT.nii ..., named L_M1_CST ...), the LBM map and the 5 sLNM PC maps in slnm_dir.
+    # S-MATT lesion loads are the fraction of the tract covered by the lesion, LBM is the unnormalized sum over the lesion.
+    template_files = OrderedDict()
+    if smatt_dir and not smatt_dir == 'none':
+        for side, hem in [('L', 'Left'), ('R', 'Right')]:
+            for tract in SMATT_TRACTS:
+                template_files['{}_{}_CST'.format(side, tract)] = (os.path.join(smatt_dir, '{}-{}-S-MATT.nii'.format(hem, tract)), True, None)
+    if slnm_dir and not slnm_dir == 'none':
+        template_files['LBM'] = (os.path.join(slnm_dir, LBM_TEMPLATE[0]),) + LBM_TEMPLATE[1:]
+        for name, (file, normalize, threshold) in SLNM_TEMPLATES.items():
+            template_files[name] = (os.path.join(slnm_dir, file), normalize, threshold)
+    return template_files
+
+def build_template_matrix(template_files):
+    # Loads every template once and stores it as a column of a sparse (n_voxels x n_templates) CSR matrix, with one row per
+    # voxel of the (flattened) MNI volume, so that a lesion's loads only touch the rows of its own voxels.
+    # The sparse (nonzero) weights are kept as float32, the NIfTI storage type of the templates.
+    # Returns a dict with the template names, the volume shape and affine, the weight matrix and the normalization of each template.
+    names = list(template_files)
+    shape = None
+    affine = None
+    rows, cols, vals = [], [], []
+    norms = np.ones(len(names))
+    for t, name in enumerate(names):
+        file, normalize, threshold = template_files[name]
+        img = nib.load(file)
+        if shape is None:
+            shape = img.shape[:3]
+            affine = img.affine
+        elif not img.shape[:3] == shape:
+            raise RuntimeError('Warning! Template {} has shape {}, expected {}'.format(file, img.shape[:3], shape))
+        data = np.asarray(img.get_fdata(dtype=np.float32)).reshape(-1)
+        if threshold is not None:
+            data[data <= threshold] = 0
+        nonzero = np.flatnonzero(data)
+        rows.append(nonzero)
+        cols.append(np.full(nonzero.shape[0], t))
+        vals.append(data[nonzero])
+        if normalize:
+            norms[t] = np.sum(data[nonzero], dtype=np.float64)
+    n_voxels = int(np.prod(shape))
+    weights = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n_voxels, len(names)), dtype=np.float32)
+    return {'names': names, 'shape': tuple(int(s) for s in shape), 'affine': affine, 'weights': weights, 'norms': norms}
+
+def load_templates(smatt_dir=None, slnm_dir=EXTRAS_DIR):
+    # Convenience wrapper: template matrix of every available template.
+    return build_template_matrix(get_template_files(smatt_dir, slnm_dir))
+
+def read_lesion_voxels(mask_file):
+    # Linear (C-order) indices of the nonzero voxels of a lesion mask, and the volume shape.
+    # The mask is read in its stored data type instead of being expanded to float64 by get_fdata.
+    img = nib.load(mask_file)
+    data = np.asanyarray(img.dataobj)
+    return np.flatnonzero(data.reshape(-1)), img.shape[:3]
+
+def get_lesion_cache_file(cache_dir, mask_file):
+    # {cache_dir}/{mask name without .nii/.nii.gz}.npz
+    name = os.path.basename(mask_file)
+    for ext in ['.nii.gz', '.nii']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(cache_dir, name + '.npz')
+
+def write_lesion_cache(mask_file, cache_file):
+    # Stores a binary lesion mask as its sorted linear voxel indices (delta-encoded, so they compress well) in a compressed
+    # .npz file, together with the volume shape, the voxel volume (mm^3) and the voxel count. The mask file's modification
+    # time and size are stored as well, so that the cache entry is rebuilt if the mask changes.
+    img = nib.load(mask_file)
+    voxels = np.flatnonzero(np.asanyarray(img.dataobj).reshape(-1))
+    st = os.stat(mask_file)
+    tmp_file = cache_file[:-len('.npz')] + '.tmp{}.npz'.format(os.getpid())
+    np.savez_compressed(tmp_file, deltas=np.diff(voxels, prepend=0).astype(np.uint32), shape=np.array(img.shape[:3]),
+                        voxel_volume=np.prod(img.header.get_zooms()[:3]), n_voxels=len(voxels),
+                        source_mtime_ns=st.st_mtime_ns, source_size=st.st_size)
+    os.replace(tmp_file, cache_file)
+    return voxels, img.shape[:3]
+
+def read_lesion_cache(cache_file, mask_file=None):
+    # Voxel indices and volume shape from a lesion cache entry, or None if it is missing or older than mask_file.
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as cache:
+        if mask_file is not None and os.path.exists(mask_file):
+            st = os.stat(mask_file)
+            if not (int(cache['source_mtime_ns']) == st.st_mtime_ns and int(cache['source_size']) == st.st_size):
+                return None
+        return np.cumsum(cache['deltas'], dtype=np.int64), tuple(int(s) for s in cache['shape'])
+
+def load_lesion_voxels(mask_file, cache_dir=None):
+    # Voxel indices and volume shape of a lesion mask, read from the compressed lesion cache in cache_dir if possible.
+    # Masks that are not cached yet (or changed since) are read from the NIfTI file once and added to the cache.
+    if not cache_dir or cache_dir == 'none':
+        return read_lesion_voxels(mask_file)
+    cache_file = get_lesion_cache_file(cache_dir, mask_file)
+    cached = read_lesion_cache(cache_file, mask_file)
+    if cached is not None:
+        return cached
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    return write_lesion_cache(mask_file, cache_file)
+
+def compute_lesion_descriptors(voxels, shape, affine):
+    # Lesion volume, left/right voxel counts and inferred lesioned hemisphere of one lesion (see LESION_DESCRIPTORS), from
+    # the same voxel indices as the lesion loads: only the x world coordinate of each lesioned voxel is computed.
+    # The inferred hemisphere is 1 (left) or 2 (right), 3 (bilateral) if the smaller side holds at least BILATERAL_FRACTION
+    # of the voxels, and NaN for an empty mask or a lesion on the midline only.
+    ijk = np.unravel_index(voxels, shape)
+    x = affine[0, 0]*ijk[0] + affine[0, 1]*ijk[1] + affine[0, 2]*ijk[2] + affine[0, 3]
+    n_left, n_right = int(np.sum(x < 0)), int(np.sum(x > 0))
+    if n_left + n_right == 0:
+        hemisphere = np.nan
+    elif min(n_left, n_right) >= BILATERAL_FRACTION*(n_left + n_right):
+        hemisphere = 3
+    else:
+        hemisphere = 1 if n_left > n_right else 2
+    voxel_volume = abs(np.linalg.det(affine[:3, :3]))
+    return OrderedDict(zip(LESION_DESCRIPTORS, [len(voxels)*voxel_volume, n_left, n_right, hemisphere]))
+
+def compute_lesion_loads(voxels, templates, hemisphere=None):
+    # Every lesion load of one lesion (given as linear voxel indices) in one sparse product over the lesion's voxels,
+    # followed by the lesion descriptors (volume, left/right voxel counts, inferred hemisphere, see compute_lesion_descriptors).
+    # If the S-MATT tracts are loaded, the ipsilesional loads (M1_CST ... preSMA_CST) are also returned, chosen by the
+    # lesioned hemisphere code as in SMATT_lesion_load.m: 1 = left, 2 = right, 3-6 (bilateral, brainstem, cerebellum,
+    # combination) = mean of both hemispheres, anything else = NaN. If no hemisphere is given (None or NaN), the inferred
+    # hemisphere is used.
+    # Returns an OrderedDict of lesion load name -> value.
+    weights = templates['weights']
+    indicator = sp.csr_matrix((np.ones(len(voxels)), (np.zeros(len(voxels), dtype=int), voxels)), shape=(1, weights.shape[0]))
+    values = np.asarray((indicator @ weights).todense(), dtype=np.float64).ravel()/templates['norms']
+    loads = OrderedDict(zip(templates['names'], values))
+    descriptors = compute_lesion_descriptors(voxels, templates['shape'], templates['affine'])
+    if hemisphere is None or np.isnan(hemisphere):
+        hemisphere = descriptors['inferred_hemisphere']
+
+    if 'L_M1_CST' in loads:
+        for tract in SMATT_TRACTS:
+            left, right = loads['L_{}_CST'.format(tract)], loads['R_{}_CST'.format(tract)]
+            if hemisphere == 1:
+                loads['{}_CST'.format(tract)] = left
+            elif hemisphere == 2:
+                loads['{}_CST'.format(tract)] = right
+            elif hemisphere in [3, 4, 5, 6]:
+                loads['{}_CST'.format(tract)] = (left + right)/2
+            else:
+                loads['{}_CST'.format(tract)] = np.nan
+    loads.update(descriptors)
+    return loads
+
+def compute_lesion_load_table(mask_files, templates, hemispheres=None, cache_dir=None):
+    # Lesion loads of several subjects. mask_files: dict of subject ID -> lesion mask file, hemispheres: dict of
+    # subject ID -> lesioned hemisphere code (see compute_lesion_loads), cache_dir: lesion cache (see load_lesion_voxels).
+    # Returns a DataFrame with one row per subject.
+    hemispheres = hemispheres or {}
+    rows = OrderedDict()
+    for subject, mask_file in mask_files.items():
+        voxels, shape = load_lesion_voxels(mask_file, cache_dir)
+        if not tuple(shape) == templates['shape']:
+            raise RuntimeError('Warning! Lesion mask {} has shape {}, expected {}'.format(mask_file, shape, templates['shape']))
+        rows[subject] = compute_lesion_loads(voxels, templates, hemispheres.get(subject))
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+def get_lesion_load_columns(template_files):
+    # Output columns of compute_lesion_loads for a set of templates, in order.
+    columns = list(template_files)
+    if 'L_M1_CST' in columns:
+        columns = columns + ['{}_CST'.format(tract) for tract in SMATT_TRACTS]
+    return columns + LESION_DESCRIPTORS
+
+def find_lesion_masks(mask_dir, ids):
+    # Lesion mask file of each subject ({mask_dir}/{subject ID}.nii.gz or .nii). Returns a dict of subject ID -> file
+    # and the list of subjects without a lesion mask.
+    mask_files = OrderedDict()
+    missing = []
+    for subject in ids:
+        for ext in ['.nii.gz', '.nii']:
+            if os.path.exists(os.path.join(mask_dir, str(subject) + ext)):
+                mask_files[subject] = os.path.join(mask_dir, str(subject) + ext)
+                break
+        else:
+            missing.append(subject)
+    return mask_files, missing
+
+
+# atlas: (parcellation volume in MNI space, number of parcels), the same volumes generate_wb_files uses (in scenesdir)
+ATLAS_FILES = {'fs86subj': ('fs86_dil1_allsubj_mode.nii.gz', 86),
+               'shen268': ('shen268_MNI1mm_dil1.nii.gz', 268)}
+
+# atlas file -> (modification time, flattened parcel labels, number of voxels of each parcel), see load_atlas_labels
+_atlas_cache = {}
+
+def load_atlas_labels(atlas, atlas_dir):
+    # Parcel label of every voxel of the (flattened, C-order) atlas volume, the volume shape and the number of voxels of
+    # each parcel (labels 1 ... n_parcels, 0 is background). Cached until the atlas file changes.
+    file, n_parcels = ATLAS_FILES[atlas]
+    atlas_file = os.path.join(atlas_dir, file)
+    mtime = os.stat(atlas_file).st_mtime_ns
+    if atlas_file in _atlas_cache and _atlas_cache[atlas_file][0] == mtime:
+        return _atlas_cache[atlas_file][1]
+
+    img = nib.load(atlas_file)
+    labels = np.rint(np.asanyarray(img.dataobj).reshape(-1)).astype(np.int32)
+    labels[(labels < 0) | (labels > n_parcels)] = 0
+    parcel_sizes = np.bincount(labels, minlength=n_parcels + 1)[1:]
+    atlas_labels = {'labels': labels, 'shape': tuple(int(s) for s in img.shape[:3]), 'parcel_sizes': parcel_sizes}
+    _atlas_cache[atlas_file] = (mtime, atlas_labels)
+    return atlas_labels
+
+def compute_parcel_overlap(voxels, atlas_labels):
+    # Fraction of each parcel covered by a lesion (given as linear voxel indices): one bincount over the parcel labels of
+    # the lesion's voxels, divided by the parcel sizes. Parcels without voxels in the atlas get 0.
+    labels = atlas_labels['labels']
+    parcel_sizes = atlas_labels['parcel_sizes']
+    counts = np.bincount(labels[voxels], minlength=len(parcel_sizes) + 1)[1:]
+    return np.divide(counts, parcel_sizes, out=np.zeros(len(parcel_sizes)), where=parcel_sizes > 0)
+
+def compute_parcel_overlap_matrix(mask_files, atlas, atlas_dir, cache_dir=None, n_workers=1):
+    # Parcel overlap of a list of lesion masks (one row per mask, in order), read with n_workers threads.
+    # cache_dir: lesion cache (see load_lesion_voxels), so that repeated runs do not decode the NIfTI masks again.
+    atlas_labels = load_atlas_labels(atlas, atlas_dir)
+    X = np.zeros((len(mask_files), len(atlas_labels['parcel_sizes'])))
+
+    def fill_row(i):
+        voxels, shape = load_lesion_voxels(mask_files[i], cache_dir)
+        if not tuple(shape) == atlas_labels['shape']:
+            raise RuntimeError('Warning! Lesion mask {} has shape {}, expected {}'.format(mask_files[i], shape, atlas_labels['shape']))
+        X[i, :] = compute_parcel_overlap(voxels, atlas_labels)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(fill_row, range(len(mask_files))))
+    return X
+
+
+def share_templates(templates):
+    # Shared-memory template registry: copies the arrays of a template matrix (see build_template_matrix) into shared memory
+    # blocks once, so that worker processes can use them without decoding the templates again or holding their own copy.
+    # Returns a small, picklable handle for attach_templates and the shared memory blocks, which the caller must release
+    # with release_templates when the workers are done.
+    weights = templates['weights']
+    arrays = {'data': weights.data, 'indices': weights.indices, 'indptr': weights.indptr, 'norms': templates['norms']}
+    handle = {'names': templates['names'], 'shape': templates['shape'], 'affine': templates['affine'], 'weights_shape': weights.shape, 'arrays': {}}
+    blocks = []
+    for key, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        handle['arrays'][key] = (block.name, array.dtype.str, array.shape)
+        blocks.append(block)
+    return handle, blocks
+
+def attach_templates(handle):
+    # Template matrix backed by the shared memory blocks of a share_templates handle (read-only, nothing is copied).
+    # The attached blocks are kept in the returned dict, so the memory stays mapped as long as the templates are used.
+    arrays = {}
+    blocks = []
+    for key, (name, dtype, shape) in handle['arrays'].items():
+        block = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.setflags(write=False)
+        arrays[key] = array
+        blocks.append(block)
+    weights = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=handle['weights_shape'], copy=False)
+    return {'names': handle['names'], 'shape': handle['shape'], 'affine': handle['affine'], 'weights': weights, 'norms': arrays['norms'], 'blocks': blocks}
+
+def release_templates(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+# Templates and lesion cache directory of a lesion-load worker process, set once per process by init_lesion_load_worker
+_worker_templates = None
+_worker_cache_dir = None
+
+def init_lesion_load_worker(template_handle, cache_dir=None):
+    # Attaches to the templates shared by the parent process (see share_templates) instead of loading them again.
+    global _worker_templates, _worker_cache_dir
+    _worker_templates = attach_templates(template_handle)
+    _worker_cache_dir = cache_dir
+
+def compute_subject_lesion_loads(item, templates=None, cache_dir=None):
+    # Worker task: (subject ID, mask file, hemisphere code) -> (subject ID, lesion loads, error message).
+    # Uses the worker's templates and lesion cache unless templates are given.
+    if templates is None:
+        templates, cache_dir = _worker_templates, _worker_cache_dir
+    subject, mask_file, hemisphere = item
+    try:
+        voxels, shape = load_lesion_voxels(mask_file, cache_dir)
+        if not tuple(shape) == templates['shape']:
+            raise RuntimeError('Lesion mask {} has shape {}, expected {}'.format(mask_file, shape, templates['shape']))
+        return subject, compute_lesion_loads(voxels, templates, hemisphere), None
+    except Exception as e:
+        return subject, None, str(e)
+
+def hash_file(path):
+    # sha1 of the file contents
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def hash_templates(template_files):
+    # One hash over the contents and settings (normalization, threshold) of all templates: if any template changes,
+    # every lesion load computed with the old templates is out of date.
+    h = hashlib.sha1()
+    for name, (file, normalize, threshold) in template_files.items():
+        h.update('{}:{}:{}:{}\n'.format(name, hash_file(file), normalize, threshold).encode())
+    return h.hexdigest()
+
+def read_lesion_load_table(output_file, subid_colname):
+    # Lesion-load table written by compute_lesion_loads_batch (None if there is none yet). A partially written last line
+    # (from an interrupted run) is removed first.
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return None
+    with open(output_file, 'rb+') as f:
+        data = f.read()
+        if not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+    return pd.read_csv(output_file, dtype={subid_colname: str, 'mask_sha1': str, 'mask_mtime_ns': str, 'mask_size': str, 'templates_sha1': str},
+                       float_precision='round_trip')
+
+def write_lesion_load_table(table, output_file, subid_colname):
+    # Rewrites the lesion-load table with one row per subject (the last one written), replacing the file atomically.
+    table = table.drop_duplicates(subset=subid_colname, keep='last')
+    table.to_csv(output_file + '.tmp', index=False)
+    os.replace(output_file + '.tmp', output_file)
+
+def compute_lesion_loads_batch(mask_files, template_files, output_file, hemispheres=None, n_workers=1, subid_colname='BIDS_ID', cache_dir=None):
+    # Computes the lesion loads of the subjects in mask_files (dict of subject ID -> lesion mask file) on a pool of
+    # n_workers processes and merges them into the lesion-load table output_file (.csv).
+    # Each row stores the content hash of the subject's mask and of the templates it was computed with, and only subjects
+    # that are new, whose mask changed or that were computed with other templates are recomputed. The mask's modification
+    # time and size are stored with its hash, and only masks whose stat changed are read and hashed again. Rows are appended as soon
+    # as they are done, so an interrupted run continues where it stopped; the table is compacted to one row per subject at
+    # the end. Subjects whose mask could not be read are reported and not written (they are retried by the next run).
+    # Masks are read through the lesion cache in cache_dir if given. Returns the list of subjects that failed.
+    hemispheres = hemispheres or {}
+    load_columns = get_lesion_load_columns(template_files)
+    columns = [subid_colname] + load_columns + ['mask_sha1', 'mask_mtime_ns', 'mask_size', 'templates_sha1']
+    templates_sha1 = hash_templates(template_files)
+    mask_stats = {subject: os.stat(file) for subject, file in mask_files.items()}
+    mask_stats = {subject: (str(st.st_mtime_ns), str(st.st_size)) for subject, st in mask_stats.items()}
+
+    table = read_lesion_load_table(output_file, subid_colname)
+    known_hashes = {}
+    if table is not None:
+        if not list(table.columns) == columns:
+            # other templates or outputs than the existing table: keep its rows (they will be recomputed) under the new columns,
+            # tables without the mask stat columns only need their masks hashed again
+            if not [c for c in table.columns if c not in ('mask_mtime_ns', 'mask_size')] == [c for c in columns if c not in ('mask_mtime_ns', 'mask_size')]:
+                table['templates_sha1'] = np.nan
+            table = table.reindex(columns=columns)
+            write_lesion_load_table(table, output_file, subid_colname)
+        last = table.drop_duplicates(subset=subid_colname, keep='last')
+        known_hashes = {subject: mask_sha1 for subject, mask_sha1, mtime, size in zip(last[subid_colname], last['mask_sha1'], last['mask_mtime_ns'], last['mask_size'])
+                        if mask_stats.get(subject) == (mtime, size)}
+    # only masks that are new or whose modification time or size changed are read
+    to_hash = [subject for subject in mask_files if str(subject) not in known_hashes]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        mask_hashes = dict(zip(to_hash, executor.map(hash_file, [mask_files[subject] for subject in to_hash])))
+    mask_hashes.update({subject: known_hashes[str(subject)] for subject in mask_files if str(subject) in known_hashes})
+
+    up_to_date = set()
+    if table is not None:
+        current = table[table['templates_sha1'] == templates_sha1].drop_duplicates(subset=subid_colname, keep='last')
+        up_to_date = {subject for subject, mask_sha1 in zip(current[subid_colname], current['mask_sha1']) if mask_hashes.get(subject) == mask_sha1}
+        # masks that were hashed again but did not change (e.g. touched, or a table without mask stats): their new stats are
+        # stored so that they are not hashed again by the next run
+        restat = [subject for subject in up_to_date if subject not in known_hashes]
+        if restat:
+            table[['mask_mtime_ns', 'mask_size']] = table[['mask_mtime_ns', 'mask_size']].astype(object)
+            for subject in restat:
+                table.loc[table[subid_colname] == subject, ['mask_mtime_ns', 'mask_size']] = mask_stats[subject]
+            write_lesion_load_table(table, output_file, subid_colname)
+    items = [(subject, file, hemispheres.get(subject)) for subject, file in mask_files.items() if str(subject) not in up_to_date]
+    print('{} subjects up to date, computing lesion loads for {} new or changed subjects'.format(len(mask_files) - len(items), len(items)))
+
+    failed = []
+    with open(output_file, 'a') as f:
+        if table is None:
+            f.write(','.join(columns) + '\n')
+            f.flush()
+
+        def write_result(result):
+            subject, loads, error = result
+            if error is not None:
+                print('Lesion loads not computed for {}: {}'.format(subject, error))
+                failed.append(subject)
+                return
+            f.write(','.join([str(subject)] + [repr(float(loads[c])) for c in load_columns] + [mask_hashes[subject], *mask_stats[subject], templates_sha1]) + '\n')
+            f.flush()
+
+        if n_workers > 1 and items:
+            # the templates are decoded once here and shared with every worker
+            template_handle, blocks = share_templates(build_template_matrix(template_files))
+            try:
+                with multiprocessing.Pool(n_workers, initializer=init_lesion_load_worker, initargs=(template_handle, cache_dir)) as pool:
+                    for result in pool.imap_unordered(compute_subject_lesion_loads, items):
+                        write_result(result)
+            finally:
+                release_templates(blocks)
+        elif items:
+            templates = build_template_matrix(template_files)
+            for item in items:
+                write_result(compute_subject_lesion_loads(item, templates, cache_dir))
+
+    if table is not None and items:
+        write_lesion_load_table(read_lesion_load_table(output_file, subid_colname), output_file, subid_colname)
+    return failed
@@ -14,12 +14,12 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="Set up and run machine learning pipeline for lesion biomarker data.")
 
   # lesionmask_path: str, default ='/home/ubuntu/enigma/lesionmasks/', path to niftis
-  #parser.add_argument("--lesionmask_path", default='/home/ubuntu/enigma/lesionmasks/',
-  #  help="Absolute path where lesion masks are located, default='/home/ubuntu/enigma/lesionmasks/'")
+  parser.add_argument("--lesionmask_path", default='/home/ubuntu/enigma/lesionmasks/',
+    help="Absolute path where lesion masks ({subject ID}.nii.gz) are located, used by chaco_type 'lesionoverlap', default='/home/ubuntu/enigma/lesionmasks/'")
   
   # nemo_path: str, default ='/home/ubuntu/enigma/lesionmasks/', path to niftis
   parser.add_argument("--nemo_path", default='/home/ubuntu/enigma/lesionmasks/',
-    help="Absolute path where NeMo outputs (subjectID_*_mean.pkl files) are located, default='/home/ubuntu/enigma/lesionmasks/', where * is NeMo-generated suffix")
+    help="Absolute path where NeMo outputs (subjectID_*_mean.pkl files) are located, default='/home/ubuntu/enigma/lesionmasks/', where * is NeMo-generated suffix. Can also be a .zip archive of NeMo outputs (read without extracting), or several directories/archives separated by commas")
   
   # nemo_path: str, default ='/home/ubuntu/enigma/lesionmasks/', path to nemo outputs
   parser.add_argument("--nemo_settings", default=['1mm','sdstream'],type=lambda s: [item.replace(" ", "") for item in s.split(',')],
@@ -93,7 +93,7 @@ if __name__ == '__main__':
 
   # chaco_types: list, default = ['chacnoneovol'], regional or pairwise chaco type "chacovol", "chacoconn"
   parser.add_argument("--chaco_types", default=['none'], type=lambda s: [item.replace(" ", "") for item in s.split(',')],
-    help="Regional or pairwise chaco type, Options: 'none', 'chacovol', 'chacoconn', default=['none']")
+    help="Regional or pairwise chaco type, Options: 'none', 'chacovol', 'chacoconn', 'lesionoverlap' (fraction of each atlas parcel covered by the lesion, computed from the lesion masks without NeMo), default=['none']")
 
   # crossval_types: list, default = ['1'], which cross-validation scheme to use
   parser.add_argument("--crossval_types", default=['1'], type=lambda s: [item.replace(" ", "") for item in s.split(',')],
@@ -146,6 +146,54 @@ if __name__ == '__main__':
   parser.add_argument("--override_rerunmodels", default=False,
     help="Whether to re-run models even if already run with same parameters, default=False") 
   
+  # store_path: str, default = 'none', directory of memory-mapped ChaCo feature stores written by build_chaco_store.py
+  parser.add_argument("--store_path", default='none',
+    help="Directory of ChaCo feature stores written by build_chaco_store.py. If specified, ChaCo scores are read from the store instead of the NeMo outputs in nemo_path, default='none'")
+  
+  # load_workers: int, default = 1, number of threads used to read NeMo outputs
+  parser.add_argument("--load_workers", type=int, default=1,
+    help="Number of threads used to read NeMo outputs (subjectID_*_mean.pkl files), default=1")
+  
+  # sparse_chacoconn: bool, default = False, whether to keep chacoconn scores as a sparse matrix
+  parser.add_argument("--sparse_chacoconn", default=False,
+    help="Whether to load pairwise (chacoconn) ChaCo scores as a sparse matrix and keep them sparse through feature selection and model fitting (not used with store_path), default=False")
+  
+  # dataset_cache_mb: int, default = 2000, memory budget for data sets reused across models/cross-validation types
+  parser.add_argument("--dataset_cache_mb", type=int, default=2000,
+    help="Memory budget (in MB) for loaded data sets that are reused across the models, cross-validation types and subsets of a run. Least recently used data sets are dropped first, default=2000")
+  
+  # lesionvol_path: str, default = 'none', directory of lesion volume text files ({subject ID}.txt)
+  parser.add_argument("--lesionvol_path", default='none',
+    help="Directory of lesion volume files ({subject ID}.txt, lesion volume as the first value) or of the compressed lesion mask cache written by compute_lesion_loads.py ({subject ID}.npz), or the lesion-load table (.csv) written by compute_lesion_loads.py. If specified, lesion volume can be used as a covariate ('lesionvol'), default='none'")
+  
+  # csv_cache_path: str, default = 'none', directory of binary .csv caches
+  parser.add_argument("--csv_cache_path", default='none',
+    help="Directory for a binary per-column cache of the .csv file (rebuilt whenever the .csv contents change). If specified, only the columns a run needs are loaded from the cache instead of parsing the .csv, default='none'")
+  
+  # out_of_core_path: str, default = 'none', directory for on-disk float32 feature matrices of very large cohorts
+  parser.add_argument("--out_of_core_path", default='none',
+    help="Directory for on-disk float32 ChaCo feature matrices, written in chunks of subjects. If specified, feature matrices are memory-mapped from there instead of loaded into memory; use with models_tested 'ridge_outofcore' to also keep model fitting out of core, default='none'")
+  
+  # lesion_cache_path: str, default = 'none', directory of the compressed lesion mask cache
+  parser.add_argument("--lesion_cache_path", default='none',
+    help="Directory of the compressed lesion mask cache ({subject ID}.npz, see compute_lesion_loads.py). If specified, chaco_type 'lesionoverlap' reads the lesion masks from the cache and adds masks that are not cached yet, default='none'")
+  
+  # outer_jobs: int, default = 1, number of processes running (permutation, outer fold) units in parallel
+  parser.add_argument("--outer_jobs", type=int, default=1,
+    help="Number of processes that run the permutations x outer cross-validation folds of a model in parallel (each outer fold of each permutation is fit independently), default=1")
+  
+  # n_cores: int, default = 0, total number of cores the run may use
+  parser.add_argument("--n_cores", type=int, default=0,
+    help="Total number of cores the run may use (0: all cores of the machine). The cores are split between the outer_jobs processes, the grid search workers of each and blas_threads BLAS threads per grid search worker, so that several runs can share a machine without oversubscribing it, default=0")
+  
+  # blas_threads: int, default = 1, BLAS/OpenMP threads per worker
+  parser.add_argument("--blas_threads", type=int, default=1,
+    help="Number of BLAS/OpenMP threads per worker process; the remaining cores of the n_cores budget go to grid search workers, default=1")
+  
+  # search_modes: str, default = 'none', inner loop hyperparameter search mode per model
+  parser.add_argument("--search_modes", default=['none'], type=lambda s: [item.replace(" ", "") for item in s.split(',')],
+    help="Inner loop hyperparameter search per model, as model:mode pairs (e.g. 'elastic_net:coarse_to_fine,svr:halving') or one mode for all models. Options: 'grid' (full grid), 'halving' (successive halving over subjects), 'coarse_to_fine' (coarse-to-fine refinement of the log-spaced grids). The adaptive modes cut the cost of the inner loop (fits, full-data equivalents and decompositions are reported per outer fold) but may pick slightly different hyperparameters; ridge and ridge_nofeatselect always score the alpha grid from ridge paths instead of fits, in any mode ('coarse_to_fine' refines k for ridge). Default='none' (full grid for every model)")
+  
   #final modle
   parser.add_argument("--final_model", default='false',
     help="Run a single 5-fold cross-validation and return the final model with its selected features.") 
@@ -153,7 +201,7 @@ if __name__ == '__main__':
       
   args = parser.parse_args()
     # check that parameters make sense.
-  model_options= ['none', 'ridge', 'lasso', 'elastic_net', 'ridge_nofeatselect', 'linear_regression', 'svm', 'svr', 'ensemble_reg']
+  model_options= ['none', 'ridge', 'lasso', 'elastic_net', 'ridge_nofeatselect', 'linear_regression', 'svm', 'svr', 'ensemble_reg', 'ridge_outofcore']
   if not set(args.models_tested).issubset(set(model_options)):
       raise RuntimeError('Warning! Unknown model option specified {} \n Only the following options are allowed {} \n'.format(args.models_tested, model_options))
 
@@ -169,10 +217,21 @@ if __name__ == '__main__':
   if not set(args.atlases).issubset(set(atlas_options)):
       raise RuntimeError('Warning! Unknown atlas type specified: {}\n Only the following options are allowed: {} \n'.format(args.atlases, atlas_options))
 
-  chaco_options = ['none', 'chacovol', 'chacoconn']
+  chaco_options = ['none', 'chacovol', 'chacoconn', 'lesionoverlap']
   if not set(args.chaco_types).issubset(set(chaco_options)):
       raise RuntimeError('Warning! Unknown atlas type specified: {}\n Only the following options are allowed: {} \n'.format(args.chaco_types, chaco_options))
 
+  search_mode_options = ['grid', 'halving', 'coarse_to_fine']
+  search_modes = {}
+  for item in args.search_modes:
+      if item == 'none':
+          continue
+      model, _, mode = item.rpartition(':')
+      if mode not in search_mode_options or (model and model not in model_options):
+          raise RuntimeError('Warning! Unknown search mode specified: {}\n Only model:mode pairs with the following modes are allowed: {} \n'.format(item, search_mode_options))
+      search_modes[model or 'all'] = mode
+  args.search_modes = search_modes
+
   crossval_options = ['1', '2', '3', '4', '5']
   if not set(args.crossval_types).issubset(set(crossval_options)):
       raise RuntimeError('Warning! Unknown cross validation type specified: {}\n Only the following options are allowed: {} \n'.format(args.crossval_types, crossval_options))    
@@ -194,7 +253,7 @@ if __name__ == '__main__':
       # if you specified running a lesion load model AND a chaco model but you only specified the parameters for both (not 'none' options)
       args.lesionload_types.append('none')
   
-  if ('chacovol' in args.chaco_types ) and (not args.models_tested):
+  if (('chacovol' in args.chaco_types ) or ('lesionoverlap' in args.chaco_types)) and (not args.models_tested):
       raise RuntimeError('Error: please specify a machine learning model to use for ChaCo predictions.')
   
   if isinstance(args.override_rerunmodels, str):
@@ -213,13 +272,17 @@ if __name__ == '__main__':
     # anything else I'm assuming you meant false.
     args.override_rerunmodels = (args.override_rerunmodels =='True') or (args.override_rerunmodels == 'true') or (args.override_rerunmodels == 'T') or (args.override_rerunmodels == '1')
   
+  if isinstance(args.sparse_chacoconn, str):
+    # anything else I'm assuming you meant false.
+    args.sparse_chacoconn = (args.sparse_chacoconn =='True') or (args.sparse_chacoconn == 'true') or (args.sparse_chacoconn == 'T') or (args.sparse_chacoconn == '1')
+  
   if not isinstance(args.chronicity_colname,str):
     args.chronicity_colname = 'none'
   
-  if ('chacovol' in args.chaco_types) and ('none' in args.atlases):
+  if (('chacovol' in args.chaco_types) or ('lesionoverlap' in args.chaco_types)) and ('none' in args.atlases):
     raise RuntimeError('No atlas specified for ChaCo model. Either specify at atlas, or do not specify a ChaCo model (chaco_types = "none")')
-  #if not os.path.exists(args.lesionmask_path):
-  #    raise RuntimeError('Warning! Path {} does not exist.'.format(args.lesionmask_path))
+  if ('lesionoverlap' in args.chaco_types) and (not os.path.exists(args.lesionmask_path)):
+      raise RuntimeError('Warning! Path {} does not exist.'.format(args.lesionmask_path))
 
   kwargs = vars(args)
   pprint.pprint(kwargs)
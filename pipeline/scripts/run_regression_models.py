@@ -24,8 +24,10 @@ reload(helper_functions_figures)
 # options for visualizing the results using the Connectome Workbench software and generating box plots of the results.
 
 
-def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colname,chronicity_colname,subsets,nemo_settings, models_tested, verbose, covariates, lesionload_types, nperms, save_models, ensembles,hcp_dir, atlases, chaco_types, crossval_types, null, results_path, output_folder, figs_only, fig_path, workbench_vis,scenesdir, wbpath,boxplots, override_rerunmodels, ensemble_atlas,final_model,generate_figures):
+def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colname,chronicity_colname,subsets,nemo_settings, models_tested, verbose, covariates, lesionload_types, nperms, save_models, ensembles,hcp_dir, atlases, chaco_types, crossval_types, null, results_path, output_folder, figs_only, fig_path, workbench_vis,scenesdir, wbpath,boxplots, override_rerunmodels, ensemble_atlas,final_model,generate_figures,store_path='none',load_workers=1,sparse_chacoconn=False,dataset_cache_mb=2000,lesionvol_path='none',csv_cache_path='none',out_of_core_path='none',lesionmask_path='none',lesion_cache_path='none',outer_jobs=1,n_cores=0,blas_threads=1,search_modes=None):
     
+    core_budget = get_core_budget(n_cores, outer_jobs, blas_threads)
+
     subsetcounter = 0
     labels=[]
     r2means=np.empty(shape=(0,nperms))
@@ -40,7 +42,7 @@ def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colna
             models_tested_chaco= models_tested
 
         for lesionload_type in lesionload_types:
-            if lesionload_type == 'none' and (('chacovol' in chaco_types) or ('chacoconn' in chaco_types)):
+            if lesionload_type == 'none' and (('chacovol' in chaco_types) or ('chacoconn' in chaco_types) or ('lesionoverlap' in chaco_types)):
                 
                 print('\nRunning ChaCo models.........')
                 for atlas in atlases: 
@@ -53,20 +55,18 @@ def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colna
                                     print('----- \n ----------- \n ----------- \n ------')
 
                                     #format the data for the current parameters
-                                    [X, Y, C, lesion_load, subIDs] = create_data_set(csv_path,site_colname,nemo_path,yvar_colname,subid_colname,chronicity_colname,atlas,covariates, verbose, y_var, chaco_type, subset,1,nemo_settings=nemo_settings,ll= lesionload_type)
-                                    
-                                    subIDs = subIDs.index
-
-                                    print(X.shape)
-                                    
                                     if subset == 'acutechronic':
-                                        # if acutechronic, X (from above) is chronic data.
-                                        # load the acute data here:
-                                        [acuteX, acuteY,acuteC, acute_lesion_load, acute_subIDs] = create_data_set(csv_path,site_colname,nemo_path,yvar_colname, subid_colname,chronicity_colname,atlas,covariates, verbose, y_var, chaco_type,'acute',1,nemo_settings,ll= lesionload_type)
+                                        # if acutechronic, X is chronic data and the acute data is loaded in the same pass.
+                                        [X, Y, C, lesion_load, subIDs], [acuteX, acuteY,acuteC, acute_lesion_load, acute_subIDs] = create_data_set_cached(csv_path,site_colname,nemo_path,yvar_colname,subid_colname,chronicity_colname,atlas,covariates, verbose, y_var, chaco_type, subset,1,nemo_settings=nemo_settings,ll= lesionload_type,store_path=store_path,n_workers=load_workers,sparse=sparse_chacoconn,cache_mb=dataset_cache_mb,lesionvol_path=lesionvol_path,csv_cache_dir=csv_cache_path,out_of_core_path=out_of_core_path,lesionmask_path=lesionmask_path,atlas_dir=scenesdir,lesion_cache_path=lesion_cache_path,loader=create_acutechronic_data_set)
                                         acute_subIDs = acute_subIDs.index
                                         acute_data = {'acute_X':acuteX,'acute_Y':acuteY, 'acute_LL':acute_lesion_load, 'acute_C':acuteC, 'acute_subIDs':acute_subIDs}
                                     else:
+                                        [X, Y, C, lesion_load, subIDs] = create_data_set_cached(csv_path,site_colname,nemo_path,yvar_colname,subid_colname,chronicity_colname,atlas,covariates, verbose, y_var, chaco_type, subset,1,nemo_settings=nemo_settings,ll= lesionload_type,store_path=store_path,n_workers=load_workers,sparse=sparse_chacoconn,cache_mb=dataset_cache_mb,lesionvol_path=lesionvol_path,csv_cache_dir=csv_cache_path,out_of_core_path=out_of_core_path,lesionmask_path=lesionmask_path,atlas_dir=scenesdir,lesion_cache_path=lesion_cache_path)
                                         acute_data = []
+                                    
+                                    subIDs = subIDs.index
+
+                                    print(X.shape)
                                                                         
                                     if verbose:
                                         announce_runningmodel(lesionload_type, ensemble, atlas, chaco_type, crossval, override_rerunmodels)
@@ -86,9 +86,9 @@ def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colna
                                             if figs_only: 
                                                 print('running figs only.')
                                             else:# if figs_only then we just want the output path where the files are located. if not, then actually run the model.
-                                                set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model)
+                                                set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model,core_budget,search_modes)
                                     else: # we do want to override previous results
-                                        set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model)
+                                        set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model,core_budget,search_modes)
 
                                     n_outer_folds=5
       
@@ -123,12 +123,17 @@ def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colna
                                         atlaslabel = 'ChaCo (fs86)'
                                     elif atlas == 'shen268':
                                         atlaslabel = 'ChaCo (shen268)'
+                                    if chaco_type == 'lesionoverlap':
+                                        atlaslabel = atlaslabel.replace('ChaCo', 'Lesion overlap')
                                         
                                     if model_tested =='ridge':
                                         model_tested_label=' + feat. select.'
                                         
                                     elif model_tested =='ridge_nofeatselect':
                                         model_tested_label=''
+
+                                    elif model_tested =='ridge_outofcore':
+                                        model_tested_label=' (out-of-core)'
                                         
                                     if ensemble == 'none':
                                         label = atlaslabel
@@ -156,16 +161,15 @@ def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colna
                             
                             atlas, model_tested, chaco_type = set_vars_for_ll(lesionload_type)
 
-                            [X, Y, C, lesion_load,  subIDs] = create_data_set(csv_path,site_colname,nemo_path,yvar_colname, subid_colname,chronicity_colname,ensemble_atlas,covariates, verbose, y_var, chaco_type,subset,1,nemo_settings,ll= lesionload_type)
-                            subIDs = subIDs.index
                             if subset == 'acutechronic':
-                                # if acutechronic, X (from above) is chronic data.
-                                # load the acute data here:
-                                [acuteX, acuteY, acuteC, acute_lesion_load,acute_subIDs] = create_data_set(csv_path,site_colname,nemo_path,yvar_colname, subid_colname,chronicity_colname,ensemble_atlas,covariates, verbose, y_var, chaco_type,'acute',1,nemo_settings,ll= lesionload_type)
+                                # if acutechronic, X is chronic data and the acute data is loaded in the same pass.
+                                [X, Y, C, lesion_load,  subIDs], [acuteX, acuteY, acuteC, acute_lesion_load,acute_subIDs] = create_data_set_cached(csv_path,site_colname,nemo_path,yvar_colname, subid_colname,chronicity_colname,ensemble_atlas,covariates, verbose, y_var, chaco_type,subset,1,nemo_settings,ll= lesionload_type,store_path=store_path,n_workers=load_workers,sparse=sparse_chacoconn,cache_mb=dataset_cache_mb,lesionvol_path=lesionvol_path,csv_cache_dir=csv_cache_path,out_of_core_path=out_of_core_path,lesionmask_path=lesionmask_path,atlas_dir=scenesdir,lesion_cache_path=lesion_cache_path,loader=create_acutechronic_data_set)
                                 acute_subIDs=acute_subIDs.index
                                 acute_data = {'acute_X':acuteX,'acute_Y':acuteY, 'acute_LL':acute_lesion_load, 'acute_C':acuteC, 'acute_site':acute_subIDs}
                             else:
+                                [X, Y, C, lesion_load,  subIDs] = create_data_set_cached(csv_path,site_colname,nemo_path,yvar_colname, subid_colname,chronicity_colname,ensemble_atlas,covariates, verbose, y_var, chaco_type,subset,1,nemo_settings,ll= lesionload_type,store_path=store_path,n_workers=load_workers,sparse=sparse_chacoconn,cache_mb=dataset_cache_mb,lesionvol_path=lesionvol_path,csv_cache_dir=csv_cache_path,out_of_core_path=out_of_core_path,lesionmask_path=lesionmask_path,atlas_dir=scenesdir,lesion_cache_path=lesion_cache_path)
                                 acute_data = []
+                            subIDs = subIDs.index
                                 
                             if verbose:
                                 announce_runningmodel(lesionload_type, ensemble, atlas, chaco_type, crossval, override_rerunmodels,chaco_model_tested)
@@ -178,10 +182,10 @@ def run_models(site_colname, csv_path, y_var,nemo_path, yvar_colname,subid_colna
                                     output_folder = output_fullpath.replace(results_path, '').replace('/', '')
                                 else:
                                     if not figs_only: # if figs_only then we just want the output path where the files are located. if not, then actually run the model.
-                                        set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model)
+                                        set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model,core_budget,search_modes)
                             else: # we do want to override previous results
 
-                                set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model)
+                                set_up_and_run_model(crossval, model_tested,lesion_load, lesionload_type, X, Y, C, subIDs, atlas, y_var, chaco_type, subset, save_models, results_path, nperms, null,ensemble, output_folder,ensemble_atlas,chaco_model_tested,acute_data,final_model,core_budget,search_modes)
 
                             n_outer_folds =5
                                                     